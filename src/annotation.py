@@ -0,0 +1,274 @@
+'''
+
+compact tooth masks and the per-panorama annotation index,
+shared by manage.py and boxcreation.py
+
+'''
+
+import numpy as np
+
+
+class ToothMask():
+    """Mask of one tooth layer, kept only inside its bounding box
+
+    A full-panorama layer costs ~4.5MB while the tooth covers a few percent of it,
+    so only the bounding box is stored, optionally bit-packed.
+    Pixels of value 255 are the tooth, as in the full-size images.
+
+    Arguments:
+        bound {list} -- [y1, y2, x1, x2] of the box in the panorama
+        img {np.array} -- uint8 image of the box
+    """
+
+    def __init__(self, bound, img):
+        self.bound = [int(b) for b in bound]
+        self.shape = (self.bound[1] - self.bound[0], self.bound[3] - self.bound[2])
+        self._img = img
+        self._bits = None
+        self._area = None
+        self._integral = None
+
+    @classmethod
+    def fromImage(cls, img):
+        # crops a full-size image to the bounding box of its non zero pixels
+        rows = np.nonzero(np.any(img > 0, axis=1))[0]
+        cols = np.nonzero(np.any(img > 0, axis=0))[0]
+        if len(rows) == 0:
+            return cls([0, 0, 0, 0], np.zeros((0, 0), dtype=np.uint8))
+        y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        return cls([y1, y2, x1, x2], img[y1:y2, x1:x2].copy())
+
+    @property
+    def img(self):
+        if self._img is None:
+            mask = np.unpackbits(self._bits)[:self.shape[0] * self.shape[1]].reshape(self.shape)
+            return mask * np.uint8(255)
+        return self._img
+
+    def pack(self):
+        """Keep the mask bit-packed, only valid for binary (0/255) masks"""
+        if self._img is not None:
+            self._area = self.area()
+            self._bits = np.packbits(self._img == 255)
+            self._img = None
+        return self
+
+    def area(self):
+        if self._area is None:
+            self._area = np.sum(self.img == 255)
+        return self._area
+
+    def integral(self):
+        """Summed-area table of the tooth pixels, built on first use"""
+        if self._integral is None:
+            integral = np.zeros((self.shape[0] + 1, self.shape[1] + 1), dtype=np.int32)
+            integral[1:, 1:] = np.cumsum(np.cumsum(self.img == 255, axis=0, dtype=np.int32), axis=1)
+            self._integral = integral
+        return self._integral
+
+    def rectArea(self, y1, y2, x1, x2):
+        """Counts the tooth pixels inside [y1:y2, x1:x2] of the panorama in O(1)"""
+        overlap = self._overlap(y1, y2, x1, x2)
+        if overlap is None:
+            return 0
+        oy1, oy2, ox1, ox2 = overlap
+        oy1, oy2 = oy1 - self.bound[0], oy2 - self.bound[0]
+        ox1, ox2 = ox1 - self.bound[2], ox2 - self.bound[2]
+        integral = self.integral()
+        return int(integral[oy2, ox2] - integral[oy1, ox2] - integral[oy2, ox1] + integral[oy1, ox1])
+
+    def flip(self, imgShape):
+        # vertical flip inside a panorama of imgShape, like cv2.flip(img, 0)
+        y1, y2, x1, x2 = self.bound
+        return ToothMask([imgShape[0] - y2, imgShape[0] - y1, x1, x2], self.img[::-1].copy())
+
+    def crop(self, y1, y2, x1, x2):
+        """Returns the mask inside the window [y1:y2, x1:x2] of the panorama"""
+        window = np.zeros((max(y2 - y1, 0), max(x2 - x1, 0)), dtype=np.uint8)
+        overlap = self._overlap(y1, y2, x1, x2)
+        if overlap is not None:
+            oy1, oy2, ox1, ox2 = overlap
+            window[oy1 - y1:oy2 - y1, ox1 - x1:ox2 - x1] = self.img[oy1 - self.bound[0]:oy2 - self.bound[0], ox1 - self.bound[2]:ox2 - self.bound[2]]
+        return window
+
+    def toImage(self, imgShape):
+        return self.crop(0, imgShape[0], 0, imgShape[1])
+
+    def intersectArea(self, img, y0=0, x0=0):
+        """Counts the tooth pixels that are 255 in img, img placed at (y0, x0) of the panorama"""
+        overlap = self._overlap(y0, y0 + img.shape[0], x0, x0 + img.shape[1])
+        if overlap is None:
+            return 0
+        oy1, oy2, ox1, ox2 = overlap
+        mine = self.img[oy1 - self.bound[0]:oy2 - self.bound[0], ox1 - self.bound[2]:ox2 - self.bound[2]]
+        theirs = img[oy1 - y0:oy2 - y0, ox1 - x0:ox2 - x0]
+        return np.sum((mine == 255) & (theirs == 255))
+
+    def intersect(self, other):
+        """Counts the pixels shared with another ToothMask"""
+        return self.intersectArea(other.img, other.bound[0], other.bound[2])
+
+    def overlaps(self, y1, y2, x1, x2):
+        return self._overlap(y1, y2, x1, x2) is not None
+
+    def _overlap(self, y1, y2, x1, x2):
+        oy1, oy2 = max(y1, self.bound[0]), min(y2, self.bound[1])
+        ox1, ox2 = max(x1, self.bound[2]), min(x2, self.bound[3])
+        if oy1 >= oy2 or ox1 >= ox2:
+            return None
+        return (oy1, oy2, ox1, ox2)
+
+
+class AnnotIndex():
+    """Index of the annotation layers of one panorama
+
+    Every layer gets one bit of a combined label map, so the overlap of a box
+    with all layers is read from a single histogram of the box pixels
+    instead of one full-image pass per layer. The label map only covers the
+    union of the layer bounds.
+
+    Arguments:
+        annotImgs {dict} -- layer name to ToothMask
+    """
+
+    WORD_BITS = 64
+
+    def __init__(self, annotImgs):
+
+        self.annotImgs = annotImgs
+        self.names = list(annotImgs.keys())
+        self.areas = np.array([annotImgs[name].area() for name in self.names], dtype=np.int64)
+        self.bounds = [annotImgs[name].bound for name in self.names]
+        self.labelMaps = []
+
+        layerNum = len(self.names)
+        if layerNum == 0:
+            self.extent = (0, 0, 0, 0)
+        else:
+            self.extent = (min(b[0] for b in self.bounds), max(b[1] for b in self.bounds),
+                    min(b[2] for b in self.bounds), max(b[3] for b in self.bounds))
+        my1, my2, mx1, mx2 = self.extent
+
+        # one label map per 64 layers, with the smallest dtype that holds the bits
+        for wordStart in range(0, layerNum, self.WORD_BITS):
+            wordBits = min(self.WORD_BITS, layerNum - wordStart)
+            dtype = next(t for t in (np.uint8, np.uint16, np.uint32, np.uint64) if np.dtype(t).itemsize * 8 >= wordBits)
+            self.labelMaps.append(np.zeros((my2 - my1, mx2 - mx1), dtype=dtype))
+
+        for idx, name in enumerate(self.names):
+
+            y1, y2, x1, x2 = self.bounds[idx]
+            if y1 >= y2 or x1 >= x2:
+                continue
+            layerMask = annotImgs[name].img == 255
+
+            labelMap = self.labelMaps[idx // self.WORD_BITS]
+            bit = labelMap.dtype.type(1) << labelMap.dtype.type(idx % self.WORD_BITS)
+            labelMap[y1 - my1:y2 - my1, x1 - mx1:x2 - mx1] |= layerMask.astype(labelMap.dtype) * bit
+
+    def intersectionAreas(self, boxImg, window):
+        """Count the box pixels of every layer
+
+        Arguments:
+            boxImg {np.array} -- box image cropped to window (255 = box)
+            window {tuple} -- (x1, y1, x2, y2) of boxImg in the panorama
+
+        Returns:
+            np.array -- intersection area for each layer, in self.names order
+        """
+        x1, y1, x2, y2 = window
+        my1, my2, mx1, mx2 = self.extent
+        counts = np.zeros(len(self.names), dtype=np.int64)
+
+        # box pixels outside the label map have no label
+        oy1, oy2, ox1, ox2 = max(y1, my1), min(y2, my2), max(x1, mx1), min(x2, mx2)
+        if oy1 >= oy2 or ox1 >= ox2:
+            return counts
+        boxMask = boxImg[oy1 - y1:oy2 - y1, ox1 - x1:ox2 - x1] == 255
+
+        for wordIdx, labelMap in enumerate(self.labelMaps):
+
+            labels, freq = np.unique(labelMap[oy1 - my1:oy2 - my1, ox1 - mx1:ox2 - mx1][boxMask], return_counts=True)
+            wordStart = wordIdx * self.WORD_BITS
+            wordBits = min(self.WORD_BITS, len(self.names) - wordStart)
+            shifts = np.arange(wordBits, dtype=labelMap.dtype)
+            bits = (labels[:, None] >> shifts) & labelMap.dtype.type(1)
+            counts[wordStart:wordStart + wordBits] = freq @ bits.astype(np.int64)
+
+        return counts
+
+    def layerImg(self, idx, window):
+        x1, y1, x2, y2 = window
+        return self.annotImgs[self.names[idx]].crop(y1, y2, x1, x2)
+
+
+class ToothIndex():
+    """Spatial index of the tooth layer bounding boxes of one panorama
+
+    The boxes are kept sorted by their left edge, with the running maximum of
+    their right edges, so the teeth meeting a window or an x range are found
+    with two binary searches and one vectorized test on what is left.
+    Box creation adds and removes the hollow teeth while it runs, which
+    rebuilds the arrays (a panorama has at most 32 layers).
+
+    Arguments:
+        annotImgs {dict} -- layer name to ToothMask, updated by add() and remove()
+    """
+
+    def __init__(self, annotImgs):
+        self.annotImgs = annotImgs
+        self._build()
+
+    def _build(self):
+        self.names = list(self.annotImgs.keys())
+        bounds = np.array([self.annotImgs[name].bound for name in self.names], dtype=np.int64).reshape(-1, 4)
+
+        # intervals are normalized, a hollow tooth shifted out of the panorama can have x1 > x2
+        order = np.argsort(np.minimum(bounds[:, 2], bounds[:, 3]), kind='stable')
+        self._order = order
+        self._bounds = bounds[order]
+        self._left = np.minimum(self._bounds[:, 2], self._bounds[:, 3])
+        self._right = np.maximum(self._bounds[:, 2], self._bounds[:, 3])
+        self._maxRight = np.maximum.accumulate(self._right) if len(order) > 0 else self._right
+
+    def __contains__(self, name):
+        return name in self.annotImgs
+
+    def __getitem__(self, name):
+        return self.annotImgs[name]
+
+    def add(self, name, toothMask):
+        self.annotImgs[name] = toothMask
+        self._build()
+
+    def remove(self, name):
+        del self.annotImgs[name]
+        self._build()
+
+    def bounds(self, names):
+        """Returns the (n, 4) array of [y1, y2, x1, x2] of the names"""
+        return np.array([self.annotImgs[name].bound for name in names], dtype=np.int64).reshape(-1, 4)
+
+    def _candidates(self, x1, x2, closed):
+        # sorted positions whose interval may meet [x1, x2) or [x1, x2]
+        hi = np.searchsorted(self._left, x2, side='right' if closed else 'left')
+        lo = np.searchsorted(self._maxRight, x1, side='left' if closed else 'right')
+        return np.arange(lo, max(lo, hi))
+
+    def spanning(self, x1, x2):
+        """Names whose x range meets the closed range [x1, x2], ends included"""
+        idx = self._candidates(x1, x2, True)
+        idx = idx[(self._right[idx] >= x1) & (self._left[idx] <= x2)]
+        return set(self.names[i] for i in self._order[idx])
+
+    def window(self, y1, y2, x1, x2):
+        """Names whose mask box overlaps the window [y1:y2, x1:x2], like ToothMask.overlaps"""
+        idx = self._candidates(x1, x2, False)
+        b = self._bounds[idx]
+        hit = ((np.maximum(b[:, 0], y1) < np.minimum(b[:, 1], y2))
+                & (np.maximum(b[:, 2], x1) < np.minimum(b[:, 3], x2)))
+        return [self.names[i] for i in np.sort(self._order[idx[hit]])]
+
+    def overlapping(self, name):
+        """Other names whose mask box overlaps the box of name"""
+        return [other for other in self.window(*self.annotImgs[name].bound) if other != name]
@@ -64,12 +64,38 @@ class TripleAugment(Augment):
 
         self.transform = [TargetOnly(Threshold())] + self.transform
     
-    def __call__(self, input_pano, input_box, target_major, target_minor):
-        for t in self.transform:
+    def __call__(self, input_pano, input_box, target_major, target_minor, start=0, stop=None):
+        # start / stop run a part of the transforms, see prefixLength
+        for t in self.transform[start:stop]:
             input_pano, input_box, target_major, target_minor = t(input_pano, input_box, target_major, target_minor)
 
         return input_pano, input_box, target_major, target_minor
 
+    def prefixLength(self):
+        """Number of leading transforms that are deterministic and give uint8 PIL images
+
+        Their result is the same every epoch, tensorshard.py stores it once.
+        """
+        for idx, t in enumerate(self.transform):
+            if not isinstance(t.transform, DETERMINISTIC):
+                return idx
+        return len(self.transform)
+
+    def prefixSize(self):
+        # (height, width) of every image after the prefix, None if it depends on the image
+        size = None
+        for t in self.transform[:self.prefixLength()]:
+            if isinstance(t.transform, T.Resize):
+                size = t.transform.size
+                size = tuple(size) if isinstance(size, (list, tuple)) and len(size) == 2 else None
+        return size
+
+    def prefixConfig(self):
+        # json serializable description of the prefix, shards are keyed by its hash
+        return [[type(t).__name__, type(t.transform).__name__,
+                {k: str(v) for k, v in sorted(vars(t.transform).items()) if not k.startswith('_') and k != 'training'}]
+                for t in self.transform[:self.prefixLength()]]
+
 
 class ToAll(Augment):
     
@@ -232,4 +258,8 @@ class RandomAug:
         return img
 
 class RandomAffine:
-    pass
\ No newline at end of file
+    pass
+
+
+# PIL to PIL transforms that draw no random number
+DETERMINISTIC = (T.Resize, Threshold)
@@ -0,0 +1,258 @@
+'''
+
+python3 benchmark.py [--panos N] [--height H] [--width W] [--margin M] [--jobs N] [--seed S] [--out result.json]
+
+benchmark of the dataset generation pipeline on synthetic panoramas
+
+It builds a throwaway data/ tree with random panoramas, one elliptic mask per tooth and the
+matching PanoSeg XML, then runs generateDatasetForEachFile, calcStat and createBoxXml on it and
+prints the time of every stage, patches/sec, the box creation telemetry and the peak RSS as JSON.
+
+The tooth masks are given both as an annotation directory (genData) and as a PSD whose layers are
+put in the PSD cache beforehand (createBoxXml), since PSDs cannot be written here. The PSD decode
+itself is therefore not measured, only reading the cache.
+
+'''
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import contextlib
+import xml.etree.ElementTree as ET
+import numpy as np
+import cv2
+import pandas as pd
+
+import manage
+import boxcreation
+import psdcache
+from stagetimer import StageTimer
+from boxtelemetry import BoxTelemetry
+
+UPPER_TEETH = ['18','17','16','15','14','13','12','11','21','22','23','24','25','26','27','28']
+LOWER_TEETH = ['48','47','46','45','44','43','42','41','31','32','33','34','35','36','37','38']
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='benchmark of genData, genStat and boxcreation')
+    parser.add_argument('--panos', type=int, default=4, help='number of synthetic panoramas')
+    parser.add_argument('--height', type=int, default=1000, help='panorama height')
+    parser.add_argument('--width', type=int, default=2000, help='panorama width')
+    parser.add_argument('--missing', type=int, default=2, help='missing teeth per panorama')
+    parser.add_argument('--margin', type=int, default=10, help='marginType for genData')
+    parser.add_argument('--jobs', type=int, default=1, help='workers for genStat')
+    parser.add_argument('--boxes', type=int, default=1, help='double/single/none boxes per tooth for boxcreation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic data tree')
+    parser.add_argument('--out', default=None, help='also write the result to this .json file')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='deeppano-bench-')
+    cwd = os.getcwd()
+
+    try:
+        # the pipeline uses paths relative to src/, like ../data/rawdata/
+        workDir = os.path.join(root, 'src')
+        os.makedirs(workDir)
+        os.chdir(workDir)
+
+        start = time.perf_counter()
+        inputFileName = synthesize(args.panos, (args.height, args.width), args.missing, args.seed)
+        result = {
+            'commit': getCommit(cwd),
+            'config': vars(args),
+            'synthesizeSeconds': time.perf_counter() - start,
+        }
+
+        result['genData'] = benchGenData(inputFileName, args.margin)
+        result['genStat'] = benchGenStat(result['genData'].pop('csv'), args.jobs)
+        result['boxcreation'] = benchBoxCreation(args.panos, args.boxes, args.seed)
+        result['peakRssMB'] = peakRssMB()
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print(json.dumps(result, indent=2))
+    if args.out is not None:
+        with open(args.out, 'w') as outFile:
+            json.dump(result, outFile, indent=2)
+
+    return
+
+
+#################
+#   Synthesis   #
+#################
+
+
+def synthesize(panoNum, imgShape, missingNum, seed):
+    """Write panoramas, tooth masks, PanoSeg XML and the FirstFile .csv under ../data/
+
+    Returns:
+        string -- path of the FirstFile .csv
+    """
+
+    rng = np.random.RandomState(seed)
+    h, w = imgShape
+    dirs = {name: '../data/rawdata/' + name + '/' for name in ('panoImg', 'psdFile', 'xmlFile', 'annotDir')}
+    for d in list(dirs.values()) + ['../data/metadata/']:
+        os.makedirs(d, exist_ok=True)
+
+    rows = []
+
+    for panoIdx in range(panoNum):
+
+        imageTitle = 'Bench-Pano-{:03d}'.format(panoIdx)
+        panoImg = cv2.GaussianBlur((rng.rand(h, w) * 255).astype(np.uint8), (9, 9), 0)
+
+        annotDir = dirs['annotDir'] + imageTitle + '/'
+        os.makedirs(annotDir, exist_ok=True)
+
+        missing = set(rng.choice(UPPER_TEETH + LOWER_TEETH, missingNum, replace=False)) if missingNum > 0 else set()
+        xmlRoot = ET.Element('root')
+        xmlToothList = ET.SubElement(xmlRoot, 'ToothList')
+        layers = []
+
+        toothW = w // 18
+        toothH = h // 4
+        for rowIdx, teeth in enumerate((UPPER_TEETH, LOWER_TEETH)):
+            for i, toothNum in enumerate(teeth):
+                cx = toothW + i * toothW + toothW // 2 + rng.randint(-toothW // 8, toothW // 8 + 1)
+                cy = (h // 3 if rowIdx == 0 else 2 * h // 3) + rng.randint(-toothH // 10, toothH // 10 + 1)
+
+                # PanoSeg box around the tooth, in flipped coordinates like the real XML
+                xmlTooth = ET.SubElement(xmlToothList, 'Tooth', Number=toothNum)
+                bw, bh = int(toothW * 0.6), int(toothH * 0.6)
+                for j, (x, y) in enumerate(((cx - bw, cy - bh), (cx + bw, cy - bh), (cx + bw, cy + bh), (cx - bw, cy + bh))):
+                    ET.SubElement(xmlTooth, 'P' + str(j), X=str(x), Y=str(h - 1 - y))
+
+                if toothNum in missing:
+                    continue
+
+                mask = np.zeros(imgShape, dtype=np.uint8)
+                cv2.ellipse(mask, (cx, cy), (int(toothW * 0.45), int(toothH * 0.45)), rng.randint(-15, 16), 0, 360, 255, -1)
+                cv2.imwrite(annotDir + 'Target-' + toothNum + '.jpg', mask)
+                panoImg = cv2.add(panoImg, (mask // 4).astype(np.uint8))
+
+                ys, xs = np.nonzero(mask)
+                y1, y2, x1, x2 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+                layers.append((toothNum, [int(y1), int(y2), int(x1), int(x2)], mask[y1:y2, x1:x2] > 200))
+
+        panoFileName = dirs['panoImg'] + imageTitle + '.jpg'
+        xmlFileName = dirs['xmlFile'] + imageTitle + '.xml'
+        psdFileName = dirs['psdFile'] + imageTitle + '.psd'
+        cv2.imwrite(panoFileName, panoImg)
+        ET.ElementTree(xmlRoot).write(xmlFileName)
+        shutil.copy(xmlFileName, xmlFileName[:-4] + '.orig.xml')
+
+        # a placeholder psd, its layers go to the cache under the hash of its content
+        with open(psdFileName, 'wb') as psdFile:
+            psdFile.write(('benchmark ' + imageTitle).encode('utf-8'))
+        psdcache._writeCache(os.path.join(psdcache.CACHE_DIR, psdcache.fileHash(psdFileName) + '.npz'), layers)
+
+        rows.append([imageTitle, panoFileName, xmlFileName, annotDir, 'train'])
+
+    inputFileName = '../data/metadata/BenchSet.csv'
+    pd.DataFrame(rows, columns=['Image.Title', 'Pano.File', 'Xml.File', 'Annot.File', 'Train.Val']).to_csv(inputFileName)
+
+    return inputFileName
+
+
+##################
+#   Benchmarks   #
+##################
+
+
+def benchGenData(inputFileName, marginType):
+
+    inputDf = pd.read_csv(inputFileName)
+    outImgPath = '../data/metadata/BenchSet-{}/'.format(marginType)
+    os.makedirs(outImgPath, exist_ok=True)
+
+    timer = StageTimer()
+    rows = []
+
+    start = time.perf_counter()
+    for idx, row in inputDf.iterrows():
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows += manage.generateDatasetForEachFile(marginType, outImgPath, row.to_dict(), timer=timer)
+    seconds = time.perf_counter() - start
+
+    csvFileName = outImgPath[:-1] + '.csv'
+    pd.DataFrame(rows, columns=manage.OUT_COLS).to_csv(csvFileName, encoding='utf-8')
+
+    return summarize(timer, seconds, len(inputDf), 'patches', csv=csvFileName, rows=len(rows))
+
+
+def benchGenStat(csvFileName, jobs):
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        manage.calcStat(csvFileName, jobs, force=True)
+    seconds = time.perf_counter() - start
+
+    # calcStat reads the pano and box patch of every row
+    patches = 2 * len(pd.read_csv(csvFileName))
+
+    return {'seconds': seconds, 'jobs': jobs, 'patches': patches, 'patchesPerSec': patches / seconds}
+
+
+def benchBoxCreation(panoNum, boxNum, seed):
+
+    timer = StageTimer()
+    telemetry = BoxTelemetry()
+
+    start = time.perf_counter()
+    for panoIdx in range(panoNum):
+        imageTitle = 'Bench-Pano-{:03d}'.format(panoIdx)
+        xmlFileName = '../data/rawdata/xmlFile/' + imageTitle + '.xml'
+        # createBoxXml appends to the xml, every run starts from the PanoSeg one
+        shutil.copy(xmlFileName[:-4] + '.orig.xml', xmlFileName)
+        with contextlib.redirect_stdout(io.StringIO()):
+            boxcreation.createBoxXml(imageTitle, boxNum, boxNum, boxNum, timer=timer,
+                    rng=random.Random(boxcreation.fileSeed(seed, imageTitle)), telemetry=telemetry)
+    seconds = time.perf_counter() - start
+
+    return summarize(timer, seconds, panoNum, 'boxes', telemetry=telemetry.summary(slowest=3))
+
+
+def summarize(timer, seconds, panoNum, unit, **extra):
+    stages = timer.toDict()
+    result = {
+        'seconds': seconds,
+        'stages': stages['seconds'],
+        'counts': stages['counts'],
+        'panos': panoNum,
+        'secondsPerPano': seconds / panoNum if panoNum > 0 else 0.0,
+        unit + 'PerSec': timer.counts.get(unit, 0) / seconds if seconds > 0 else 0.0,
+    }
+    result.update(extra)
+    return result
+
+
+def peakRssMB():
+    # ru_maxrss is in KB on linux and in bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def getCommit(repoDir):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repoDir,
+                stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
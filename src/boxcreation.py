@@ -4,20 +4,35 @@ import pandas as pd
 import xml.etree.ElementTree as ET
 import numpy as np
 import cv2
-from psd_tools import PSDImage
 import time
 import datetime
 import copy
 import re
 import math
 import random
+import itertools
+import hashlib
+import multiprocessing
+import traceback
+from psdcache import loadPsdLayers
+from cliutil import popOption
+from annotation import ToothMask, ToothIndex
+from stagetimer import NULL_TIMER
+from boxtelemetry import BoxTelemetry, NULL_TELEMETRY
     
 def __main__():
     
         
-    if len(sys.argv) < 3:
-        print('need to input numbers for double, singe none')
+    args = list(sys.argv)
+    jobs = int(popOption(args, '--jobs', 1))
+    seed = int(popOption(args, '--seed', 0))
+    reportName = popOption(args, '--report', None)
+
+    if len(args) < 4:
+        print('need to input numbers for double, singe none\n',
+                '(doubleNum) (singleNum) (noneNum) [--jobs N] [--seed S] [--report (file name)]')
         return
+    doubleNum, singleNum, noneNum = int(args[1]), int(args[2]), int(args[3])
     
     #command = str(sys.argv[1])
     '''
@@ -38,13 +53,56 @@ def __main__():
 
     psdDir = '../data/rawdata/psdFile/'
 
-    for subdir, dirs, files in os.walk(psdDir):
-        for fileName in files:
-            print(fileName) # e.g. T1-Pano-002.psd
-            name = fileName[:-4] # 확장자 뺀 이름 e.g. T1-Pano-002
-            createBoxXml(fileName, sys.argv[1], sys.argv[2], sys.argv[3])
+    # e.g. T1-Pano-002.psd -> T1-Pano-002 (확장자 뺀 이름)
+    names = sorted(fileName[:-4] for fileName in os.listdir(psdDir) if fileName.endswith('.psd'))
+    tasks = [(name, doubleNum, singleNum, noneNum, seed, reportName is not None) for name in names]
+
+    # every file draws from its own generator, so the boxes do not depend on jobs or order
+    if jobs > 1:
+        print('creating boxes with {} workers'.format(jobs))
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.imap_unordered(_createBoxXmlWorker, tasks)
+    else:
+        pool = None
+        results = map(_createBoxXmlWorker, tasks)
+
+    failedNames = []
+    telemetry = BoxTelemetry()
+    for name, error, records in results:
+        telemetry.extend(records)
+        if error is not None:
+            print('failed to create boxes for {}\n{}'.format(name, error))
+            failedNames.append(name)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if len(failedNames) > 0:
+        print('{} files failed: {}'.format(len(failedNames), failedNames))
+
+    if reportName is not None:
+        telemetry.writeReport(reportName)
+        print('box creation report written to {}.csv and {}.json'.format(reportName, reportName))
 
     return
+
+
+def fileSeed(seed, name):
+    # stable across runs and processes, unlike hash()
+    return int(hashlib.sha256('{}:{}'.format(seed, name).encode('utf-8')).hexdigest()[:16], 16)
+
+
+def _createBoxXmlWorker(task):
+    # catches every error so that one broken file does not abort the whole run
+    name, doubleNum, singleNum, noneNum, seed, report = task
+    print(name)
+    telemetry = BoxTelemetry(enabled=report)
+    try:
+        createBoxXml(name, doubleNum, singleNum, noneNum, rng=random.Random(fileSeed(seed, name)), telemetry=telemetry)
+        return (name, None, telemetry.records)
+    except Exception:
+        return (name, traceback.format_exc(), telemetry.records)
    
  
     ####################
@@ -52,50 +110,42 @@ def __main__():
     ####################
     
     
-def extractFromPsd(annotPsd, imgShape):
+def extractFromPsd(psdFileName, imgShape):
     
     annotImgs = {}
     imgsBoundary = {}
     
-    for layer in annotPsd.layers:
-    
-        if layer is None or layer.bbox == (0, 0, 0, 0):
-            continue
-    
-        layerImg = np.array(layer.as_PIL())
-    
-        # get alpha channel from png and convert to grayscale
-        if (layerImg.shape[-1] != 4):
-            # Then this is background image
-            continue
-    
-        r, g, b, a = cv2.split(layerImg)
-        layerImg = cv2.merge([a, a, a])
-        layerImg = cv2.cvtColor(layerImg, cv2.COLOR_BGR2GRAY)
-        ret, layerImg = cv2.threshold(layerImg, 200, 255, cv2.THRESH_BINARY)
+    # decoded layers come from the psd cache after the first run
+    for name, bound, layerMask in loadPsdLayers(psdFileName):
     
-        annotImg = np.zeros(imgShape, dtype=np.uint8)
-        b1, b2 = layer.bbox.y1, layer.bbox.y2
-        b3, b4 = layer.bbox.x1, layer.bbox.x2
-        annotImg[b1:b2, b3:b4] = layerImg
-        #annotImg = cv2.flip(annotImg, 0) # flip
+        b1, b2, b3, b4 = bound
+        annotImg = ToothMask(bound, layerMask.astype(np.uint8) * 255)
+        #annotImg = annotImg.flip(imgShape) # flip
+        annotImg.integral() # rectangle overlaps of box creation are read from it
     
-        annotImgs[layer.name.strip()] = annotImg
-        imgsBoundary[layer.name.strip()] = [b1, b2, b3, b4]
+        annotImgs[name] = annotImg
+        imgsBoundary[name] = [b1, b2, b3, b4]
     
     return (annotImgs, imgsBoundary)
     
     
-def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
+# a tooth gets fewer boxes than asked for after this many failed box creations
+MAX_BOX_FAILURES = 5
+
+
+def createBoxXml(imageTitle, doubleNum, singleNum, noneNum, timer=NULL_TIMER, rng=random, telemetry=NULL_TELEMETRY):
     
     panoDir = '../data/rawdata/panoImg/'
     psdDir = '../data/rawdata/psdFile/'
     xmlDir = '../data/rawdata/xmlFile/'   
     xmlName = xmlDir + imageTitle + '.xml'
-    panoImg = cv2.imread(panoDir + imageTitle + '.jpg', cv2.IMREAD_GRAYSCALE)
+    with timer.stage('pano'):
+        panoImg = cv2.imread(panoDir + imageTitle + '.jpg', cv2.IMREAD_GRAYSCALE)
     imgShape = panoImg.shape
-    annotPsd = PSDImage.load(psdDir + imageTitle + '.psd')
-    annotImgs, imgsBoundary = extractFromPsd(annotPsd, imgShape) 
+    with timer.stage('annot'):
+        annotImgs, imgsBoundary = extractFromPsd(psdDir + imageTitle + '.psd', imgShape)
+    # neighbor and window queries of every box type go through one index
+    toothIndex = ToothIndex(annotImgs)
     
     doubleBoxList = {}
     singleBoxList = {}
@@ -103,6 +153,7 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
     hollowBoxList = {}
     teethNum = 10
     
+    timer.start('box')
     while teethNum < 49:
             
         teethNum += 1
@@ -112,7 +163,7 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
         name = str(teethNum)
        
         teethType = 'real'
-        neighborTeethKeys = findNeighborTeeth(imgsBoundary, name, imgShape)
+        neighborTeethKeys = findNeighborTeeth(toothIndex, name, imgShape)
     
         if name not in annotImgs:
             if neighborTeethKeys[0] == 0:
@@ -145,9 +196,8 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
             if newBoundary[3] >= imgShape[1]:
                 newBoundary[3] = imgShape[1]-1
             # add hollow teeth as if it's real
-            newAnnotImg = np.zeros(imgShape, dtype=np.uint8)
-            newAnnotImg[newBoundary[0]:newBoundary[1],newBoundary[2]:newBoundary[3]] = 255
-            annotImgs[name] = newAnnotImg 
+            newAnnotImg = np.full((max(newBoundary[1]-newBoundary[0], 0), max(newBoundary[3]-newBoundary[2], 0)), 255, dtype=np.uint8)
+            toothIndex.add(name, ToothMask(newBoundary, newAnnotImg))
             imgsBoundary[name] = newBoundary
     
         if teethType == 'hollow':
@@ -157,15 +207,20 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
             newBoundary.append(int((imgsBoundary[neighborTeethKeys[0]][2]+imgsBoundary[neighborTeethKeys[0]][3])/2))
             newBoundary.append(int((imgsBoundary[neighborTeethKeys[1]][2]+imgsBoundary[neighborTeethKeys[1]][3])/2))
 
-            hollowBoxImg = np.zeros(imgShape, dtype=np.uint8)
-            hollowBoxImg[newBoundary[0]:newBoundary[1],newBoundary[2]:newBoundary[3]] = 255
+            # work in the hollow box padded by one pixel, so contours touching it are not clipped
+            wy1, wy2 = newBoundary[0] - 1, max(newBoundary[1], newBoundary[0]) + 1
+            wx1, wx2 = newBoundary[2] - 1, max(newBoundary[3], newBoundary[2]) + 1
+            hollowBoxImg = np.zeros((wy2 - wy1, wx2 - wx1), dtype=np.uint8)
+            hollowBoxImg[1:-1, 1:-1] = 255
 
-            neighborMask = cv2.bitwise_or(annotImgs[neighborTeethKeys[0]], annotImgs[neighborTeethKeys[1]])
+            neighborMask = cv2.bitwise_or(annotImgs[neighborTeethKeys[0]].crop(wy1, wy2, wx1, wx2),
+                    annotImgs[neighborTeethKeys[1]].crop(wy1, wy2, wx1, wx2))
             neighborMask = cv2.bitwise_not(neighborMask)
             hollowBoxImg = cv2.bitwise_and(hollowBoxImg, neighborMask)                       
  
-            newAnnotImg = np.zeros(imgShape, dtype=np.uint8)
-            img, contours, hierachy = cv2.findContours(hollowBoxImg, cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
+            newAnnotImg = np.zeros(hollowBoxImg.shape, dtype=np.uint8)
+            # OpenCV 3 returns (img, contours, hierarchy), OpenCV 4 (contours, hierarchy)
+            contours = cv2.findContours(hollowBoxImg, cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)[-2]
             #newAnnotImg = cv2.drawContours(newAnnotImg, contours, 0, 255, -1)
             contoursNum = len(contours)  # except the whole img
             maxArea = 0
@@ -180,20 +235,20 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
             cv2.drawContours(newAnnotImg, [maxContour], 0, 255, cv2.FILLED)
 
             newAnnotArea = np.sum(newAnnotImg == 255)
-            leftAnnotArea = np.sum(annotImgs[neighborTeethKeys[0]] == 255)
-            rightAnnotArea = np.sum(annotImgs[neighborTeethKeys[1]] == 255)
+            leftAnnotArea = annotImgs[neighborTeethKeys[0]].area()
+            rightAnnotArea = annotImgs[neighborTeethKeys[1]].area()
 
             if newAnnotArea < leftAnnotArea * 0.1 and newAnnotArea < rightAnnotArea * 0.1:
                 teethType = 'absense'                
             else:     
                 x,y,w,h = cv2.boundingRect(maxContour)
 
-                newBoundary[0] = y
-                newBoundary[1] = y + h
-                newBoundary[2] = x
-                newBoundary[3] = x + w
+                newBoundary[0] = wy1 + y
+                newBoundary[1] = wy1 + y + h
+                newBoundary[2] = wx1 + x
+                newBoundary[3] = wx1 + x + w
                  
-                annotImgs[name] = newAnnotImg
+                toothIndex.add(name, ToothMask(newBoundary, newAnnotImg[y:y+h, x:x+w]))
                 imgsBoundary[name] = newBoundary
     
         print("start for main = ", name, ", type = ", teethType)            
@@ -206,14 +261,19 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
 
         ### Double Logic ###
         i = 0 
+        failed = 0
         while i < doubleNum: # how many doubel boxes?
             if teethType == 'real':
-                createdBox = createDoubleBox(annotImgs, imgsBoundary, name, imgShape, 'double')
+                with telemetry.box(imageTitle, name, 'double', teethType):
+                    createdBox = createDoubleBox(toothIndex, imgsBoundary, name, imgShape, 'double', rng, telemetry=telemetry)
             else:    
                 #createdBox = createDoubleBox(annotImgs, imgsBoundary, name, imgShape, 'triple')
                 break
                 
             if createdBox == 0:
+                failed += 1
+                if failed >= MAX_BOX_FAILURES:
+                    break
                 continue
                     
             doubleBoxList[name + '-' + str(i)] = createdBox
@@ -223,14 +283,19 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
         
         ### Single Logic ###
         i = 0
+        failed = 0
         while i < singleNum: # how many single boxes?
             if teethType == 'real':
-                createdBox = createSingleOrNoneBox(annotImgs,imgsBoundary,name,neighborTeethKeys,imgShape,'single')
+                with telemetry.box(imageTitle, name, 'single', teethType):
+                    createdBox = createSingleOrNoneBox(toothIndex,imgsBoundary,name,neighborTeethKeys,imgShape,'single',rng,telemetry=telemetry)
             else:
                 #createdBox = createDoubleBox(annotImgs, imgsBoundary, name, imgShape, 'double')
                 break
 
             if createdBox == 0:
+                failed += 1
+                if failed >= MAX_BOX_FAILURES:
+                    break
                 continue
 
             singleBoxList[name + '-' + str(i)] = createdBox
@@ -240,14 +305,19 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
             
         ###  None Logic ###
         i = 0
+        failed = 0
         while i < noneNum: # how many none boxes?
             if teethType == 'real':
-                createdBox = createSingleOrNoneBox(annotImgs,imgsBoundary,name,neighborTeethKeys,imgShape,'none')
+                with telemetry.box(imageTitle, name, 'none', teethType):
+                    createdBox = createSingleOrNoneBox(toothIndex,imgsBoundary,name,neighborTeethKeys,imgShape,'none',rng,telemetry=telemetry)
             else:
                 #createdBox = createSingleOrNoneBox(annotImgs,imgsBoundary,name,neighborTeethKeys,imgShape,'single')
                 break
                 
             if createdBox ==0:
+                failed += 1
+                if failed >= MAX_BOX_FAILURES:
+                    break
                 continue
 
             noneBoxList[name + '-' + str(i)] = createdBox
@@ -258,14 +328,22 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
         
         # hollow logic
         i = 0
+        failed = 0
         while i < doubleNum/2: # how many hollow boxes?
             if teethType == 'hollow' or teethType == 'hollow_end':
-                createdBox1 = createDoubleBox(annotImgs,imgsBoundary,name,imgShape,'double')
-                createdBox2 = createSingleOrNoneBox(annotImgs,imgsBoundary,name,neighborTeethKeys,imgShape,'single')
+                # one record for both boxes, the hollow box is created only if both are
+                with telemetry.box(imageTitle, name, 'hollow', teethType):
+                    createdBox1 = createDoubleBox(toothIndex,imgsBoundary,name,imgShape,'double',rng,telemetry=telemetry)
+                    createdBox2 = createSingleOrNoneBox(toothIndex,imgsBoundary,name,neighborTeethKeys,imgShape,'single',rng,telemetry=telemetry)
+                    if createdBox1 == 0 or createdBox2 == 0:
+                        telemetry.failed()
             else:
                 break
 
-            if createdBox ==0:
+            if createdBox1 == 0 or createdBox2 == 0:
+                failed += 1
+                if failed >= MAX_BOX_FAILURES:
+                    break
                 continue
 
             hollowBoxList[name + '-' + str(2*i)] = createdBox1
@@ -275,12 +353,15 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
         print('hollow done!')
 
         if teethType == 'hollow' or teethType == 'hollow_end':
-            del annotImgs[name]
+            toothIndex.remove(name)
             del imgsBoundary[name]
 
+    timer.stop('box')
+    timer.count('boxes', len(doubleBoxList) + len(singleBoxList) + len(noneBoxList) + len(hollowBoxList))
         
 
     # build XML 
+    timer.start('xml')
     #xmlRoot = ET.Element("root")
     xmlRoot = ET.parse(xmlName).getroot()
     #xmlToothList = ET.SubElement(xmlRoot, "ToothList")
@@ -348,12 +429,14 @@ def createBoxXml(imageTitle, doubleNum, singleNum, noneNum):
             ET.SubElement(xmlTooth, 'P' + str(i), Y = str(y), X = str(x))
 
     xmlTree = ET.ElementTree(xmlRoot)
+    # written before returning, the caller may read the xml right away
     xmlTree.write(xmlDir + imageTitle + '.xml')
+    timer.stop('xml')
 
     return
 
     
-def findNeighborTeeth(imgsBoundary, mainTeethKey, imgShape):
+def findNeighborTeeth(toothIndex, mainTeethKey, imgShape):
     
     neighborTeethKeys = []
     teethKeys = [['18','17','16','15','14','13','12','11','21','22','23','24','25','26','27','28'],
@@ -382,9 +465,9 @@ def findNeighborTeeth(imgsBoundary, mainTeethKey, imgShape):
             neighborTeethKeys.append(0)
             break
         tempKey = teethKeys[isBot][tempIdx]
-        if tempKey in imgsBoundary:
+        if tempKey in toothIndex:
             neighborTeethKeys.append(tempKey)
-            leftEnd = imgsBoundary[tempKey][2]
+            leftEnd = toothIndex[tempKey].bound[2]
             break
     
         tempIdx -= 1
@@ -397,30 +480,17 @@ def findNeighborTeeth(imgsBoundary, mainTeethKey, imgShape):
             neighborTeethKeys.append(0)
             break
         tempKey = teethKeys[isBot][tempIdx]
-        if tempKey in imgsBoundary:
+        if tempKey in toothIndex:
             neighborTeethKeys.append(tempKey)
-            rightEnd = imgsBoundary[tempKey][3]
+            rightEnd = toothIndex[tempKey].bound[3]
             break
     
         tempIdx += 1
     
     print(leftEnd, rightEnd, tempKey)
-    # find up / down
-    tempIdx = 0
-    for tempIdx in range(16):
-       
-        tempKey = teethKeys[1-isBot][tempIdx]
-        if tempKey not in imgsBoundary:
-            continue
-
-        tempLeft = imgsBoundary[tempKey][2]
-        tempRight = imgsBoundary[tempKey][3]
-        if tempLeft < leftEnd and tempRight < leftEnd:
-            continue
-        if tempLeft > rightEnd and tempRight > rightEnd:
-            continue
-
-        neighborTeethKeys.append(tempKey)
+    # find up / down, the other jaw's teeth between both ends
+    spanning = toothIndex.spanning(leftEnd, rightEnd)
+    neighborTeethKeys += [tempKey for tempKey in teethKeys[1-isBot] if tempKey in spanning]
 
     return neighborTeethKeys
 
@@ -464,7 +534,81 @@ def findCommonPoint(line1, line2, imgShape):
     return (1, (int(x),int(y)))
 '''
 
-def getLineCutImg(annotImg, criticalLine, angle, imgShape):
+def getLineCutArea(toothMask, criticalLine, angle, imgShape):
+
+    # only the tooth's bounding box is tested against the line
+    y1, y2, x1, x2 = toothMask.bound
+    if y1 >= y2 or x1 >= x2:
+        return 0
+    lineCutMask = getLineCutMask(criticalLine, angle, imgShape, (y1, y2, x1, x2))
+
+    return toothMask.intersectArea(lineCutMask.astype(np.uint8) * 255, y1, x1)
+
+
+def getLineCutMask(criticalLine, angle, imgShape, window):
+    """The region of getLineCutRegion inside window, without rasterizing the whole panorama
+
+    Pixels on the side of the line that getLineCutRegion fills, and the pixels of the line itself
+    (within half a pixel along the minor axis), are True. It differs from the flood filled region
+    only by rounding on the line and on the panorama border.
+
+    Arguments:
+        criticalLine {list} -- [x1, y1, x2, y2] running from border to border
+        angle {int} -- angle the line was found with, picks the filled side
+        window {tuple} -- (y1, y2, x1, x2) of the returned mask in the panorama
+    """
+
+    wy1, wy2, wx1, wx2 = window
+    ys = np.arange(wy1, wy2, dtype=np.int64).reshape(-1, 1)
+    xs = np.arange(wx1, wx2, dtype=np.int64).reshape(1, -1)
+
+    return lineCutTest(np.array([criticalLine], dtype=np.int64), angle, imgShape, ys, xs)[0]
+
+
+def lineCutTest(lines, angle, imgShape, ys, xs):
+    """Whether the points (ys, xs) are in the line cut region of each line, see getLineCutMask
+
+    Arguments:
+        lines {np.array} -- (n, 4) lines of [x1, y1, x2, y2]
+        ys, xs {np.array} -- point coordinates, broadcast against each other
+
+    Returns:
+        np.array -- bool array of shape (n,) + broadcast shape of ys and xs
+    """
+
+    pointShape = np.broadcast(ys, xs).shape
+    expand = (slice(None),) + (None,) * len(pointShape)
+    qx1, qy1 = lines[:, 0], lines[:, 1]
+    dx, dy = lines[:, 2] - qx1, lines[:, 3] - qy1
+    major = np.maximum(np.abs(dx), np.abs(dy))
+    side = lineCutSide(lines, angle, imgShape)
+
+    cross = (dx[expand] * (ys - qy1[expand]) - dy[expand] * (xs - qx1[expand])) * side[expand]
+
+    # a line of one point cuts nothing
+    return (2 * cross >= -major[expand]) | (major[expand] == 0)
+
+
+def lineCutSide(lines, angle, imgShape):
+    # 1 or -1 per line, the sign of the cross product on the side getLineCutRegion fills
+
+    # same fill points as getLineCutRegion
+    if angle < 90:
+        fillPoint = (1, 1)
+    elif angle < 180:
+        fillPoint = (imgShape[1]-2, 1)
+    elif angle < 270:
+        fillPoint = (imgShape[1]-2, imgShape[0]-2)
+    else:
+        fillPoint = (1, imgShape[0]-2)
+
+    qx1, qy1 = lines[:, 0], lines[:, 1]
+    dx, dy = lines[:, 2] - qx1, lines[:, 3] - qy1
+
+    return np.where(dx * (fillPoint[1] - qy1) - dy * (fillPoint[0] - qx1) >= 0, 1, -1)
+
+
+def getLineCutRegion(criticalLine, angle, imgShape):
 
     lineCutImg = np.zeros(imgShape, dtype=np.uint8)
     mask = np.zeros((imgShape[0]+2,imgShape[1]+2), dtype=np.uint8)
@@ -492,31 +636,105 @@ def getLineCutImg(annotImg, criticalLine, angle, imgShape):
     pts = pts.reshape((-1,1,2))
     cv2.polylines(lineCutImg, [pts], True, 255)
     cv2.floodFill(lineCutImg, mask, fillPoint, 255)
-    intersectionImg = cv2.bitwise_and(annotImg, lineCutImg)
 
-    return intersectionImg
+    return lineCutImg
+
+
+# the sweep of findCriticalLine is scored this many lines at a time
+CRITICAL_LINE_BATCH = 64
 
 
 def findCriticalLine(annotImg, topLeft, topRight, imgShape, inputAngle):
 
-    criticalLine = []
+    # the first line cutting 8% of the tooth (the line before it for inputAngle < 180),
+    # or the first line after it cutting 92%, scored CRITICAL_LINE_BATCH lines at a time
+    teethArea = annotImg.area()
+    angle = inputAngle % 180
+    candidates = criticalLineCandidates(topLeft, topRight, imgShape, inputAngle)
+    prevLine = [0, 0, 0, 0]
+    found = 0
+
+    if teethArea == 0:
+        return []
+
+    while True:
+        lines = list(itertools.islice(candidates, CRITICAL_LINE_BATCH))
+        if len(lines) == 0:
+            return []
+        lineCutIOU = lineCutAreas(annotImg, np.array(lines, dtype=np.int64), angle, imgShape) / teethArea
+
+        start = 0
+        if found == 0:
+            passed = np.nonzero(lineCutIOU >= 0.08)[0]
+            if len(passed) == 0:
+                prevLine = lines[-1]
+                continue
+            found = 1
+            if inputAngle < 180:
+                return prevLine if passed[0] == 0 else lines[passed[0] - 1]
+            start = passed[0] + 1
+
+        passed = np.nonzero(lineCutIOU[start:] >= 0.92)[0]
+        if len(passed) > 0:
+            return lines[start + passed[0]]
+
+
+def lineCutAreas(toothMask, lines, angle, imgShape):
+    """getLineCutArea of one tooth for many lines
+
+    Lines that leave the tooth's bounding box on one side are decided from its corners,
+    only the lines crossing it are tested against the tooth pixels.
+    """
+
+    areas = np.zeros(len(lines), dtype=np.int64)
+    y1, y2, x1, x2 = toothMask.bound
+    if y1 >= y2 or x1 >= x2:
+        return areas
+
+    cornerYs = np.array([y1, y1, y2 - 1, y2 - 1], dtype=np.int64)
+    cornerXs = np.array([x1, x2 - 1, x1, x2 - 1], dtype=np.int64)
+    corners = lineCutTest(lines, angle, imgShape, cornerYs, cornerXs)
+    areas[corners.all(axis=1)] = toothMask.area()
+
+    crossing = np.nonzero(corners.any(axis=1) & ~corners.all(axis=1))[0]
+    if len(crossing) == 0:
+        return areas
+
+    # the test of lineCutTest written as one matrix product, 2 * side * cross + major >= 0
+    # with cross = dx * y - dy * x - (dx * qy1 - dy * qx1), exact in float64 for panorama coordinates
+    lines = lines[crossing]
+    qx1, qy1 = lines[:, 0], lines[:, 1]
+    dx, dy = lines[:, 2] - qx1, lines[:, 3] - qy1
+    side = lineCutSide(lines, angle, imgShape)
+    coefs = np.stack([dx, -dy, -(dx * qy1 - dy * qx1)], axis=1) * (2 * side)[:, None]
+
+    ys, xs = np.nonzero(toothMask.img == 255)
+    points = np.stack([ys + y1, xs + x1, np.ones(len(ys), dtype=np.int64)]).astype(np.float64)
+    major = np.maximum(np.abs(dx), np.abs(dy)).astype(np.float64)
+
+    chunk = max(1, QUAD_CHUNK_PIXELS // max(len(ys), 1))
+    for start in range(0, len(crossing), chunk):
+        inside = coefs[start:start + chunk].astype(np.float64) @ points >= -major[start:start + chunk, None]
+        areas[crossing[start:start + chunk]] = inside.sum(axis=1)
+
+    return areas
+
+
+def criticalLineCandidates(topLeft, topRight, imgShape, inputAngle):
+    # yields the lines findCriticalLine sweeps, in sweep order
+
     p1 = [0, 0]
     p2 = [0, imgShape[0]-1]
     p3 = [imgShape[1]-1, imgShape[0]-1]
     p4 = [imgShape[1]-1, 0]   
-    teethArea = np.sum(annotImg == 255)
     angle = inputAngle % 180 # maybe random between 0 ~ 9?
-    prev_q = [0,0,0,0]
     q1 = [0,0]
     q2 = [0,0]
-    found = 0
 
     if angle < 90:
         rad = math.radians(angle)
-        fillPoint = (1,1)        
     else:
         rad = math.radians(180-angle)
-        fillPoint = (p4[0]-1,1)        
  
     tan = math.tan(rad)
 
@@ -565,25 +783,7 @@ def findCriticalLine(annotImg, topLeft, topRight, imgShape, inputAngle):
                 q2[1] = int(-q2[0]/tan) -1
                 q2[0] = 0
 
-        lineCutImg = getLineCutImg(annotImg, [q1[0],q1[1],q2[0],q2[1]], angle, imgShape)
-        lineCutArea = np.sum(lineCutImg == 255)
-        lineCutIOU = lineCutArea / teethArea            
-
-        if found == 0:
-            if lineCutIOU >= 0.08:
-                found = 1
-                if inputAngle < 180:
-                    criticalLine = [prev_q[0], prev_q[1], prev_q[2], prev_q[3]]
-                    break
-            prev_q = [q1[0], q1[1], q2[0], q2[1]]
-        elif found == 1:
-            if lineCutIOU >= 0.92:
-                found = 2
-                if inputAngle >= 180:
-                    criticalLine = [q1[0], q1[1], q2[0], q2[1]]
-                break
-        else:
-            break 
+        yield [q1[0], q1[1], q2[0], q2[1]]
 
         if q1[1] < p2[1]:
             q1[1] += 2
@@ -593,23 +793,31 @@ def findCriticalLine(annotImg, topLeft, topRight, imgShape, inputAngle):
             q1[0] += 2
         else:
             q1[0] -= 2
-
-
-    return criticalLine
    
 
-def findSurvivedKeys(annotImgs, survivedKeys, criticalLine, angle, imgShape):
+def findSurvivedKeys(toothIndex, survivedKeys, criticalLine, angle, imgShape):
 
     newSurvivedKeys = []
+    keys = [key for key in survivedKeys if key != 0]
+
+    # teeth whose box is on one side of the line are decided from the box corners
+    bounds = toothIndex.bounds(keys)
+    valid = (bounds[:, 0] < bounds[:, 1]) & (bounds[:, 2] < bounds[:, 3])
+    cornerYs = bounds[:, [0, 0, 1, 1]] - [0, 0, 1, 1]
+    cornerXs = bounds[:, [2, 3, 2, 3]] - [0, 1, 0, 1]
+    corners = lineCutTest(np.array([criticalLine], dtype=np.int64), angle, imgShape, cornerYs, cornerXs)[0]
 
-    for key in survivedKeys:
+    for idx, key in enumerate(keys):
 
-        if key == 0:
+        if not valid[idx] or not corners[idx].any():
             continue
-        teethImg = annotImgs[key]
-        teethArea = np.sum(teethImg == 255)
-        lineCutImg = getLineCutImg(teethImg, criticalLine, angle, imgShape)
-        lineCutArea = np.sum(lineCutImg == 255)
+        teethImg = toothIndex[key]
+        if corners[idx].all():
+            if teethImg.area() > 0:
+                newSurvivedKeys.append(key)
+            continue
+        teethArea = teethImg.area()
+        lineCutArea = getLineCutArea(teethImg, criticalLine, angle, imgShape)
         thisIOU = lineCutArea / teethArea
         
         if thisIOU >= 0.08:
@@ -618,7 +826,7 @@ def findSurvivedKeys(annotImgs, survivedKeys, criticalLine, angle, imgShape):
     return newSurvivedKeys
 
 
-def createBoxInsideLines(criticalLineList, angleList, mainBoundary, imgShape):
+def createBoxInsideLines(criticalLineList, angleList, mainBoundary, imgShape, rng=random):
 
     h = mainBoundary[1] - mainBoundary[0]
     w = mainBoundary[3] - mainBoundary[2]
@@ -637,13 +845,14 @@ def createBoxInsideLines(criticalLineList, angleList, mainBoundary, imgShape):
     if rangeRight >= imgShape[1]:
         rangeRight = imgShape[1] - 1
 
-    insideLinesImg = np.ones(imgShape, dtype=np.uint8) * 255
+    # points are only drawn from the range, so the lines are only evaluated there
+    insideLinesImg = np.ones((rangeBot - rangeTop, rangeRight - rangeLeft), dtype=bool)
     
     for i in range(len(angleList)):
     
         line = criticalLineList[i]
         angle = angleList[i]
-        insideLinesImg = getLineCutImg(insideLinesImg, line, angle, imgShape)
+        insideLinesImg &= getLineCutMask(line, angle, imgShape, (rangeTop, rangeBot, rangeLeft, rangeRight))
         
 
     n = 0
@@ -657,10 +866,10 @@ def createBoxInsideLines(criticalLineList, angleList, mainBoundary, imgShape):
             if i > 999:
                 return 0
             i+=1
-            x = random.randrange(rangeLeft, rangeRight)
-            y = random.randrange(rangeTop, rangeBot)
+            x = rng.randrange(rangeLeft, rangeRight)
+            y = rng.randrange(rangeTop, rangeBot)
     
-            if insideLinesImg[y, x] == 255:
+            if insideLinesImg[y - rangeTop, x - rangeLeft]:
                 n += 1
                 boxPoints.append([x,y])
 
@@ -678,7 +887,11 @@ def createBoxInsideLines(criticalLineList, angleList, mainBoundary, imgShape):
     return boxPoints
 
 
-def createSingleOrNoneBox(annotImgs, imgsBoundary, mainTeethKey, neighborTeethKeys, imgShape, boxType):
+# a single / none box draws at most SINGLE_BOX_ATTEMPTS critical lines and SINGLE_BOX_ATTEMPTS boxes
+SINGLE_BOX_ATTEMPTS = 100
+
+
+def createSingleOrNoneBox(toothIndex, imgsBoundary, mainTeethKey, neighborTeethKeys, imgShape, boxType, rng=random, maxAttempts=SINGLE_BOX_ATTEMPTS, telemetry=NULL_TELEMETRY):
 
     '''
     neighborTeethKeys = findNeighborTeeth(imgsBoundary, mainTeethKey, imgShape)
@@ -723,12 +936,13 @@ def createSingleOrNoneBox(annotImgs, imgsBoundary, mainTeethKey, neighborTeethKe
         cv2.floodFill(mainTeethImg, mask, fillPoint, 255)
     '''
 
-    mainTeethImg = annotImgs[mainTeethKey]
+    mainTeethImg = toothIndex[mainTeethKey]
     mainBoundary = imgsBoundary[mainTeethKey]
-    mainTeethArea = np.sum(mainTeethImg == 255)
+    mainTeethArea = mainTeethImg.area()
     criticalLineList = []
     angleList = []       
     survivedKeys = list(neighborTeethKeys)
+    lineAttempts = 0
 
     while len(survivedKeys) > 0:
 
@@ -736,21 +950,31 @@ def createSingleOrNoneBox(annotImgs, imgsBoundary, mainTeethKey, neighborTeethKe
             survivedKeys = survivedKeys[1:]
             continue
 
-        tempTeethImg = annotImgs[survivedKeys[0]]
+        if lineAttempts >= maxAttempts:
+            print("no lines for {} box of {} after {} attempts".format(boxType, mainTeethKey, maxAttempts))
+            return 0
+        lineAttempts += 1
+
+        tempTeethImg = toothIndex[survivedKeys[0]]
         tempBoundary = imgsBoundary[survivedKeys[0]]
         topLeft = (tempBoundary[2], tempBoundary[0])
         topRight = (tempBoundary[3], tempBoundary[0])
         
         print("add line for ", survivedKeys[0])
-        angle = random.randrange(0,360)
+        angle = rng.randrange(0,360)
         criticalLine = findCriticalLine(tempTeethImg, topLeft, topRight, imgShape, angle)
+        if len(criticalLine) == 0:
+            # no line of the sweep cuts the tooth enough, try another angle
+            telemetry.reject('no_line')
+            continue
         
-        checkMainArea = np.sum(getLineCutImg(mainTeethImg, criticalLine, angle, imgShape) == 255)
+        checkMainArea = getLineCutArea(mainTeethImg, criticalLine, angle, imgShape)
         if checkMainArea < mainTeethArea * 0.55:
+            telemetry.reject('main_cut')
             continue
 
         survivedKeys = survivedKeys[1:]
-        survivedKeys = findSurvivedKeys(annotImgs, survivedKeys, criticalLine, angle, imgShape)
+        survivedKeys = findSurvivedKeys(toothIndex, survivedKeys, criticalLine, angle, imgShape)
         
         criticalLineList.append(criticalLine)
         angleList.append(angle)
@@ -759,8 +983,11 @@ def createSingleOrNoneBox(annotImgs, imgsBoundary, mainTeethKey, neighborTeethKe
     if boxType == 'none':
         topLeft = (mainBoundary[2], mainBoundary[0])
         topRight = (mainBoundary[3], mainBoundary[0])
-        angle = random.randrange(0,360)
+        angle = rng.randrange(0,360)
         criticalLine = findCriticalLine(mainTeethImg, topLeft, topRight, imgShape, angle)
+        if len(criticalLine) == 0:
+            telemetry.reject('no_line')
+            return 0
 
         angleList.append(angle)
         criticalLineList.append(criticalLine)
@@ -770,58 +997,69 @@ def createSingleOrNoneBox(annotImgs, imgsBoundary, mainTeethKey, neighborTeethKe
         minBoxSize = mainTeethArea / 10
 
 
-    while True:
+    for attempt in range(maxAttempts):
 
-        boxPoints = createBoxInsideLines(criticalLineList, angleList, mainBoundary, imgShape)
+        telemetry.attempt()
+        boxPoints = createBoxInsideLines(criticalLineList, angleList, mainBoundary, imgShape, rng)
         
         if boxPoints == 0:
+            telemetry.reject('no_point')
             return 0            
 
-        boxImg = np.zeros(imgShape, dtype=np.uint8)
-        boxImg = fillBox(boxImg, boxPoints)
+        # the box is filled inside its bounding rectangle only
+        bx1, by1 = np.min(boxPoints, axis=0)
+        bx2, by2 = np.max(boxPoints, axis=0) + 1
+        boxImg = np.zeros((by2 - by1, bx2 - bx1), dtype=np.uint8)
+        boxImg = fillBox(boxImg, [[x - bx1, y - by1] for x, y in boxPoints])
         boxArea = np.sum(boxImg == 255)
 
         if boxArea < minBoxSize:
+            telemetry.reject('small_box')
             continue
 
-        if boxType == 'none':
-            break
-        
-        intersectionImg = cv2.bitwise_and(boxImg, mainTeethImg)
-        intersectionArea = np.sum(intersectionImg == 255)
+        intersectionArea = mainTeethImg.intersectArea(boxImg, by1, bx1)
         thisIOU = intersectionArea / mainTeethArea
 
-        if thisIOU >= 0.08:
-            break
+        if boxType == 'none' or thisIOU >= 0.08:
+            print("success!")
+            telemetry.created(thisIOU)
+            return boxPoints
+        telemetry.reject('low_iou')
 
-    print("success!")
+    print("no {} box for {} after {} attempts".format(boxType, mainTeethKey, maxAttempts))
+
+    return 0
 
-    return boxPoints
 
+# a double box is drawn from DOUBLE_BOX_ATTEMPTS random rectangles, QUADS_PER_BOX quads each
+DOUBLE_BOX_ATTEMPTS = 20
+QUADS_PER_BOX = 50
+# quads are rasterized in chunks of at most this many pixels
+QUAD_CHUNK_PIXELS = 1 << 22
 
-def createDoubleBox(annotImgs, imgsBoundary, mainTeethKey, imgShape, boxType):
+
+def createDoubleBox(toothIndex, imgsBoundary, mainTeethKey, imgShape, boxType, rng=random, maxAttempts=DOUBLE_BOX_ATTEMPTS, telemetry=NULL_TELEMETRY):
 
     if boxType == 'double':
         findNum = 1
     else:
         findNum = 2
 
-    mainTeethImg = annotImgs[mainTeethKey]
+    mainTeethImg = toothIndex[mainTeethKey]
     mainBoundary = imgsBoundary[mainTeethKey]
-    mainTeethArea = np.sum(mainTeethImg == 255)
+    mainTeethArea = mainTeethImg.area()
     main_h = mainBoundary[1] - mainBoundary[0]
     main_w = mainBoundary[3] - mainBoundary[2]
 
-    boxPoints = []
-
     print("area = ", mainTeethArea)
 
-    while True:
+    for attempt in range(maxAttempts):
 
-        rand_w = random.randrange(int(main_w), int(3 * main_w))
-        rand_h = random.randrange(int(main_h), int(1.8 * main_h))
-        rand_y = (mainBoundary[0]+mainBoundary[1])/2 + random.randrange(int(-0.2*main_h),int(0.2*main_h))
-        rand_x = (mainBoundary[2]+mainBoundary[3])/2 + random.randrange(int(-0.2*main_w),int(0.2*main_w))
+        telemetry.attempt()
+        rand_w = rng.randrange(int(main_w), int(3 * main_w))
+        rand_h = rng.randrange(int(main_h), int(1.8 * main_h))
+        rand_y = (mainBoundary[0]+mainBoundary[1])/2 + rng.randrange(int(-0.2*main_h),int(0.2*main_h))
+        rand_x = (mainBoundary[2]+mainBoundary[3])/2 + rng.randrange(int(-0.2*main_w),int(0.2*main_w))
 
         box_x1 = int(rand_x - rand_w/2)
         box_x2 = int(rand_x + rand_w/2)
@@ -836,58 +1074,93 @@ def createDoubleBox(annotImgs, imgsBoundary, mainTeethKey, imgShape, boxType):
         if box_x2 >= imgShape[1]:
             box_x2 = imgShape[1]-1 
         if box_y2 >= imgShape[0]:
-            box_x2 = imgShape[0]-1 
+            box_y2 = imgShape[0]-1 
 
-        for i in range(50):
+        if box_x1 >= box_x2 or box_y1 >= box_y2:
+            telemetry.reject('empty_rect')
+            continue
 
-            r1 = random.randrange(box_x1, box_x2)
-            r2 = random.randrange(box_x1, box_x2)
-            r3 = random.randrange(box_y1, box_y2)
-            r4 = random.randrange(box_y1, box_y2)
+        quads = []
+        for i in range(QUADS_PER_BOX):
 
-            boxPoints = [[r1,box_y1],[box_x2,r3],[r2,box_y2],[box_x1,r4]]
-            pts = np.array(boxPoints, np.int32)
-            pts = pts.reshape((-1,1,2))
-            fillPoint = (int((box_x1+box_x2)/2),int((r3+r4)/2))
-            
-            boxImg = np.zeros(imgShape, dtype=np.uint8)
-            mask = np.zeros((imgShape[0]+2,imgShape[1]+2), dtype=np.uint8)
-            cv2.polylines(boxImg, [pts], True, 255)
-            cv2.floodFill(boxImg, mask, fillPoint, 255)
-            
-            intersectionImg = cv2.bitwise_and(mainTeethImg, boxImg)
-            intersectionArea = np.sum(intersectionImg == 255)
-            mainIOU = intersectionArea / mainTeethArea
-            if mainIOU < 0.08:
-                print("try again...1")
-                continue
+            r1 = rng.randrange(box_x1, box_x2)
+            r2 = rng.randrange(box_x1, box_x2)
+            r3 = rng.randrange(box_y1, box_y2)
+            r4 = rng.randrange(box_y1, box_y2)
 
-            found = 0 
-            for name, annotImg in annotImgs.items():
+            quads.append([[r1,box_y1],[box_x2,r3],[r2,box_y2],[box_x1,r4]])
 
-                if name == mainTeethKey:
-                    continue
+        # every quad lies inside the rectangle, so a tooth with too little area in the rectangle
+        # cannot pass with any quad, which the summed-area tables tell without rasterizing.
+        # Only the teeth meeting the rectangle can have any area in it.
+        window = (box_y1, box_y2 + 1, box_x1, box_x2 + 1)
+        if mainTeethImg.rectArea(*window) < 0.08 * mainTeethArea:
+            telemetry.reject('main_rect')
+            continue
+        names = [name for name in toothIndex.window(*window)
+                if name != mainTeethKey and toothIndex[name].rectArea(*window) >= 0.08 * toothIndex[name].area()]
+        if len(names) < findNum:
+            telemetry.reject('neighbor_rect')
+            continue
+        names.append(mainTeethKey)
 
-                intersectionImg = cv2.bitwise_and(annotImg, boxImg)
-                intersectionArea = np.sum(intersectionImg == 255)
-                annotArea = np.sum(annotImg == 255)
-                thisIOU = intersectionArea / annotArea
+        intersectionAreas = quadIntersectionAreas(np.array(quads, dtype=np.int64), window, [toothIndex[name] for name in names])
+        areas = np.array([toothIndex[name].area() for name in names], dtype=np.float64)
+        ious = intersectionAreas / np.maximum(areas, 1)
 
-                if thisIOU >= 0.08:
-                    found += 1
+        mainIdx = names.index(mainTeethKey)
+        mainIOU = ious[:, mainIdx]
+        found = np.sum(ious >= 0.08, axis=1) - (mainIOU >= 0.08)
 
-                if found == findNum:
-                    break
+        # the first quad in drawing order that covers the main tooth and findNum others
+        passed = np.nonzero((mainIOU >= 0.08) & (found >= findNum))[0]
+        if len(passed) > 0:
+            telemetry.created(mainIOU[passed[0]])
+            return quads[passed[0]]
 
-            if found == findNum:
-                break        
-    
-        if found == findNum:
-            break
-    
-        print("try again...2")
+        telemetry.reject('no_quad')
 
-    return boxPoints
+    print("no {} box for {} after {} attempts".format(boxType, mainTeethKey, maxAttempts))
+
+    return 0
+
+
+def quadIntersectionAreas(quads, window, toothMasks):
+    """Count the pixels of every tooth inside every quad
+
+    Arguments:
+        quads {np.array} -- (n, 4, 2) convex quads of [x, y] points
+        window {tuple} -- (y1, y2, x1, x2) containing every quad
+        toothMasks {list} -- ToothMasks to count
+
+    Returns:
+        np.array -- (n, len(toothMasks)) intersection areas
+    """
+
+    y1, y2, x1, x2 = window
+    h, w = y2 - y1, x2 - x1
+    masks = np.stack([toothMask.crop(y1, y2, x1, x2).reshape(-1) == 255 for toothMask in toothMasks], axis=1).astype(np.float32)
+
+    ys = np.arange(y1, y2, dtype=np.int64).reshape(1, h, 1)
+    xs = np.arange(x1, x2, dtype=np.int64).reshape(1, 1, w)
+    chunk = max(1, QUAD_CHUNK_PIXELS // max(h * w, 1))
+    counts = []
+
+    for start in range(0, len(quads), chunk):
+        q = quads[start:start + chunk]
+        # a pixel is inside a convex quad if it is on the same side of all four edges, edges included
+        positive = np.ones((len(q), h, w), dtype=bool)
+        negative = np.ones((len(q), h, w), dtype=bool)
+        for k in range(4):
+            ax, ay = q[:, k, 0].reshape(-1, 1, 1), q[:, k, 1].reshape(-1, 1, 1)
+            bx, by = q[:, (k+1)%4, 0].reshape(-1, 1, 1), q[:, (k+1)%4, 1].reshape(-1, 1, 1)
+            cross = (bx - ax) * (ys - ay) - (by - ay) * (xs - ax)
+            positive &= cross >= 0
+            negative &= cross <= 0
+        inside = (positive | negative).reshape(len(q), -1).astype(np.float32)
+        counts.append(inside @ masks)
+
+    return np.rint(np.concatenate(counts, axis=0)).astype(np.int64)
 
 
 def fillBox(img, pts):
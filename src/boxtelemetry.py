@@ -0,0 +1,138 @@
+'''
+
+counters of box creation, used by boxcreation.py --report and benchmark.py
+
+Every call that creates one box (createDoubleBox, createSingleOrNoneBox, or both for a hollow
+box) is one record: the panorama, tooth, box type, whether a box came out, the attempts it took,
+the rejections by reason, its wall time and the IoU of the box with the main tooth.
+Like the stage timer, the box functions take an optional telemetry and use NULL_TELEMETRY
+without one.
+
+Rejection reasons
+    double  empty_rect (the random rectangle is empty after clipping),
+            main_rect / neighbor_rect (the rectangle holds < 8% of the main tooth / of too few others),
+            no_quad (none of the quads of the rectangle passes)
+    single / none
+            no_line (the sweep finds no critical line for a tooth at the drawn angle),
+            main_cut (a critical line cuts the main tooth below 55%),
+            no_point (no point inside the lines after 1000 draws),
+            small_box (box smaller than a tenth of the tooth), low_iou (single box < 8% of the tooth)
+
+'''
+
+import time
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+BOX_TYPES = ['double', 'single', 'none', 'hollow']
+REASONS = ['empty_rect', 'main_rect', 'neighbor_rect', 'no_quad', 'no_line', 'main_cut', 'no_point', 'small_box', 'low_iou']
+PERCENTILES = [50, 90, 99]
+
+
+class BoxTelemetry():
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.current = None
+
+    @contextmanager
+    def box(self, imageTitle, tooth, boxType, teethType='real'):
+        # counts of the box functions called inside go to one record
+        if not self.enabled:
+            yield
+            return
+        record = OrderedDict([('image', imageTitle), ('tooth', tooth), ('teethType', teethType),
+                ('boxType', boxType), ('created', False), ('attempts', 0), ('seconds', 0.0), ('iou', np.nan)])
+        for reason in REASONS:
+            record[reason] = 0
+        self.current = record
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.current = None
+            self.records.append(record)
+
+    def attempt(self):
+        if self.current is not None:
+            self.current['attempts'] += 1
+
+    def reject(self, reason):
+        if self.current is not None:
+            self.current[reason] += 1
+
+    def created(self, iou):
+        if self.current is not None:
+            self.current['created'] = True
+            self.current['iou'] = float(iou)
+
+    def failed(self):
+        # a box made of several calls fails if one of them fails
+        if self.current is not None:
+            self.current['created'] = False
+            self.current['iou'] = np.nan
+
+    def extend(self, records):
+        # records of another process, see boxcreation._createBoxXmlWorker
+        self.records += records
+
+    def toDataFrame(self):
+        return pd.DataFrame(self.records, columns=['image', 'tooth', 'teethType', 'boxType', 'created',
+                'attempts', 'seconds', 'iou'] + REASONS)
+
+    def summary(self, slowest=10):
+        """Per box type totals and percentiles, and the slowest teeth
+
+        Returns:
+            dict -- json serializable summary
+        """
+
+        df = self.toDataFrame()
+        result = OrderedDict()
+
+        for boxType in BOX_TYPES:
+            typeDf = df[df['boxType'] == boxType]
+            if len(typeDf) == 0:
+                continue
+            created = typeDf[typeDf['created']]
+            result[boxType] = OrderedDict([
+                ('calls', int(len(typeDf))),
+                ('created', int(len(created))),
+                ('seconds', float(typeDf['seconds'].sum())),
+                ('rejections', OrderedDict((reason, int(typeDf[reason].sum())) for reason in REASONS if typeDf[reason].sum() > 0)),
+                ('attemptsPercentiles', percentiles(typeDf['attempts'])),
+                ('secondsPercentiles', percentiles(typeDf['seconds'])),
+                ('iouPercentiles', percentiles(created['iou'])),
+            ])
+
+        # a tooth is slow over all its calls of all box types
+        teeth = df.groupby(['image', 'tooth'], sort=False).agg({'seconds': 'sum', 'attempts': 'sum', 'created': 'sum'})
+        teeth = teeth.sort_values('seconds', ascending=False).head(slowest)
+        result['slowestTeeth'] = [OrderedDict([('image', image), ('tooth', tooth), ('seconds', float(row['seconds'])),
+                ('attempts', int(row['attempts'])), ('created', int(row['created']))])
+                for (image, tooth), row in teeth.iterrows()]
+
+        return result
+
+    def writeReport(self, fileName):
+        """Writes the records to (fileName).csv and the summary to (fileName).json"""
+        self.toDataFrame().to_csv(fileName + '.csv', index=False)
+        with open(fileName + '.json', 'w') as jsonFile:
+            json.dump(self.summary(), jsonFile, indent=2)
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {}
+    result = OrderedDict(('p' + str(p), float(np.percentile(values, p))) for p in PERCENTILES)
+    result['max'] = float(values.max())
+    return result
+
+
+NULL_TELEMETRY = BoxTelemetry(enabled=False)
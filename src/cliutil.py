@@ -0,0 +1,29 @@
+'''
+
+command line options of the scripts
+
+Scripts take positional arguments from sys.argv and pop their options out of it first.
+This module imports nothing, so any script can use it without the dependencies of another.
+
+'''
+
+
+def popOption(args, name, default):
+    # removes '--name value' from args and returns the value
+    if name not in args:
+        return default
+    idx = args.index(name)
+    if idx + 1 >= len(args):
+        print('need to input value for {}'.format(name))
+        return default
+    value = args[idx + 1]
+    del args[idx:idx + 2]
+    return value
+
+
+def popFlag(args, name):
+    # removes '--name' from args and returns whether it was given
+    if name not in args:
+        return False
+    args.remove(name)
+    return True
@@ -0,0 +1,189 @@
+'''
+
+COCO person annotations shared by pretrain_coco.py and dataset.CocoPanoSet
+
+loading the instances json through a cache, the image id -> annotations index,
+reading images from a local COCO directory or zip, and rasterizing an annotation
+inside a window of its image at any resolution
+
+'''
+
+import os
+import io
+import pickle
+import hashlib
+import zipfile
+import numpy as np
+from PIL import Image
+from pycocotools.coco import COCO
+from pycocotools import mask as maskUtils
+
+COCO_CACHE_DIR = '../data/cache/coco/'
+
+
+def loadCoco(annFile, catNms, cacheDir=COCO_CACHE_DIR):
+    """Load the instances of the catNms categories, from a pickle cache after the first call
+
+    The instances json of train2017 takes seconds to parse and most of it is other categories,
+    so only the categories, the images of catNms and their annotations are cached.
+    The cache is keyed by the path, size and modification time of annFile.
+
+    Returns:
+        COCO -- indexed like COCO(annFile), restricted to catNms
+    """
+
+    stat = os.stat(annFile)
+    key = '{}:{}:{}:{}'.format(os.path.abspath(annFile), stat.st_size, stat.st_mtime, ','.join(catNms))
+    cacheName = os.path.join(cacheDir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+
+    coco = COCO()
+    if os.path.exists(cacheName):
+        try:
+            with open(cacheName, 'rb') as cacheFile:
+                coco.dataset = pickle.load(cacheFile)
+            coco.createIndex()
+            return coco
+        except (IOError, EOFError, pickle.UnpicklingError):
+            print('broken coco cache {}, loading {} again'.format(cacheName, annFile))
+
+    fullCoco = COCO(annFile)
+    catIds = fullCoco.getCatIds(catNms=catNms)
+    anns = [a for a in fullCoco.dataset['annotations'] if a['category_id'] in catIds]
+    imgIds = set(a['image_id'] for a in anns)
+    coco.dataset = {
+        'info': fullCoco.dataset.get('info', {}),
+        'categories': fullCoco.dataset['categories'],
+        'images': [img for img in fullCoco.dataset['images'] if img['id'] in imgIds],
+        'annotations': anns,
+    }
+    coco.createIndex()
+
+    # written aside and renamed like the psd cache
+    os.makedirs(cacheDir, exist_ok=True)
+    tempName = '{}.{}.tmp'.format(cacheName, os.getpid())
+    with open(tempName, 'wb') as cacheFile:
+        pickle.dump(coco.dataset, cacheFile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tempName, cacheName)
+
+    return coco
+
+
+def buildAnnotIndex(coco, catIds, includeCrowd=False):
+    # image id -> annotations of catIds, in the order of coco.getAnnIds
+    annotIndex = {}
+    for ann in coco.dataset['annotations']:
+        if ann['category_id'] in catIds and (includeCrowd or not ann['iscrowd']):
+            annotIndex.setdefault(ann['image_id'], []).append(ann)
+    return annotIndex
+
+
+def findImageSource(source, dataType):
+    """Locate the images of dataType in a local COCO directory
+
+    source holds either the extracted (dataType)/ directory or (dataType).zip, as downloaded from cocodataset.org
+
+    Returns:
+        tuple -- ('dir', directory) or ('zip', zip file name)
+    """
+
+    if os.path.isdir(os.path.join(source, dataType)):
+        return ('dir', os.path.join(source, dataType))
+    if os.path.isfile(os.path.join(source, dataType + '.zip')):
+        return ('zip', os.path.join(source, dataType + '.zip'))
+    raise IOError('no {} directory or {}.zip in {}'.format(dataType, dataType, source))
+
+
+_zipFiles = {}
+
+def readImageBytes(imageSource, fileName):
+    kind, path = imageSource
+    if kind == 'dir':
+        with open(os.path.join(path, fileName), 'rb') as imageFile:
+            return imageFile.read()
+
+    # one open zip per process, like getImageWriter
+    key = (os.getpid(), path)
+    if key not in _zipFiles:
+        _zipFiles[key] = zipfile.ZipFile(path)
+    dataType = os.path.splitext(os.path.basename(path))[0]
+    return _zipFiles[key].read(dataType + '/' + fileName)
+
+
+def instanceWindow(bbox, imgSize, margin):
+    """Window around an instance, its bbox grown by margin times its size on every side
+
+    Arguments:
+        bbox {list} -- COCO [x, y, w, h]
+        imgSize {tuple} -- (height, width) of the image
+        margin {float} -- growth relative to the bbox size
+
+    Returns:
+        tuple -- (x1, y1, x2, y2) clipped to the image
+    """
+
+    x, y, w, h = bbox
+    x1 = int(max(np.floor(x - margin * w), 0))
+    y1 = int(max(np.floor(y - margin * h), 0))
+    x2 = int(min(np.ceil(x + w + margin * w), imgSize[1]))
+    y2 = int(min(np.ceil(y + h + margin * h), imgSize[0]))
+
+    return (x1, y1, max(x2, x1 + 1), max(y2, y1 + 1))
+
+
+def rasterizeSegmentation(segmentation, imgSize, window, size):
+    """Mask of a COCO segmentation inside window, rasterized at size
+
+    Polygons are scaled to size and rasterized there, so no full resolution mask is made.
+    RLE segmentations (crowds) are decoded at full resolution and resized.
+
+    Arguments:
+        segmentation {list or dict} -- polygons or RLE of the annotation
+        imgSize {tuple} -- (height, width) of the image
+        window {tuple} -- (x1, y1, x2, y2) of the image to rasterize
+        size {tuple} -- (height, width) of the mask
+
+    Returns:
+        np.array -- uint8 mask of size, 255 = instance
+    """
+
+    x1, y1, x2, y2 = window
+    height, width = size
+    sx, sy = width / (x2 - x1), height / (y2 - y1)
+
+    if isinstance(segmentation, list):
+        polygons = []
+        for polygon in segmentation:
+            points = np.array(polygon, dtype=np.float64).reshape(-1, 2)
+            points = (points - [x1, y1]) * [sx, sy]
+            polygons.append(points.reshape(-1).tolist())
+        polygons = [polygon for polygon in polygons if len(polygon) >= 6]
+        if len(polygons) == 0:
+            return np.zeros(size, dtype=np.uint8)
+        rle = maskUtils.merge(maskUtils.frPyObjects(polygons, height, width))
+        return maskUtils.decode(rle) * np.uint8(255)
+
+    if isinstance(segmentation['counts'], list):
+        segmentation = maskUtils.frPyObjects(segmentation, imgSize[0], imgSize[1])
+    mask = maskUtils.decode(segmentation)[y1:y2, x1:x2] * np.uint8(255)
+    return np.array(Image.fromarray(mask).resize((width, height), Image.NEAREST))
+
+
+def rasterizeBox(bbox, window, size):
+    """Filled COCO bbox inside window at size, the box channel of an instance"""
+
+    x1, y1, x2, y2 = window
+    height, width = size
+    sx, sy = width / (x2 - x1), height / (y2 - y1)
+    x, y, w, h = bbox
+
+    boxImg = np.zeros(size, dtype=np.uint8)
+    bx1, bx2 = int(np.floor((x - x1) * sx)), int(np.ceil((x + w - x1) * sx))
+    by1, by2 = int(np.floor((y - y1) * sy)), int(np.ceil((y + h - y1) * sy))
+    boxImg[max(by1, 0):max(by2, 0), max(bx1, 0):max(bx2, 0)] = 255
+
+    return boxImg
+
+
+def readImage(imageSource, fileName):
+    """Grayscale PIL image of a COCO image"""
+    return Image.open(io.BytesIO(readImageBytes(imageSource, fileName))).convert('L')
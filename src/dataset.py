@@ -16,6 +16,10 @@ from typing import NamedTuple
 from torch.utils.data import Dataset
 import pandas as pd
 from augmentation import getAugmentation
+from patchstore import STORE_PREFIX, isStoreRef, readPatch
+from overlay import OVERLAY_PREFIX, isOverlayRef, resolveOverlay
+from samplecache import MB, SampleCache
+from tensorshard import SHARD_DIR, loadShards
 
 IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg')
 
@@ -32,7 +36,30 @@ def isImageFile(filename):
 def getAbsoluteAddress(filedir):
     if filedir == '0':
         return None
+    if isStoreRef(filedir):
+        return STORE_PREFIX + os.path.join(os.path.dirname(__file__), filedir[len(STORE_PREFIX):])
+    if isOverlayRef(filedir):
+        # rendered on demand, see overlay.resolveOverlay
+        return OVERLAY_PREFIX + os.path.join(os.path.dirname(__file__), filedir[len(OVERLAY_PREFIX):])
     return os.path.join(os.path.dirname(__file__), filedir)
+
+
+def openImage(path):
+    """open an image file, or a patch of the patch store
+    
+    Arguments:
+        path {string} -- file path or patch store reference
+    """
+    if isStoreRef(path):
+        return Image.fromarray(readPatch(path), mode='L')
+    return Image.open(path)
+
+
+def thresholdTarget(img, path):
+    """binarize a target mask, store patches are lossless and already binary"""
+    if isStoreRef(path):
+        return img
+    return img.point(lambda p: 255 if p > 50 else 0)
     
 
 def createImage(size, blank=True):
@@ -54,6 +81,7 @@ FRONT = (11, 12, 13, 21, 22, 23, 31, 32, 33, 41, 42, 43)
 class Filter():
     
     def __init__(self, filters):
+        self.filters = list(filters)
         lookup = {
             "train" : lambda row: row['Train.Val'] == 'train' and int(row['Segmentable.Type']) > 0,
             "val" : lambda row: row['Train.Val'] == 'val' and int(row['Segmentable.Type']) > 0,
@@ -71,6 +99,54 @@ class Filter():
                 return False
         return True
 
+    def mask(self, df):
+        """the same filters over a whole DataFrame, as a boolean np.array"""
+        lookup = {
+            "train" : lambda df: (df['Train.Val'] == 'train') & (df['Segmentable.Type'].astype(int) > 0),
+            "val" : lambda df: (df['Train.Val'] == 'val') & (df['Segmentable.Type'].astype(int) > 0),
+            "easy": lambda df: df['Segmentable.Type'].astype(int) <= 10,
+            "segmentable": lambda df: df['Segmentable.Type'].astype(int) < 10,
+            "unsegmentable": lambda df: df['Segmentable.Type'].astype(int) >= 10,
+            "front-teeth": lambda df: df['Tooth.Num.Annot'].astype(int).isin(FRONT),
+        }
+        mask = np.ones(len(df), dtype=bool)
+        for f in self.filters:
+            mask &= lookup[f](df).values
+        return mask
+
+
+class PathArray():
+    """Read-only list of paths (or None) in one contiguous utf-8 buffer
+
+    A list of str keeps one refcounted object per path, and touching the refcounts in
+    forked DataLoader workers copies the pages holding them. Two np.arrays do not.
+    """
+
+    def __init__(self, paths):
+        encoded = [b'' if path is None else path.encode('utf-8') for path in paths]
+        self.none = np.array([path is None for path in paths], dtype=bool)
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(e) for e in encoded])
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __getitem__(self, index):
+        if self.none[index]:
+            return None
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __len__(self):
+        return len(self.none)
+
+
+def addressColumn(df, col):
+    return PathArray([getAbsoluteAddress(path) for path in df[col].astype(str)])
+
+
+def parseSizes(sizes):
+    """'(h, w)' strings of Cropped.Img.Size to an (n, 2) int array"""
+    parsed = sizes.astype(str).str.extract(r'\(\s*(\d+)\s*,\s*(\d+)')
+    return parsed.astype(np.int64).values.reshape(-1, 2)
+
 class Data(NamedTuple):
     metadata_path: str
     pano_mean: float
@@ -89,7 +165,7 @@ class Patch(NamedTuple):
     size: tuple
 
 
-def getDataset(datadir, name, filter, pretrain, channel, size, train, val):
+def getDataset(datadir, name, filter, pretrain, channel, size, train, val, coco=None, cache=None, shards=None):
     df = pd.read_csv(datadir)
     data = df.loc[df['DataSet.Title'] == name].iloc[0]
     data = Data(data['Csv.File'], data['Pano.Mean'], data['Pano.Stdev'], data['Box.Mean'], data['Box.Stdev'])    
@@ -109,43 +185,75 @@ def getDataset(datadir, name, filter, pretrain, channel, size, train, val):
     augmentations = {'train' : getAugmentation(train, augmentation_param),
                      'val'   : getAugmentation(val, augmentation_param)}    
 
+    # "coco": "(COCO directory)" streams the person instances of train2017 / val2017 instead of the csv patches
+    if coco is not None:
+        return { x: CocoPanoSet(coco, x + '2017', size, transform=augmentations[x])
+                    for x in ('train', 'val')}
+
+    # "shards": {"dir": .., "jobs": ..} stores the deterministic prefix of the transforms once, see tensorshard.py
+    if shards is not None and not pretrain:
+        return { x: getShardSet(PanoSet(data.metadata_path, data_filter[x]), augmentations[x], name, x, filter[x], **shards)
+                    for x in ('train', 'val')}
+
+    # "cache": {"encoded_mb": .., "decoded_mb": ..} caches the patch files of PanoSet, see samplecache.py
+    if cache is not None and not pretrain:
+        return { x: PanoSet(data.metadata_path, data_filter[x], transform=augmentations[x], cache=cache)
+                    for x in ('train', 'val')}
+
     return { x: D(data.metadata_path, data_filter[x], transform=augmentations[x])
                     for x in ('train', 'val')}
 
+
+def getShardSet(dataset, transform, name, split, filterSpec, dir=SHARD_DIR, jobs=1):
+    # falls back to dataset with the whole transform when the prefix cannot be stored
+    shards = loadShards(dataset, transform, name, split, filterSpec, dir, jobs)
+    if shards is None:
+        dataset.transform = transform
+        return dataset
+    return ShardSet(dataset, shards, transform)
+
+
+def stackSample(input_pano, input_box, target_major, target_minor):
+    input = torch.cat([input_box, input_pano], dim=0)
+    target = torch.cat([target_major, target_minor], dim=0)
+
+    assert set(np.unique(target)).issubset({0,1})
+
+    return input, target
+
+
 class PanoSet(Dataset):
     """
     extended Dataset class for pytorch
     
     """
 
-    def __init__(self, meta_data_path, filter_func, transform = None):
+    PATH_COLS = ('Cropped.Pano.Img', 'Cropped.Box.Img', 'Cropped.Major.Annot.Img', 'Cropped.Minor.Annot.Img',
+                 'Major.Target.Img', 'Minor.Target.Img', 'All.Img')
+
+    # files read by __getitem__, one cache slot each
+    CACHE_SLOTS = 4
+
+    def __init__(self, meta_data_path, filter_func, transform = None, cache = None):
         
         self.path = meta_data_path
         df = pd.read_csv(self.path)
-        data = []
-
-        for idx, row in df.iterrows():
-            if filter_func(row):
-                pano_path = getAbsoluteAddress(row['Cropped.Pano.Img'])
-                box_path = getAbsoluteAddress(row['Cropped.Box.Img'])
-                major_input_path = getAbsoluteAddress(row['Cropped.Major.Annot.Img'])
-                minor_input_path = getAbsoluteAddress(row['Cropped.Minor.Annot.Img'])
-                major_target_path = getAbsoluteAddress(row['Major.Target.Img'])
-                minor_target_path = getAbsoluteAddress(row['Minor.Target.Img'])
-                all_image_path = getAbsoluteAddress(row['All.Img'])
-                size = eval(row['Cropped.Img.Size'])
-
-                data.append(Patch(
-                    pano_path, box_path,  
-                    major_input_path,  minor_input_path,
-                    major_target_path, minor_target_path,
-                    all_image_path,
-                    size))
-        
-        self.data = data
-        self.meta_data = df
+        df = df[filter_func.mask(df)]
+
+        # a few arrays instead of one object per row, see PathArray
+        self.paths = [addressColumn(df, col) for col in self.PATH_COLS]
+        self.sizes = parseSizes(df['Cropped.Img.Size'])
         self.transform = transform
 
+        # made here, before the DataLoader forks its workers, so they share the encoded tier
+        self.cache = None
+        if cache is not None:
+            self.cache = SampleCache(len(self) * self.CACHE_SLOTS,
+                    cache.get('encoded_mb', 0) * MB, cache.get('decoded_mb', 0) * MB)
+
+    def patch(self, index):
+        return Patch(*[paths[index] for paths in self.paths], tuple(int(s) for s in self.sizes[index]))
+
     def __getitem__(self, index, doTransform=True):
         """
         
@@ -155,46 +263,92 @@ class PanoSet(Dataset):
             tuple: (image, target, path, index)
                 target is class_index
         """
-        patch = self.data[index]
+        input_pano, input_box, target_major, target_minor = self.loadSample(index)
 
-        input_pano = Image.open(patch.pano_path)
-        input_box = Image.open(patch.box_path)
+        if self.transform is not None and doTransform:
+            input_pano, input_box, target_major, target_minor = self.transform(input_pano, input_box, target_major, target_minor)
+            
+        input, target = stackSample(input_pano, input_box, target_major, target_minor)
+      
+        return (input, target, index)
+
+    def loadSample(self, index):
+        # the four images of a sample before any transform
+        patch = self.patch(index)
+
+        input_pano = self.openSlot(index, 0, patch.pano_path)
+        input_box = self.openSlot(index, 1, patch.box_path)
 
         if patch.major_target_path is None:
             target_major = createImage(patch.size)
         else:
-            target_major = Image.open(patch.major_target_path)
+            target_major = thresholdTarget(self.openSlot(index, 2, patch.major_target_path), patch.major_target_path)
 
         if patch.minor_target_path is None:
             target_minor = createImage(patch.size)
         else:
-            target_minor = Image.open(patch.minor_target_path)
+            target_minor = thresholdTarget(self.openSlot(index, 3, patch.minor_target_path), patch.minor_target_path)
 
-        target_major = target_major.point(lambda p: 255 if p > 50 else 0)
-        target_minor = target_minor.point(lambda p: 255 if p > 50 else 0)
+        return input_pano, input_box, target_major, target_minor
 
-        if self.transform is not None and doTransform:
-            input_pano, input_box, target_major, target_minor = self.transform(input_pano, input_box, target_major, target_minor)
-            
-        input = torch.cat([input_box, input_pano], dim=0)
-        target = torch.cat([target_major, target_minor], dim=0)
+    def openSlot(self, index, slot, path):
+        # patch store references are already memory mapped, only files go through the cache
+        if self.cache is None or isStoreRef(path):
+            return openImage(path)
+        return self.cache.read(index * self.CACHE_SLOTS + slot, path)
+
+    def getAllImgPath(self, index):
+        # an overlay reference is rendered from the patches of the row the first time it is asked for
+        row = {col: '0' if paths[index] is None else paths[index] for col, paths in zip(self.PATH_COLS, self.paths)}
+        return resolveOverlay(row)
+
+    def step(self):
+        # counters and bytes of all workers
+        if self.cache is not None:
+            print('sample cache: {}'.format(dict(self.cache.stats())))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __str__(self):
+        return 'Dataset: {} [size: {}]'.format(self.__class__.__name__, len(self))
+
+
+class ShardSet(Dataset):
+    """
+    samples of a PanoSet read from the shards of tensorshard.py,
+    only the transforms after the deterministic prefix run per sample
+    
+    """
+
+    def __init__(self, dataset, shards, transform):
+        self.dataset = dataset
+        self.shards = shards
+        self.transform = transform
+        self.start = transform.prefixLength()
+
+    def __getitem__(self, index, doTransform=True):
+        sample = self.shards[index]
+        input_pano, input_box, target_major, target_minor = [Image.fromarray(np.array(sample[k]), mode='L') for k in range(4)]
+
+        if doTransform:
+            input_pano, input_box, target_major, target_minor = self.transform(input_pano, input_box, target_major, target_minor, start=self.start)
+
+        input, target = stackSample(input_pano, input_box, target_major, target_minor)
 
-        assert set(np.unique(target)).issubset({0,1})
-      
         return (input, target, index)
 
     def getAllImgPath(self, index):
-        patch = self.data[index]
-        return patch.all_image_path
+        return self.dataset.getAllImgPath(index)
 
     def step(self):
-        pass
+        self.dataset.step()
 
     def __len__(self):
-        return len(self.data)
+        return len(self.shards)
 
     def __str__(self):
-        return 'Dataset: {} [size: {}]'.format(self.__class__.__name__, len(self.data))
+        return 'Dataset: {} [size: {}]'.format(self.__class__.__name__, len(self))
 
 if __name__ == '__main__':
     print(__doc__)
@@ -210,24 +364,20 @@ class PretrainPanoSet(Dataset):
     
     """
 
+    PATH_COLS = ('Pano.Img', 'Target.Img', 'All.Img')
+
     def __init__(self, meta_data_path, filter_func, transform = None):
         
         self.path = meta_data_path
         df = pd.read_csv(self.path)
-        data = []
-
-        for idx, row in df.iterrows():
-            if filter_func(row):
-                pano_path = getAbsoluteAddress(row['Pano.Img'])
-                target_path = getAbsoluteAddress(row['Target.Img'])
-                all_path = getAbsoluteAddress(row['All.Img'])
+        df = df[filter_func.mask(df)]
 
-                data.append(Panorama(pano_path, target_path, all_path))
-        
-        self.data = data
-        self.meta_data = df
+        self.paths = [addressColumn(df, col) for col in self.PATH_COLS]
         self.transform = transform
 
+    def patch(self, index):
+        return Panorama(*[paths[index] for paths in self.paths])
+
     def __getitem__(self, index, doTransform=True):
         """
         
@@ -237,7 +387,7 @@ class PretrainPanoSet(Dataset):
             tuple: (image, target, path, index)
                 target is class_index
         """
-        patch = self.data[index]
+        patch = self.patch(index)
 
         input_pano = Image.open(patch.pano_path)
         input_box = createImage(input_pano.size)
@@ -257,6 +407,89 @@ class PretrainPanoSet(Dataset):
       
         return (input, target, index)
 
+    def __len__(self):
+        return len(self.paths[0])
+
+    def __str__(self):
+        return 'Dataset: {} [size: {}]'.format(self.__class__.__name__, len(self))
+
+
+class Instance(NamedTuple):
+    img_id: int
+    ann_index: int
+
+
+COCO_MARGIN = 0.5
+
+class CocoPanoSet(Dataset):
+    """
+    extended Dataset class for pytorch for pretrain, read from the COCO annotations
+
+    Every person instance is one sample: its window (bbox grown by margin) of the grayscale image,
+    its bbox as the box, its mask as the major target and the other instances as the minor target,
+    all rasterized at the training size. No mask or xml file is written.
+    coco_dir holds instances_(data_type).json and the images (see cocoannot.findImageSource).
+    """
+
+    def __init__(self, coco_dir, data_type, size, transform = None, margin = COCO_MARGIN):
+
+        # pycocotools is only needed for this dataset
+        from cocoannot import loadCoco, buildAnnotIndex, findImageSource
+
+        coco = loadCoco(os.path.join(coco_dir, 'instances_{}.json'.format(data_type)), ['person'])
+        self.annot_index = buildAnnotIndex(coco, coco.getCatIds(catNms=['person']))
+        self.images = {img_id: coco.imgs[img_id] for img_id in self.annot_index}
+        self.image_source = findImageSource(coco_dir, data_type)
+
+        self.data = [Instance(img_id, j) for img_id in sorted(self.annot_index) for j in range(len(self.annot_index[img_id]))]
+        self.size = tuple(size)
+        self.margin = margin
+        self.transform = transform
+
+    def __getitem__(self, index, doTransform=True):
+        """
+        
+        Arguments:
+            index {int} -- index of instance
+        Returns:
+            tuple: (image, target, index)
+        """
+        from cocoannot import instanceWindow, rasterizeSegmentation, rasterizeBox, readImage
+
+        instance = self.data[index]
+        img = self.images[instance.img_id]
+        anns = self.annot_index[instance.img_id]
+        ann = anns[instance.ann_index]
+        img_size = (img['height'], img['width'])
+        window = instanceWindow(ann['bbox'], img_size, self.margin)
+
+        input_pano = readImage(self.image_source, img['file_name']).crop(window)
+        input_pano = input_pano.resize((self.size[1], self.size[0]), Image.BILINEAR)
+        input_box = rasterizeBox(ann['bbox'], window, self.size)
+        target_major = rasterizeSegmentation(ann['segmentation'], img_size, window, self.size)
+
+        target_minor = np.zeros(self.size, dtype=np.uint8)
+        x1, y1, x2, y2 = window
+        for other in anns:
+            ox, oy, ow, oh = other['bbox']
+            if other is ann or ox >= x2 or oy >= y2 or ox + ow <= x1 or oy + oh <= y1:
+                continue
+            target_minor |= rasterizeSegmentation(other['segmentation'], img_size, window, self.size)
+
+        input_box = Image.fromarray(input_box, mode='L')
+        target_major = Image.fromarray(target_major, mode='L')
+        target_minor = Image.fromarray(target_minor, mode='L')
+
+        if self.transform is not None and doTransform:
+            input_pano, input_box, target_major, target_minor = self.transform(input_pano, input_box, target_major, target_minor)
+            
+        input, target = stackSample(input_pano, input_box, target_major, target_minor)
+      
+        return (input, target, index)
+
+    def step(self):
+        pass
+
     def __len__(self):
         return len(self.data)
 
@@ -264,4 +497,4 @@ class PretrainPanoSet(Dataset):
         return 'Dataset: {} [size: {}]'.format(self.__class__.__name__, len(self.data))
 
 if __name__ == '__main__':
-    print(__doc__)
\ No newline at end of file
+    print(__doc__)
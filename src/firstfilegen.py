@@ -1,5 +1,7 @@
 import os
 import sys
+import json
+from collections import OrderedDict
 import pandas as pd
 
 def __main__():
@@ -20,34 +22,107 @@ def makeFirstFile(semiOrNot):
     outFileName = '../data/metadata/DataSet.csv'
     if semiOrNot == 'semi':
         outFileName = '../data/metadata/SemiSet.csv'
+    indexFileName = outFileName[:-4] + '-index.json'
+    changesFileName = outFileName[:-4] + '-changes.json'
 
     valNames = ['T1-Pano-042', 'T1-Pano-062', 'T1-Pano-081', 'T1-Pano-107', 'T1-Pano-111', 'T1-Pano-126', 'T1-Pano-136']
     cols = ['Image.Title', 'Pano.File', 'Xml.File', 'Annot.File', 'Train.Val']
-    rows = []
-
-    for subdir, dirs, files in os.walk(panoDir):
-        for fileName in files:
-            print(fileName)
-            name = fileName[:-4]
-            panoName = panoDir + fileName
-            psdName = psdDir + name + '.psd'
-            xmlName = xmlDir + name + '.xml'
-            trainVal = 'val' if (name in valNames) else 'train'
-            if not os.path.exists(xmlName):
-                print('error: xml does not exist for {}'.format(name))
-                continue
-            if not os.path.exists(psdName):
-                if (semiOrNot == 'semi'):
-                    psdName = -1
-                    trainVal = 'semi'
-                else:
-                    continue
-            rows.append([name, panoName, xmlName, psdName, trainVal])
-
-    outputDf = pd.DataFrame(rows, columns=cols)
-    outputDf.to_csv(outFileName)
 
-    return
+    # each directory is listed once, then joined by file name without extension
+    panoFiles = scanDir(panoDir)
+    psdFiles = scanDir(psdDir, '.psd')
+    xmlFiles = scanDir(xmlDir, '.xml')
+
+    rows = {}
+    index = {}
+
+    for name in sorted(panoFiles):
+        panoName, panoKey = panoFiles[name]
+        trainVal = 'val' if (name in valNames) else 'train'
+        if name not in xmlFiles:
+            print('error: xml does not exist for {}'.format(name))
+            continue
+        xmlName, xmlKey = xmlFiles[name]
+        if name in psdFiles:
+            psdName, psdKey = psdFiles[name]
+        elif (semiOrNot == 'semi'):
+            psdName, psdKey = -1, None
+            trainVal = 'semi'
+        else:
+            continue
+        rows[name] = [name, panoName, xmlName, psdName, trainVal]
+        index[name] = [panoKey, xmlKey, psdKey]
+
+    # rows whose raw files did not change are kept as they are in the previous .csv
+    prevRows, prevIndex = loadFirstFile(outFileName, indexFileName, cols)
+    changes = {'added': [], 'updated': [], 'removed': []}
+    outRows = []
+
+    for name, prevRow in prevRows.items():
+        if name not in rows:
+            changes['removed'].append(name)
+        elif prevIndex.get(name) == index[name]:
+            outRows.append(prevRow)
+        else:
+            changes['updated'].append(name)
+            outRows.append(rows[name])
+
+    for name, row in rows.items():
+        if name not in prevRows:
+            changes['added'].append(name)
+            outRows.append(row)
+
+    for change in ('added', 'updated', 'removed'):
+        for name in changes[change]:
+            print('{}: {}'.format(change, name))
+    print('{} rows: {} added, {} updated, {} removed'.format(len(outRows),
+            len(changes['added']), len(changes['updated']), len(changes['removed'])))
+
+    if len(prevRows) == 0 or any(len(names) > 0 for names in changes.values()):
+        outputDf = pd.DataFrame(outRows, columns=cols)
+        outputDf.to_csv(outFileName)
+
+    with open(indexFileName, 'w') as indexFile:
+        json.dump(index, indexFile)
+
+    # genData only regenerates these panoramas anyway (see its manifest), this is for other consumers
+    with open(changesFileName, 'w') as changesFile:
+        json.dump(changes, changesFile, indent=1)
+
+    return changes
+
+
+def scanDir(dirName, ext=None):
+    # file name without extension -> (path, [mtime, size]) of the files directly in dirName
+    files = {}
+    if not os.path.isdir(dirName):
+        return files
+    for entry in os.scandir(dirName):
+        if not entry.is_file():
+            continue
+        if ext is not None and not entry.name.endswith(ext):
+            continue
+        stat = entry.stat()
+        files[entry.name[:-4]] = (dirName + entry.name, [stat.st_mtime_ns, stat.st_size])
+    return files
+
+
+def loadFirstFile(outFileName, indexFileName, cols):
+    # previous rows by title and the file keys they were made from, empty if there is no previous run
+    prevRows = OrderedDict()
+    prevIndex = {}
+    if not (os.path.exists(outFileName) and os.path.exists(indexFileName)):
+        return (prevRows, prevIndex)
+    try:
+        prevDf = pd.read_csv(outFileName, index_col=0)
+        with open(indexFileName, 'r') as indexFile:
+            prevIndex = json.load(indexFile)
+    except (IOError, ValueError):
+        print('cannot read previous {}, building it again'.format(outFileName))
+        return (OrderedDict(), {})
+    for idx, row in prevDf.iterrows():
+        prevRows[str(row['Image.Title'])] = [row[col] for col in cols]
+    return (prevRows, prevIndex)
 
 if __name__ == '__main__':
     __main__()
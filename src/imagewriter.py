@@ -0,0 +1,132 @@
+'''
+
+background writer for images and other output files
+
+Encoding a jpg and writing it blocks the caller for a few milliseconds per patch.
+ImageWriter hands the writes to a few threads (cv2.imencode releases the GIL), so
+encoding overlaps with the cropping or inference of the caller. A caller that needs
+the pixels a reader of the file will get (like the genData stat) can ask for the
+written bytes decoded again.
+
+'''
+
+import os
+import threading
+import queue
+import numpy as np
+import cv2
+
+WRITER_THREADS = 4
+MAX_PENDING = 64
+
+
+class ImageWriter():
+    """Bounded pool of writer threads
+
+    write() blocks while MAX_PENDING jobs are waiting, so a fast producer cannot fill the memory
+    with pending images. The first failed write is raised again by the next write(), flush() or close().
+    A caller that fails before its flush() drains the writer, so its errors do not surface in the next file.
+
+    Arguments:
+        threads {int} -- number of writer threads
+        maxPending {int} -- number of jobs queued before write() blocks
+    """
+
+    def __init__(self, threads=WRITER_THREADS, maxPending=MAX_PENDING):
+        self.jobs = queue.Queue(maxsize=maxPending)
+        self.error = None
+        self.errorLock = threading.Lock()
+        self.threads = []
+
+        for i in range(threads):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                with self.errorLock:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _raiseError(self):
+        with self.errorLock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def submit(self, func, *args):
+        # func(*args) runs on a writer thread, args must not be modified afterwards
+        self._raiseError()
+        self.jobs.put((func, args))
+
+    def write(self, fileName, img, decoded=None):
+        # img is copied, the caller may keep drawing on it
+        # decoded, if given, is a list that gets the written file decoded as grayscale, once flushed
+        self.submit(_imwrite, fileName, np.array(img, copy=True), decoded)
+
+    def flush(self):
+        # waits until every submitted job is written
+        self.jobs.join()
+        self._raiseError()
+
+    def drain(self):
+        # like flush(), but returns the error instead of raising it, for the cleanup after a failed panorama
+        self.jobs.join()
+        with self.errorLock:
+            error, self.error = self.error, None
+        return error
+
+    def close(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self._raiseError()
+
+
+def _imwrite(fileName, img, decoded=None):
+    # the same bytes cv2.imwrite would write
+    ok, encoded = cv2.imencode(os.path.splitext(fileName)[1], img)
+    if not ok:
+        raise IOError('cannot encode image {}'.format(fileName))
+    with open(fileName, 'wb') as imgFile:
+        imgFile.write(encoded.tobytes())
+    if decoded is not None:
+        decoded.append(cv2.imdecode(encoded, cv2.IMREAD_GRAYSCALE))
+
+
+_writers = {}
+
+def getImageWriter():
+    # one writer per process, threads do not survive a fork
+    pid = os.getpid()
+    if pid not in _writers:
+        _writers[pid] = ImageWriter()
+    return _writers[pid]
+
+
+def pendingWriteError(error):
+    """Waits for the writes of a failed panorama, so they are not blamed on the next one
+
+    Arguments:
+        error {string} -- traceback of the failure
+
+    Returns:
+        string -- error, with the failed pending write if any
+    """
+    pending = getImageWriter().drain()
+    if pending is not None:
+        error += 'pending write failed: {!r}\n'.format(pending)
+    return error
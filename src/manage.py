@@ -1,8 +1,10 @@
 '''
 
-python3 manage.py genData (marginType) (inputFileName)
+python3 manage.py genData (marginType[,marginType...]) (inputFileName) [--jobs N] [--force] [--store]
 
-python3 manage.py genStat (fileName)
+python3 manage.py genStat (fileName) [--jobs N] [--force]
+
+python3 manage.py genOverlay (fileName) [--rows start:end] [--name regex] [--force]
 
 
 '''
@@ -13,37 +15,63 @@ import pandas as pd
 import xml.etree.ElementTree as et
 import numpy as np
 import cv2
-from psd_tools import PSDImage
 import time
 import datetime
 import copy
 import re
 import math
+import multiprocessing
+import traceback
+import json
+import hashlib
+from annotation import AnnotIndex, ToothMask
+from psdcache import loadPsdLayers
+from patchstore import getPatchStoreWriter, closePatchStoreWriter, dropUnreferencedShards, isStoreRef, storeRefExists, readPatchImage
+from overlay import overlayRef, resolveOverlay
+from imagewriter import getImageWriter, pendingWriteError
+from stagetimer import NULL_TIMER
+from cliutil import popOption, popFlag
 
 
 def __main__():
     
     if len(sys.argv) < 2:
         print('need to input commands\n',
-                'genData (marginType) (inputFileName), or\n',
-                'genStat (fileName)')
+                'genData (marginType[,marginType...]) (inputFileName) [--jobs N] [--force] [--store], or\n',
+                'genStat (fileName) [--jobs N] [--force], or\n',
+                'genOverlay (fileName) [--rows start:end] [--name regex] [--force]')
         return
     
     command = str(sys.argv[1])
+    args = list(sys.argv)
     
     if command == "genData":
-        if len(sys.argv) != 4:
+        jobs = int(popOption(args, '--jobs', 1))
+        force = popFlag(args, '--force')
+        store = popFlag(args, '--store')
+        if len(args) != 4:
             print('need to input marginType and inputFileName\n')
             return
-        marginType = int(sys.argv[2])
-        inputFileName = str(sys.argv[3])
-        generateDataset(marginType, inputFileName)
+        marginTypes = [int(m) for m in args[2].split(',')]
+        inputFileName = str(args[3])
+        generateDataset(marginTypes, inputFileName, jobs, force, store)
     elif command == "genStat":
-        if len(sys.argv) != 3:
+        jobs = int(popOption(args, '--jobs', 1))
+        force = popFlag(args, '--force')
+        if len(args) != 3:
+            print('need to input fileName\n')
+            return
+        fileName = str(args[2])
+        calcStat(fileName, jobs, force)
+    elif command == "genOverlay":
+        rows = popOption(args, '--rows', None)
+        name = popOption(args, '--name', None)
+        force = popFlag(args, '--force')
+        if len(args) != 3:
             print('need to input fileName\n')
             return
-        fileName = str(sys.argv[2])
-        calcStat(fileName)
+        fileName = str(args[2])
+        genOverlay(fileName, rows, name, force)
     else:
         print('need to type in command')
 
@@ -55,8 +83,19 @@ def __main__():
 #######################
 
 
-def generateDataset(marginType, inputFileName):
+OUT_COLS = ['Name', 'Cropped.Pano.Img', 'Cropped.Box.Img', 'Cropped.Major.Annot.Img', 'Cropped.Minor.Annot.Img',
+        'Left.Upmost.Coord', 'Cropped.Img.Size', 'Tooth.Num.Panoseg', 'Tooth.Num.Major.Annot', 'Tooth.Num.Minor.Annot',
+        'Max.Teeth.IOU', '2nd.Max.Teeth.IOU', 'Max.Box.IOU', '2nd.Max.Box.IOU', 'Margin.Type', 'Segmentable.Type',
+        'Major.Target.Img', 'Minor.Target.Img', 'All.Img', 'Train.Val']
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+def generateDataset(marginTypes, inputFileName, jobs=1, force=False, store=False):
     
+    if not isinstance(marginTypes, (list, tuple)):
+        marginTypes = [marginTypes]
+
     try:
         inputDf = pd.read_csv(inputFileName)
     except IOError:
@@ -73,35 +112,189 @@ def generateDataset(marginType, inputFileName):
 
     # timestamp = datetime.datetime.fromtimestamp(time.mktime(time.localtime())).strftime('%Y%m%d%H%M%S')
     # TODO: should extract inputFileName from route using regex
-    outputFormat = inputFileName[17:-4] + '-' + str(marginType)
-    outImgPath = '../data/metadata/' + outputFormat + '/'
-    outCsvFileName = '../data/metadata/' + outputFormat + '.csv'
-    if (os.path.exists(outImgPath)):
-        print('directory already exists for outImgPath' + outImgPath)
-        # return
+    outImgPaths = {}
+    outCsvFileNames = {}
+    for marginType in marginTypes:
+        outputFormat = inputFileName[17:-4] + '-' + str(marginType)
+        outImgPaths[marginType] = '../data/metadata/' + outputFormat + '/'
+        outCsvFileNames[marginType] = '../data/metadata/' + outputFormat + '.csv'
+        if (os.path.exists(outImgPaths[marginType])):
+            print('directory already exists for outImgPath' + outImgPaths[marginType])
+            # return
+        else:
+            os.mkdir(outImgPaths[marginType])
+
+        print('outputRoute: {}'.format(outputFormat))
+
+    # panoramas whose inputs did not change since the last run are taken from the manifest,
+    # the others are decoded once and generate every stale margin type together
+    manifests = {m: ({} if force else loadManifest(outImgPaths[m] + MANIFEST_NAME)) for m in marginTypes}
+    rowsByFile = {m: [None] * rowNum for m in marginTypes}
+    statsByFile = {m: [None] * rowNum for m in marginTypes}
+    failedTitles = []
+    tasks = []
+
+    for idx, (rowIdx, row) in enumerate(inputDf.iterrows()):
+        row = row.to_dict()
+        staleMargins = []
+        inputKeys = []
+        for marginType in marginTypes:
+            inputKey = getInputKey(row, marginType, store)
+            entry = manifests[marginType].get(str(row['Image.Title']))
+            if entry is not None and entry['key'] == inputKey and outputsExist(entry['rows']):
+                rowsByFile[marginType][idx] = entry['rows']
+                # entries written before stats were taken from the written patches are scanned once instead
+                statsByFile[marginType][idx] = DatasetStat.fromDict(entry['patchStat']) if 'patchStat' in entry else DatasetStat.fromRows(entry['rows'])
+                continue
+            staleMargins.append(marginType)
+            inputKeys.append(inputKey)
+        if len(staleMargins) > 0:
+            tasks.append((idx, inputKeys, staleMargins, [outImgPaths[m] for m in staleMargins], row, store))
+
+    print('{} panoramas are up to date, {} to generate'.format(rowNum - len(tasks), len(tasks)))
+
+    # results come back in any order and are put back to the input order below
+    if jobs > 1:
+        print('generating with {} workers'.format(jobs))
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.imap_unordered(_generateDatasetWorker, tasks)
     else:
-        os.mkdir(outImgPath)
+        pool = None
+        results = map(_generateDatasetWorker, tasks)
+
+    manifestFiles = {m: open(outImgPaths[m] + MANIFEST_NAME, 'a') for m in marginTypes}
+    try:
+        for idx, inputKeys, staleMargins, imageTitle, outRowsList, stats, error in results:
+            if error is not None:
+                print('failed to generate dataset for {}\n{}'.format(imageTitle, error))
+                failedTitles.append(imageTitle)
+                continue
+            for marginType, inputKey, outRows, stat in zip(staleMargins, inputKeys, outRowsList, stats):
+                rowsByFile[marginType][idx] = appendManifest(manifestFiles[marginType], imageTitle, inputKey, outRows, stat)
+                statsByFile[marginType][idx] = stat
+    finally:
+        for manifestFile in manifestFiles.values():
+            manifestFile.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for marginType in marginTypes:
+        closePatchStoreWriter(outImgPaths[marginType] + 'store/')
+
+    if len(failedTitles) > 0:
+        print('{} panoramas failed: {}'.format(len(failedTitles), failedTitles))
+
+    for marginType in marginTypes:
+        rows = [outRow for outRows in rowsByFile[marginType] if outRows is not None for outRow in outRows]
+        outputDf = pd.DataFrame(rows, columns=OUT_COLS)
+        outputDf.to_csv(outCsvFileNames[marginType], encoding='utf-8')
+
+        # shards left by the panoramas that were generated again (or failed) hold no row of the .csv any more
+        removed = dropUnreferencedShards(outImgPaths[marginType] + 'store/', (v for outRow in rows for v in outRow))
+        if removed > 0:
+            print('removed {:.1f} MB of unreferenced store shards'.format(removed / (1 << 20)))
+
+        # the stat of the whole dataset is merged from the per panorama stats, genStat reads it back
+        stat = DatasetStat()
+        for fileStat in statsByFile[marginType]:
+            if fileStat is not None:
+                stat.merge(fileStat)
+        stat.save(getStatFileName(outCsvFileNames[marginType]))
+        print('stat for margin type {}'.format(marginType))
+        stat.report()
 
-    print('outputRoute: {}'.format(outputFormat))
+    return
 
-    outCols = ['Name', 'Cropped.Pano.Img', 'Cropped.Box.Img', 'Cropped.Major.Annot.Img', 'Cropped.Minor.Annot.Img',
-            'Left.Upmost.Coord', 'Cropped.Img.Size', 'Tooth.Num.Panoseg', 'Tooth.Num.Major.Annot', 'Tooth.Num.Minor.Annot',
-            'Max.Teeth.IOU', '2nd.Max.Teeth.IOU', 'Max.Box.IOU', '2nd.Max.Box.IOU', 'Margin.Type', 'Segmentable.Type',
-            'Major.Target.Img', 'Minor.Target.Img', 'All.Img', 'Train.Val']
-    rows = []
 
-    for idx, row in inputDf.iterrows():
-        rows.extend(generateDatasetForEachFile(marginType, outImgPath, row))
-   
-    outputDf = pd.DataFrame(rows, columns=outCols)
-    outputDf.to_csv(outCsvFileName, encoding='utf-8')
+def _generateDatasetWorker(task):
+    # catches every error so that one broken panorama does not abort the whole build
+    idx, inputKeys, marginTypes, outImgPaths, row, store = task
+    imageTitle = str(row['Image.Title'])
+    try:
+        stats = [DatasetStat() for marginType in marginTypes]
+        outRowsList = generateDatasetForEachFileMargins(marginTypes, outImgPaths, row, store, stats)
+        return (idx, inputKeys, marginTypes, imageTitle, outRowsList, stats, None)
+    except Exception:
+        return (idx, inputKeys, marginTypes, imageTitle, [], [], pendingWriteError(traceback.format_exc()))
+
+
+def getInputKey(row, marginType, store=False):
+    # changes whenever one of the raw inputs, the margin or the output format changes
+    parts = [str(marginType), str(MARGIN_LISTS[marginType]), 'store' if store else 'jpg']
+    for col in ('Pano.File', 'Xml.File', 'Annot.File'):
+        parts.append(_fileKey(row[col]))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _fileKey(fileName):
+    fileName = str(fileName)
+    if os.path.isdir(fileName):
+        return ','.join(_fileKey(os.path.join(fileName, f)) for f in sorted(os.listdir(fileName)))
+    if not os.path.exists(fileName):
+        return fileName + ':missing'
+    stat = os.stat(fileName)
+    return '{}:{}:{}'.format(fileName, stat.st_mtime_ns, stat.st_size)
+
+
+def loadManifest(manifestFileName):
+    # one json line per generated panorama, the last line of a title wins
+    manifest = {}
+    if not os.path.exists(manifestFileName):
+        return manifest
+    validSize = 0
+    with open(manifestFileName, 'rb') as manifestFile:
+        for line in manifestFile:
+            try:
+                entry = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # a line cut by an interrupted run, drop it and everything after
+                break
+            manifest[entry['title']] = entry
+            validSize += len(line)
+    if validSize < os.path.getsize(manifestFileName):
+        with open(manifestFileName, 'r+b') as manifestFile:
+            manifestFile.truncate(validSize)
+    return manifest
+
+
+def appendManifest(manifestFile, imageTitle, inputKey, outRows, stat=None):
+    # tuples are stored the way to_csv writes them, so cached and fresh rows look the same
+    outRows = [[str(v) if isinstance(v, tuple) else v for v in outRow] for outRow in outRows]
+    entry = {'title': imageTitle, 'key': inputKey, 'rows': outRows}
+    if stat is not None:
+        entry['patchStat'] = stat.toDict()
+    manifestFile.write(json.dumps(entry, default=lambda v: v.item()) + '\n')
+    manifestFile.flush()
+    return outRows
+
+
+def outputsExist(outRows):
+    panoCol = OUT_COLS.index('Cropped.Pano.Img')
+    for outRow in outRows:
+        panoName = outRow[panoCol]
+        if not (storeRefExists(panoName) if isStoreRef(panoName) else os.path.exists(panoName)):
+            return False
+    return True
 
-    return
 
+def generateDatasetForEachFile(marginType, outImgPath, row, store=False, stat=None, timer=NULL_TIMER):
+    return generateDatasetForEachFileMargins([marginType], [outImgPath], row, store,
+            None if stat is None else [stat], timer)[0]
 
-def generateDatasetForEachFile(marginType, outImgPath, row):
 
-    outRows = []
+def generateDatasetForEachFileMargins(marginTypes, outImgPaths, row, store=False, stats=None, timer=NULL_TIMER):
+    # decodes the inputs and computes the IoUs once, then crops every margin type from that state
+    # stats, if given, is a DatasetStat per margin type updated with every written patch,
+    # as it reads back from the jpg, so it equals a genStat scan of the .csv
+    # timer, if given, is a StageTimer that gets the time of every stage
+
+    outRowsList = [[] for marginType in marginTypes]
+    storeWriters = [getPatchStoreWriter(outImgPath + 'store/') if store else None for outImgPath in outImgPaths]
+    if stats is None:
+        stats = [None] * len(marginTypes)
+    # (stat, decoded pano, decoded box, major target, minor target) of every row, applied once flushed
+    statUpdates = []
 
     print('row: {}'.format(row))
     imageTitle = str(row['Image.Title'])
@@ -114,18 +307,25 @@ def generateDatasetForEachFile(marginType, outImgPath, row):
     if doAnnot and not (annotFileName[-3:] == 'psd'):
         isAnnotDir = True
 
-    panoImg = cv2.flip(cv2.imread(panoFileName, cv2.IMREAD_GRAYSCALE), 0)
+    with timer.stage('pano'):
+        panoImg = cv2.flip(cv2.imread(panoFileName, cv2.IMREAD_GRAYSCALE), 0)
     imgShape = panoImg.shape
 
     annotImgs = None
-    if doAnnot and not isAnnotDir:
-        annotPsd = PSDImage.load(annotFileName)
-        annotImgs = extractImgsFromPsd(annotPsd, imgShape) # flipped
-    elif isAnnotDir:
-        annotImgs = extractImgsFromDir(annotFileName, imgShape)
+    annotIndex = None
+    with timer.stage('annot'):
+        if doAnnot and not isAnnotDir:
+            annotImgs = extractImgsFromPsd(annotFileName, imgShape) # flipped
+        elif isAnnotDir:
+            annotImgs = extractImgsFromDir(annotFileName, imgShape)
+
+        if annotImgs is not None:
+            # layer areas, bounds and the label map do not depend on the box, build them once per panorama
+            annotIndex = AnnotIndex(annotImgs)
 
     # XML Parsing
-    root = et.parse(xmlFileName).getroot()
+    with timer.stage('xml'):
+        root = et.parse(xmlFileName).getroot()
 
     for tooth in root.iter('Tooth'):
 
@@ -133,115 +333,137 @@ def generateDatasetForEachFile(marginType, outImgPath, row):
         toothNum = str(tooth.attrib['Number'])
         thisTitle = imageTitle + '-' + str(toothNum)
         coords = genCoordsFromTooth(tooth)
-        
-        cropPanoImg = cv2.copyMakeBorder(panoImg, 0, 0, 0, 0, cv2.BORDER_REPLICATE) # flipped
-        leftMostCoor, cropPanoImg = cropImageWithMargin(cropPanoImg, coords, marginType, imgShape)
-        cropPanoImg = cv2.flip(cropPanoImg, 0) # unflip
 
-        print('img size: {} for coords: {}'.format(cropPanoImg.shape, coords))
+        # everything below works inside the union of the crop windows, the box never exceeds any of them
+        windows = [getMarginRect(coords, marginType, imgShape) for marginType in marginTypes]
+        ux1, uy1 = min(w[0] for w in windows), min(w[1] for w in windows)
+        ux2, uy2 = max(w[2] for w in windows), max(w[3] for w in windows)
+        unionWindow = (ux1, uy1, ux2, uy2)
 
-        boxImg = np.zeros(imgShape, dtype=np.uint8)
-        boxImg = genBoxImage(boxImg, coords) # flipped
-        leftMostCoor, cropBoxImg = cropImageWithMargin(boxImg, coords, marginType, imgShape)
-        cropBoxImg = cv2.flip(cropBoxImg, 0) # unflip
-        
-        # Leave it for debugging usage
-        inputImg = cv2.copyMakeBorder(cropPanoImg, 0, 0, 0, 0, cv2.BORDER_REPLICATE)
-        cv2.addWeighted(cv2.add(cropPanoImg, cropBoxImg), 0.2, inputImg, 0.8, 0, inputImg)
+        with timer.stage('raster'):
+            boxImg = np.zeros(panoImg[uy1:uy2, ux1:ux2].shape, dtype=np.uint8)
+            boxImg = genBoxImage(boxImg, [[x - ux1, y - uy1] for x, y in coords]) # flipped
 
-        if not doAnnot:
+        if doAnnot:
+            with timer.stage('iou'):
+                maxIOU, sndMaxIOU, fstBoxIOU, sndBoxIOU, majorToothNum, majorAnnotImg, minorToothNum, minorAnnotImg = genAnnotImages(annotIndex, boxImg, unionWindow) # flipped
 
-            cpiName = outImgPath + 'cropPanoImg' + '-' + thisTitle + '.jpg'
-            cbiName = outImgPath + 'cropBoxImg' + '-' + thisTitle + '.jpg'
+                segType = decideSegType(maxIOU, sndMaxIOU, fstBoxIOU)
+                majorTargetFlag = decideTargetFlag(maxIOU)
+                minorTargetFlag = decideTargetFlag(sndMaxIOU)
 
-            cv2.imwrite(cpiName, cropPanoImg)
-            cv2.imwrite(cbiName, cropBoxImg)
+        for marginType, outImgPath, outRows, window, storeWriter, stat in zip(marginTypes, outImgPaths, outRowsList, windows, storeWriters, stats):
 
-            newRow = [thisTitle, cpiName, cbiName, -1, -1, leftMostCoor, cropPanoImg.shape, toothNum,
-                    -1, -1, -1, -1, -1, -1, marginType, -1, -1, -1, -1, row['Train.Val']]
-            outRows.append(newRow)
+            x1, y1, x2, y2 = window
+            leftMostCoor = (x1, y1)
+            local = (slice(y1 - uy1, y2 - uy1), slice(x1 - ux1, x2 - ux1))
 
-            continue
+            cropPanoImg = cv2.flip(panoImg[y1:y2, x1:x2], 0) # unflip
 
-        maxIOU, sndMaxIOU, fstBoxIOU, sndBoxIOU, majorToothNum, majorAnnotImg, minorToothNum, minorAnnotImg = genAnnotImages(annotImgs, boxImg, imgShape) # flipped
-        leftMostCoor, cropMajorAnnotImg = cropImageWithMargin(majorAnnotImg, coords, marginType, imgShape)
-        cropMajorAnnotImg = cv2.flip(cropMajorAnnotImg, 0) # unflip
-        leftMostCoor, cropMinorAnnotImg = cropImageWithMargin(minorAnnotImg, coords, marginType, imgShape)
-        cropMinorAnnotImg = cv2.flip(cropMinorAnnotImg, 0) # unflip
-
-        segType = decideSegType(maxIOU, sndMaxIOU, fstBoxIOU)
-        majorTargetFlag = decideTargetFlag(maxIOU)
-        minorTargetFlag = decideTargetFlag(sndMaxIOU)
-        majorTargetImg = np.zeros(cropMajorAnnotImg.shape, dtype = np.uint8) if not majorTargetFlag else cropMajorAnnotImg
-        minorTargetImg = np.zeros(cropMinorAnnotImg.shape, dtype = np.uint8) if not minorTargetFlag else cropMinorAnnotImg
-
-        allImg = cv2.copyMakeBorder(inputImg, 0, 0, 0, 0, cv2.BORDER_REPLICATE)
-        cv2.addWeighted(cv2.add(inputImg, cv2.add(majorTargetImg, minorTargetImg)), 0.6, allImg, 0.4, 0, allImg)
-
-        # TODO: Wrong tooth number check?
-
-        # TODO: calculate imageTitle from panoFileName and delete imageTitle column from .csv
-        cpiName = outImgPath + 'cropPanoImg' + '-' + thisTitle + '.jpg'
-        cbiName = outImgPath + 'cropBoxImg' + '-' + thisTitle + '.jpg'
-        macaiName = outImgPath + 'cropAnnotMajorImg' + '-' + thisTitle + '.jpg'
-        micaiName = outImgPath + 'cropAnnotMinorImg' + '-' + thisTitle + '.jpg'
-        matiName = 0 if not majorTargetFlag else re.sub('cropPanoImg', 'targetMajorImg', cpiName)
-        mitiName = 0 if not minorTargetFlag else re.sub('cropPanoImg', 'targetMinorImg', cpiName)
-        aiName = re.sub('cropPanoImg', 'allImg', cpiName)
-
-        # export images
-        cv2.imwrite(cpiName, cropPanoImg)
-        cv2.imwrite(cbiName, cropBoxImg)
-        cv2.imwrite(macaiName, cropMajorAnnotImg)
-        cv2.imwrite(micaiName, cropMinorAnnotImg)
-        if majorTargetFlag:
-            cv2.imwrite(matiName, cropMajorAnnotImg)
-        if minorTargetFlag:
-            cv2.imwrite(mitiName, cropMinorAnnotImg)
-        cv2.imwrite(aiName, allImg)
-
-        # write row for .csv
-        newRow = [thisTitle, cpiName, cbiName, macaiName, micaiName, leftMostCoor, cropPanoImg.shape, toothNum,
-                majorToothNum, minorToothNum, maxIOU, sndMaxIOU, fstBoxIOU, sndBoxIOU, marginType,
-                segType, matiName, mitiName, aiName, row['Train.Val']]
-        outRows.append(newRow)
+            print('img size: {} for coords: {}'.format(cropPanoImg.shape, coords))
 
-    return outRows
+            cropBoxImg = cv2.flip(boxImg[local], 0) # unflip
 
+            if not doAnnot:
 
-# This function returns flipped imgs
-def extractImgsFromPsd(annotPsd, imgShape):
+                cpiName = outImgPath + 'cropPanoImg' + '-' + thisTitle + '.jpg'
+                cbiName = outImgPath + 'cropBoxImg' + '-' + thisTitle + '.jpg'
 
-    annotImgs = {}
+                decodedPano, decodedBox = ([], []) if stat is not None else (None, None)
+                with timer.stage('encode'):
+                    cpiName = writePatch(cpiName, cropPanoImg, storeWriter, decoded=decodedPano)
+                    cbiName = writePatch(cbiName, cropBoxImg, storeWriter, decoded=decodedBox)
 
-    for layer in annotPsd.layers:
+                newRow = [thisTitle, cpiName, cbiName, -1, -1, leftMostCoor, cropPanoImg.shape, toothNum,
+                        -1, -1, -1, -1, -1, -1, marginType, -1, -1, -1, -1, row['Train.Val']]
+                outRows.append(newRow)
+                timer.count('patches', 2)
+                if stat is not None:
+                    statUpdates.append((stat, decodedPano, decodedBox, -1, -1))
 
-        if layer is None or layer.bbox == (0, 0, 0, 0):
-            continue
+                continue
 
-        layerImg = np.array(layer.as_PIL())
+            cropMajorAnnotImg = cv2.flip(majorAnnotImg[local], 0) # unflip
+            cropMinorAnnotImg = cv2.flip(minorAnnotImg[local], 0) # unflip
 
-        # get alpha channel from png and convert to grayscale
-        if (layerImg.shape[-1] != 4):
-            # Then this is background image
-            continue
+            # TODO: Wrong tooth number check?
 
-        r, g, b, a = cv2.split(layerImg)
-        layerImg = cv2.merge([a, a, a])
-        layerImg = cv2.cvtColor(layerImg, cv2.COLOR_BGR2GRAY)
-        ret, layerImg = cv2.threshold(layerImg, 200, 255, cv2.THRESH_BINARY)
+            # TODO: calculate imageTitle from panoFileName and delete imageTitle column from .csv
+            cpiName = outImgPath + 'cropPanoImg' + '-' + thisTitle + '.jpg'
+            cbiName = outImgPath + 'cropBoxImg' + '-' + thisTitle + '.jpg'
+            macaiName = outImgPath + 'cropAnnotMajorImg' + '-' + thisTitle + '.jpg'
+            micaiName = outImgPath + 'cropAnnotMinorImg' + '-' + thisTitle + '.jpg'
+            matiName = 0 if not majorTargetFlag else re.sub('cropPanoImg', 'targetMajorImg', cpiName)
+            mitiName = 0 if not minorTargetFlag else re.sub('cropPanoImg', 'targetMinorImg', cpiName)
+            # the debug overlay is rendered on demand by genOverlay
+            aiName = overlayRef(re.sub('cropPanoImg', 'allImg', cpiName))
+
+            # export images
+            decodedPano, decodedBox = ([], []) if stat is not None else (None, None)
+            with timer.stage('encode'):
+                cpiName = writePatch(cpiName, cropPanoImg, storeWriter, decoded=decodedPano)
+                cbiName = writePatch(cbiName, cropBoxImg, storeWriter, decoded=decodedBox)
+                macaiName = writePatch(macaiName, cropMajorAnnotImg, storeWriter, isMask=True)
+                micaiName = writePatch(micaiName, cropMinorAnnotImg, storeWriter, isMask=True)
+                if majorTargetFlag:
+                    matiName = writePatch(matiName, cropMajorAnnotImg, storeWriter, isMask=True)
+                if minorTargetFlag:
+                    mitiName = writePatch(mitiName, cropMinorAnnotImg, storeWriter, isMask=True)
+
+            # write row for .csv
+            newRow = [thisTitle, cpiName, cbiName, macaiName, micaiName, leftMostCoor, cropPanoImg.shape, toothNum,
+                    majorToothNum, minorToothNum, maxIOU, sndMaxIOU, fstBoxIOU, sndBoxIOU, marginType,
+                    segType, matiName, mitiName, aiName, row['Train.Val']]
+            outRows.append(newRow)
+            timer.count('patches', 4 + int(majorTargetFlag) + int(minorTargetFlag))
+            if stat is not None:
+                statUpdates.append((stat, decodedPano, decodedBox, matiName, mitiName))
+
+    # patches must be on disk before the manifest records the rows
+    with timer.stage('encode'):
+        for storeWriter in storeWriters:
+            if storeWriter is not None:
+                storeWriter.flush()
+        getImageWriter().flush()
+
+    # in row order, like the scan
+    with timer.stage('stat'):
+        for stat, decodedPano, decodedBox, majorTarget, minorTarget in statUpdates:
+            stat.update(decodedPano[0], decodedBox[0], majorTarget, minorTarget)
+
+    return outRowsList
+
+
+def writePatch(fileName, img, storeWriter=None, isMask=False, decoded=None):
+    # returns what the .csv should reference: the jpg file, or the patch in the store
+    # decoded, if given, is a list that gets the patch as readPatchImage will read it, once flushed
+    if storeWriter is None:
+        # encoded and written in the background, flushed once per panorama
+        getImageWriter().write(fileName, img, decoded)
+        return fileName
+    if isMask:
+        # stored losslessly, so the binarization PanoSet did on jpgs happens once here
+        img = np.where(img > 50, 255, 0).astype(np.uint8)
+    if decoded is not None:
+        decoded.append(img)
+    return storeWriter.write(os.path.basename(fileName)[:-4], img)
+
+
+# This function returns flipped ToothMasks
+def extractImgsFromPsd(annotFileName, imgShape):
 
-        annotImg = np.zeros(imgShape, dtype=np.uint8)
-        b1, b2 = layer.bbox.y1, layer.bbox.y2
-        b3, b4 = layer.bbox.x1, layer.bbox.x2
-        annotImg[b1:b2, b3:b4] = layerImg
-        annotImg = cv2.flip(annotImg, 0) # flip
-        annotImgs[layer.name.strip()] = annotImg
+    annotImgs = {}
+
+    # decoded layers come from the psd cache after the first run
+    for name, bound, layerMask in loadPsdLayers(annotFileName):
+
+        annotImg = ToothMask(bound, layerMask.astype(np.uint8) * 255)
+        annotImgs[name] = annotImg.flip(imgShape).pack() # flip
 
     return annotImgs
 
 
-# This function returns flipped imgs
+# This function returns flipped ToothMasks
 def extractImgsFromDir(annotDir, imgShape):
 
     annotImgs = {}
@@ -251,7 +473,8 @@ def extractImgsFromDir(annotDir, imgShape):
             print(fileName)
             annotImg = cv2.flip(cv2.imread(annotDir + fileName, cv2.IMREAD_GRAYSCALE), 0)
             name = re.sub('Target-(\d+).jpg', '\\1', fileName)
-            annotImgs[name] = annotImg
+            # jpg masks are not binary, so they stay unpacked
+            annotImgs[name] = ToothMask.fromImage(annotImg)
 
     return annotImgs
 
@@ -281,7 +504,8 @@ def genBoxImage(img, coords):
     return img
 
 
-def genAnnotImages(annotImgs, boxImg, imgShape):
+# boxImg and the returned annotation imgs are cropped to window = (x1, y1, x2, y2)
+def genAnnotImages(annotIndex, boxImg, window):
 
     maxIOU = 0
     sndMaxIOU = 0
@@ -289,16 +513,17 @@ def genAnnotImages(annotImgs, boxImg, imgShape):
     sndBoxIOU = 0
 
     maxIOULayerName = 0
-    maxIOULayerImg = np.zeros(imgShape, dtype=np.uint8)
+    maxIOULayerIdx = -1
     sndMaxIOULayerName = 0
-    sndMaxIOULayerImg = np.zeros(imgShape, dtype=np.uint8)
+    sndMaxIOULayerIdx = -1
 
-    for name, annotImg in annotImgs.items():
+    boxArea = np.sum(boxImg == 255)
+    intersectionAreas = annotIndex.intersectionAreas(boxImg, window)
 
-        intersectionImg = cv2.bitwise_and(annotImg, boxImg)
-        intersectionArea = np.sum(intersectionImg == 255)
-        teethArea = np.sum(annotImg == 255)
-        boxArea = np.sum(boxImg == 255)
+    for idx, name in enumerate(annotIndex.names):
+
+        intersectionArea = intersectionAreas[idx]
+        teethArea = annotIndex.areas[idx]
         thisIOU = intersectionArea / teethArea
         thisBoxIOU = intersectionArea / boxArea
 
@@ -310,19 +535,26 @@ def genAnnotImages(annotImgs, boxImg, imgShape):
             sndMaxIOU = maxIOU
             sndBoxIOU = fstBoxIOU
             sndMaxIOULayerName = maxIOULayerName
-            sndMaxIOULayerImg = maxIOULayerImg
+            sndMaxIOULayerIdx = maxIOULayerIdx
 
             maxIOU = thisIOU
             fstBoxIOU = thisBoxIOU
             maxIOULayerName = name
-            maxIOULayerImg = annotImg
+            maxIOULayerIdx = idx
 
         elif (sndMaxIOU < thisIOU):
 
             sndMaxIOU = thisIOU
             sndBoxIOU = thisBoxIOU
             sndMaxIOULayerName = name
-            sndMaxIOULayerImg = annotImg
+            sndMaxIOULayerIdx = idx
+
+    maxIOULayerImg = np.zeros(boxImg.shape, dtype=np.uint8)
+    if maxIOULayerIdx >= 0:
+        maxIOULayerImg = annotIndex.layerImg(maxIOULayerIdx, window)
+    sndMaxIOULayerImg = np.zeros(boxImg.shape, dtype=np.uint8)
+    if sndMaxIOULayerIdx >= 0:
+        sndMaxIOULayerImg = annotIndex.layerImg(sndMaxIOULayerIdx, window)
 
     return (maxIOU, sndMaxIOU, fstBoxIOU, sndBoxIOU, maxIOULayerName, maxIOULayerImg, sndMaxIOULayerName, sndMaxIOULayerImg)
 
@@ -358,16 +590,21 @@ def genCoordsFromTooth(tooth):
     # return [[int(coord.attrib['X']), int(coord.attrib['Y'])]] for coord in tooth]
 
 
+# [left, right, top, bottom] margins for each marginType
+MARGIN_LISTS = {1: [40, 40, 40, 40], 2: [50, 50, 80, 80], 3: [80, 80, 80, 80],
+        4: [60, 60, 100, 100], 5: [100, 100, 100, 100], 6: [200, 200, 200, 200],
+        7: [400, 400, 400, 400], 8: [60, 60, 120, 120], 9: [70, 70, 150, 150],
+        10: [100, 100, 150, 150]}
+
+
 def cropImageWithMargin(img, coords, marginType, imgShape):
-    marginFuns = {1: _cropImageWithMargin1, 2: _cropImageWithMargin2, 3: _cropImageWithMargin3,
-            4: _cropImageWithMargin4, 5: _cropImageWithMargin5, 6: _cropImageWithMargin6,
-            7: _cropImageWithMargin7, 8: _cropImageWithMargin8, 9: _cropImageWithMargin9,
-            10: _cropImageWithMargin10}
-    return marginFuns[marginType](img, coords, imgShape)
+    x1, y1, x2, y2 = getMarginRect(coords, marginType, imgShape)
+    return ((x1, y1), img[y1:y2, x1:x2])
 
 
-def __cropImageWithSimpleMargin(img, coords, marginList, imgShape):
+def getMarginRect(coords, marginType, imgShape):
 
+    marginList = MARGIN_LISTS[marginType]
     x1, x2, y1, y2 = 5000, 0, 5000, 0
 
     for coord in coords:
@@ -388,47 +625,131 @@ def __cropImageWithSimpleMargin(img, coords, marginList, imgShape):
     y1 = (y1 - marginList[2]) if ((y1 - marginList[2]) > 0) else 0
     y2 = (y2 + marginList[3]) if ((y2 + marginList[3]) < imgShape[0]) else imgShape[0]
 
-    return ((x1, y1), img[y1:y2, x1:x2])
-
-
-def _cropImageWithMargin1(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [40, 40, 40, 40], imgShape)
-
-def _cropImageWithMargin2(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [50, 50, 80, 80], imgShape)
-
-def _cropImageWithMargin3(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [80, 80, 80, 80], imgShape)
-
-def _cropImageWithMargin4(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [60, 60, 100, 100], imgShape)
+    return (x1, y1, x2, y2)
 
-def _cropImageWithMargin5(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [100, 100, 100, 100], imgShape)
 
-def _cropImageWithMargin6(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [200, 200, 200, 200], imgShape)
-
-def _cropImageWithMargin7(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [400, 400, 400, 400], imgShape)
+################
+#   CalcStat   #
+################
 
-def _cropImageWithMargin8(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [60, 60, 120, 120], imgShape)
 
-def _cropImageWithMargin9(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [70, 70, 150, 150], imgShape)
+class RunningStat():
+    """Mean and variance of pixel values (scaled to [0, 1]), accumulated in one pass
 
-    
-def _cropImageWithMargin10(img, coords, imgShape):
-    return __cropImageWithSimpleMargin(img, coords, [100, 100, 150, 150], imgShape)
+    Every image is reduced to its own (count, mean, M2) and merged with Chan's formula,
+    so partial stats of separate workers or panoramas merge to the stat of the whole dataset.
+    """
 
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
 
-################
-#   CalcStat   #
-################
-
+    def update(self, img):
+        x = np.asarray(img, dtype=np.float64) / 255
+        if x.size == 0:
+            return
+        mean = x.mean()
+        self.merge(RunningStat(x.size, mean, np.square(x - mean).sum()))
 
-def calcStat(fileName):
+    def merge(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+
+    def std(self):
+        return math.sqrt(self.m2 / self.n) if self.n > 0 else 0.0
+
+    def toDict(self):
+        return {'n': int(self.n), 'mean': float(self.mean), 'm2': float(self.m2)}
+
+
+class DatasetStat():
+    """Pano/box pixel stats and none/single/double target counts of a set of patches"""
+
+    def __init__(self):
+        self.pano = RunningStat()
+        self.box = RunningStat()
+        self.totalCount = 0
+        self.noneCount = 0
+        self.noneNSingleCount = 0
+
+    def update(self, panoImg, boxImg, majorTarget, minorTarget):
+        self.pano.update(panoImg)
+        self.box.update(boxImg)
+        self.totalCount += 1
+        self.noneCount += 1 if (str(majorTarget) == str(0)) else 0
+        self.noneNSingleCount += 1 if (str(minorTarget) == str(0)) else 0
+
+    def merge(self, other):
+        self.pano.merge(other.pano)
+        self.box.merge(other.box)
+        self.totalCount += other.totalCount
+        self.noneCount += other.noneCount
+        self.noneNSingleCount += other.noneNSingleCount
+        return self
+
+    def toDict(self):
+        return {'pano': self.pano.toDict(), 'box': self.box.toDict(), 'totalCount': self.totalCount,
+                'noneCount': self.noneCount, 'noneNSingleCount': self.noneNSingleCount}
+
+    @classmethod
+    def fromDict(cls, d):
+        stat = cls()
+        stat.pano = RunningStat(**d['pano'])
+        stat.box = RunningStat(**d['box'])
+        stat.totalCount = d['totalCount']
+        stat.noneCount = d['noneCount']
+        stat.noneNSingleCount = d['noneNSingleCount']
+        return stat
+
+    @classmethod
+    def fromRows(cls, rows):
+        # rows are .csv rows, as dicts or as lists in OUT_COLS order
+        stat = cls()
+        for row in rows:
+            if not isinstance(row, dict):
+                row = dict(zip(OUT_COLS, row))
+            cropPanoImg = readPatchImage(row['Cropped.Pano.Img'])
+            cropBoxImg = readPatchImage(row['Cropped.Box.Img'])
+            stat.update(cropPanoImg, cropBoxImg, row['Major.Target.Img'], row['Minor.Target.Img'])
+        return stat
+
+    def save(self, statFileName):
+        with open(statFileName, 'w') as statFile:
+            json.dump(self.toDict(), statFile)
+
+    @classmethod
+    def load(cls, statFileName):
+        with open(statFileName, 'r') as statFile:
+            return cls.fromDict(json.load(statFile))
+
+    def report(self):
+        singleCount = self.noneNSingleCount - self.noneCount
+        doubleCount = self.totalCount - self.noneNSingleCount
+
+        print("Pano(Mean, Std) = ({}, {})".format(self.pano.mean, self.pano.std()))
+        print("Box(Mean, Std) = ({}, {})".format(self.box.mean, self.box.std()))
+        print("None: {}, Single: {}, Double: {}".format(self.noneCount, singleCount, doubleCount))
+
+
+def getStatFileName(csvFileName):
+    return csvFileName[:-4] + '-stat.json'
+
+
+def calcStat(fileName, jobs=1, force=False):
+
+    # genData leaves the stat of its .csv next to it, scanning is only needed without it
+    statFileName = getStatFileName(fileName)
+    if not force and os.path.exists(statFileName) and os.path.exists(fileName) and \
+            os.path.getmtime(statFileName) >= os.path.getmtime(fileName):
+        print('stat from {}'.format(statFileName))
+        DatasetStat.load(statFileName).report()
+        return
 
     try:
         inputDf = pd.read_csv(fileName)
@@ -436,57 +757,59 @@ def calcStat(fileName):
         print('cannot read input file')
         return
 
-    sumPixelNum = 0
-    sumPanoPixelValue = 0
-    sumBoxPixelValue = 0
-    varPano = 0
-    varBox = 0
-
-    totalCount = 0
-    noneCount = 0
-    noneNSingleCount = 0
-    
-    for idx, row in inputDf.iterrows():
+    cols = ['Cropped.Pano.Img', 'Cropped.Box.Img', 'Major.Target.Img', 'Minor.Target.Img']
+    rows = inputDf[cols].to_dict('records')
+
+    # every image is read once, partial stats of each chunk are merged
+    if jobs > 1 and len(rows) > 1:
+        chunkSize = int(math.ceil(len(rows) / jobs))
+        chunks = [rows[i:i + chunkSize] for i in range(0, len(rows), chunkSize)]
+        pool = multiprocessing.Pool(processes=jobs)
+        partialStats = pool.map(DatasetStat.fromRows, chunks)
+        pool.close()
+        pool.join()
+    else:
+        partialStats = [DatasetStat.fromRows(rows)]
 
-        cropPanoImg = cv2.imread(row['Cropped.Pano.Img'], cv2.IMREAD_GRAYSCALE)
-        cropBoxImg = cv2.imread(row['Cropped.Box.Img'], cv2.IMREAD_GRAYSCALE)
-        h, w = cropBoxImg.shape
+    stat = DatasetStat()
+    for partialStat in partialStats:
+        stat.merge(partialStat)
 
-        sumPixelNum += h * w
-        sumPanoPixelValue += np.sum(cropPanoImg) / 255
-        sumBoxPixelValue += np.sum(cropBoxImg) / 255
+    stat.save(statFileName)
+    stat.report()
 
-        totalCount += 1
-        noneCount += 1 if (row['Major.Target.Img'] == str(0)) else 0
-        noneNSingleCount +=1 if (row['Minor.Target.Img'] == str(0)) else 0
-           
-    meanPano = sumPanoPixelValue / sumPixelNum
-    meanBox = sumBoxPixelValue / sumPixelNum
+    return
 
-    singleCount = noneNSingleCount - noneCount
-    doubleCount = totalCount - noneNSingleCount
 
-    for idx, row in inputDf.iterrows():
+##################
+#   GenOverlay   #
+##################
 
-        cropPanoImg = cv2.imread(row['Cropped.Pano.Img'], cv2.IMREAD_GRAYSCALE)
-        cropBoxImg = cv2.imread(row['Cropped.Box.Img'], cv2.IMREAD_GRAYSCALE)
 
-        cropPanoImgVar = np.square(cropPanoImg / 255 - meanPano)
-        cropBoxImgVar = np.square(cropBoxImg / 255 - meanBox)
-
-        varPano += np.sum(cropPanoImgVar)
-        varBox += np.sum(cropBoxImgVar)
+def genOverlay(fileName, rows=None, name=None, force=False):
 
+    try:
+        inputDf = pd.read_csv(fileName)
+    except IOError:
+        print('cannot read input file')
+        return
 
-    varPano /= sumPixelNum
-    varBox /= sumPixelNum
+    # rows as 'start:end' of the .csv order, name as a regex of the Name column
+    if rows is not None:
+        start, end = [int(r) if r else None for r in rows.split(':')]
+        inputDf = inputDf.iloc[start:end]
+    if name is not None:
+        inputDf = inputDf[inputDf['Name'].astype(str).str.match(name)]
 
-    stdPano = math.sqrt(varPano)
-    stdBox = math.sqrt(varBox)
+    count = 0
+    for idx, row in inputDf.iterrows():
+        if str(row['All.Img']) == str(-1):
+            # no annotation, so no overlay
+            continue
+        print(resolveOverlay(row, force))
+        count += 1
 
-    print("Pano(Mean, Std) = ({}, {})".format(meanPano, stdPano))
-    print("Box(Mean, Std) = ({}, {})".format(meanBox, stdBox))
-    print("None: {}, Single: {}, Double: {}".format(noneCount, singleCount, doubleCount))
+    print('{} overlays'.format(count))
 
     return
 
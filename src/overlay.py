@@ -0,0 +1,74 @@
+'''
+
+debug overlays of generated patches
+
+genData does not render the pano/box/target overlay of every patch any more. Its 'All.Img'
+column holds 'overlay:(jpg path)', and the overlay is rendered from the pano, box and target
+patches of the row the first time it is asked for (manage.py genOverlay, or resolveOverlay).
+
+'''
+
+import os
+import numpy as np
+import cv2
+from patchstore import readPatchImage
+
+OVERLAY_PREFIX = 'overlay:'
+
+
+def isOverlayRef(path):
+    return isinstance(path, str) and path.startswith(OVERLAY_PREFIX)
+
+
+def overlayRef(fileName):
+    return OVERLAY_PREFIX + fileName
+
+
+def renderOverlay(cropPanoImg, cropBoxImg, majorTargetImg, minorTargetImg):
+    """Blend the box, then both targets, over the pano patch
+
+    Returns:
+        tuple -- (inputImg, allImg), pano with box, and pano with box and targets
+    """
+
+    inputImg = cv2.copyMakeBorder(cropPanoImg, 0, 0, 0, 0, cv2.BORDER_REPLICATE)
+    cv2.addWeighted(cv2.add(cropPanoImg, cropBoxImg), 0.2, inputImg, 0.8, 0, inputImg)
+
+    allImg = cv2.copyMakeBorder(inputImg, 0, 0, 0, 0, cv2.BORDER_REPLICATE)
+    cv2.addWeighted(cv2.add(inputImg, cv2.add(majorTargetImg, minorTargetImg)), 0.6, allImg, 0.4, 0, allImg)
+
+    return (inputImg, allImg)
+
+
+def resolveOverlay(row, force=False):
+    """Returns a file path for the 'All.Img' of a generated .csv row, rendering it if needed
+
+    Arguments:
+        row {dict} -- row of a genData .csv
+
+    Keyword Arguments:
+        force {bool} -- render again even if the file exists (default: {False})
+    """
+
+    allImgName = str(row['All.Img'])
+    if not isOverlayRef(allImgName):
+        return allImgName
+
+    fileName = allImgName[len(OVERLAY_PREFIX):]
+    if os.path.exists(fileName) and not force:
+        return fileName
+
+    cropPanoImg = readPatchImage(row['Cropped.Pano.Img'])
+    cropBoxImg = readPatchImage(row['Cropped.Box.Img'])
+    targetImgs = []
+    for col in ('Major.Target.Img', 'Minor.Target.Img'):
+        if str(row[col]) == str(0):
+            targetImgs.append(np.zeros(cropPanoImg.shape, dtype=np.uint8))
+        else:
+            targetImgs.append(readPatchImage(row[col]))
+
+    inputImg, allImg = renderOverlay(cropPanoImg, cropBoxImg, targetImgs[0], targetImgs[1])
+    if not cv2.imwrite(fileName, allImg):
+        raise IOError('cannot write image {}'.format(fileName))
+
+    return fileName
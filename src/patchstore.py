@@ -0,0 +1,153 @@
+'''
+
+sharded binary store for uint8 image patches
+
+genData --store appends patches to shard files instead of writing one jpg per patch.
+Every patch is referenced from the .csv as 'pstore:(shard file)@(offset):(height)x(width)',
+and read back as a view of an np.memmap of its shard.
+
+'''
+
+import os
+import time
+import numpy as np
+import cv2
+
+STORE_PREFIX = 'pstore:'
+MAX_SHARD_BYTES = 1 << 30
+
+
+def isStoreRef(path):
+    return isinstance(path, str) and path.startswith(STORE_PREFIX)
+
+
+def parseStoreRef(ref):
+    shardName, location = ref[len(STORE_PREFIX):].rsplit('@', 1)
+    offset, shape = location.split(':')
+    h, w = shape.split('x')
+    return (shardName, int(offset), (int(h), int(w)))
+
+
+class PatchStoreWriter():
+    """Appends uint8 patches to the shards of one store directory
+
+    Every process writes its own shards, so workers never share a file.
+    Each shard has a .idx text file next to it with (key, offset, height, width) per line.
+
+    Arguments:
+        storeDir {string} -- directory of the store
+    """
+
+    def __init__(self, storeDir, maxShardBytes=MAX_SHARD_BYTES):
+        self.storeDir = storeDir
+        self.maxShardBytes = maxShardBytes
+        self.shardNum = 0
+        self.shardName = None
+        self.shardFile = None
+        self.indexFile = None
+
+        if not os.path.exists(storeDir):
+            os.makedirs(storeDir, exist_ok=True)
+
+    def _openShard(self):
+        self.close()
+        self.shardName = os.path.join(self.storeDir, 'shard-{}-{}-{}.bin'.format(
+            os.getpid(), int(time.time() * 1000), self.shardNum))
+        self.shardNum += 1
+        self.shardFile = open(self.shardName, 'ab')
+        self.indexFile = open(self.shardName[:-4] + '.idx', 'a')
+
+    def write(self, key, img):
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        if self.shardFile is None or self.shardFile.tell() + img.nbytes > self.maxShardBytes:
+            self._openShard()
+
+        offset = self.shardFile.tell()
+        self.shardFile.write(img.tobytes())
+        self.indexFile.write('{},{},{},{}\n'.format(key, offset, img.shape[0], img.shape[1]))
+
+        return '{}{}@{}:{}x{}'.format(STORE_PREFIX, self.shardName, offset, img.shape[0], img.shape[1])
+
+    def flush(self):
+        if self.shardFile is not None:
+            self.shardFile.flush()
+            self.indexFile.flush()
+
+    def close(self):
+        if self.shardFile is not None:
+            self.shardFile.close()
+            self.indexFile.close()
+        self.shardFile = None
+        self.indexFile = None
+
+
+_writers = {}
+
+def getPatchStoreWriter(storeDir):
+    # one writer per store directory and process
+    key = (os.getpid(), storeDir)
+    if key not in _writers:
+        _writers[key] = PatchStoreWriter(storeDir)
+    return _writers[key]
+
+
+def closePatchStoreWriter(storeDir):
+    # the next write to storeDir starts a new shard, so a rerun does not append to the shards it replaces
+    writer = _writers.pop((os.getpid(), storeDir), None)
+    if writer is not None:
+        writer.close()
+
+
+def dropUnreferencedShards(storeDir, refs):
+    """Removes the shards of storeDir (and their .idx) that none of refs points to
+
+    Regenerated panoramas write new shards, the shards of their old patches are dropped
+    once the .csv of the whole dataset is written.
+
+    Arguments:
+        storeDir {string} -- directory of the store
+        refs {iterable} -- every cell of the .csv, values that are not store refs are skipped
+
+    Returns:
+        int -- bytes removed
+    """
+    if not os.path.exists(storeDir):
+        return 0
+
+    referenced = set(os.path.abspath(parseStoreRef(ref)[0]) for ref in refs if isStoreRef(ref))
+    removed = 0
+    for fileName in sorted(os.listdir(storeDir)):
+        shardName = os.path.join(storeDir, fileName)
+        if not fileName.endswith('.bin') or os.path.abspath(shardName) in referenced:
+            continue
+        removed += os.path.getsize(shardName)
+        os.remove(shardName)
+        if os.path.exists(shardName[:-4] + '.idx'):
+            os.remove(shardName[:-4] + '.idx')
+        _shards.pop(shardName, None)
+    return removed
+
+
+_shards = {}
+
+def readPatch(ref):
+    """Returns the patch of ref as a read-only view of its memory-mapped shard"""
+    shardName, offset, shape = parseStoreRef(ref)
+    shard = _shards.get(shardName)
+    if shard is None or len(shard) < offset + shape[0] * shape[1]:
+        # not mapped yet, or the shard grew since it was mapped
+        shard = np.memmap(shardName, dtype=np.uint8, mode='r')
+        _shards[shardName] = shard
+    return shard[offset:offset + shape[0] * shape[1]].reshape(shape)
+
+
+def readPatchImage(path):
+    # grayscale patch from a jpg file or from the store
+    if isStoreRef(path):
+        return readPatch(path)
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+
+def storeRefExists(ref):
+    shardName, offset, shape = parseStoreRef(ref)
+    return os.path.exists(shardName) and os.path.getsize(shardName) >= offset + shape[0] * shape[1]
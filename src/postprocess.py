@@ -14,6 +14,7 @@ import pandas as pd
 import re
 import sys
 import json
+from imagewriter import getImageWriter
 
 class PanoWithOutputImgs():
 
@@ -196,7 +197,8 @@ class PanoWithOutputImgs():
             for imgType in self.imgTypeList:
                 imgDict = self.imgDictArray[self.thresList.index(thres)][self.imgTypeList.index(imgType)]
                 for fileName, panoImg in imgDict.items():
-                    cv2.imwrite(path + 'PanoWithOutputImg-' + fileName + '-' + imgType + '-' + str(thres) + '.jpg', panoImg)
+                    # encoded in the background while the next batch is inferred
+                    getImageWriter().write(path + 'PanoWithOutputImg-' + fileName + '-' + imgType + '-' + str(thres) + '.jpg', panoImg)
             rows.append([fileName])
         return rows
 
@@ -347,6 +349,7 @@ def postprocess(path, config, dataCsv):
         panoWithOutputImgs.saveImg(saveImgPath)
 
     rows = panoWithOutputImgs.saveImg(saveImgPath)
+    getImageWriter().flush()
     return
 
 
@@ -5,6 +5,7 @@ https://github.com/matterport/Mask_RCNN
 '''
 
 from pycocotools.coco import COCO
+from pycocotools import mask as maskUtils
 import cv2
 import numpy as np
 from PIL import Image
@@ -16,31 +17,48 @@ import xml.etree.ElementTree as ET
 import random
 import pandas as pd
 import time
+import multiprocessing
+import traceback
+from cocoannot import loadCoco, buildAnnotIndex, findImageSource, readImageBytes
+from cliutil import popOption
 
 
 def __main__():
     
     pylab.rcParams['figure.figsize'] = (8.0, 10.0)
 
-    if len(sys.argv) < 2:
+    args = list(sys.argv)
+    source = popOption(args, '--source', None)
+    jobs = int(popOption(args, '--jobs', 1))
+    seed = int(popOption(args, '--seed', 0))
+
+    if len(args) < 2:
+        print('need to input how many images\n',
+                '(howMany) [--source (COCO directory)] [--jobs N] [--seed S]')
         return
     
-    howMany = int(sys.argv[1])
+    howMany = int(args[1])
 
-    makePretrainData(howMany)
+    makePretrainData(howMany, source, jobs, seed)
     
     return
 
 
-def makePretrainData(howMany):
+def makePretrainData(howMany, source=None, jobs=1, seed=0):
 
-    makePretrainDataTrainVal(int(howMany * 0.9), 'train2017', 'train')
-    makePretrainDataTrainVal(howMany - int(howMany * 0.9), 'val2017', 'val')
+    makePretrainDataTrainVal(int(howMany * 0.9), 'train2017', 'train', source, jobs, seed)
+    makePretrainDataTrainVal(howMany - int(howMany * 0.9), 'val2017', 'val', source, jobs, seed)
 
     return
 
 
-def makePretrainDataTrainVal(howMany, dataType, trainVal):
+def makePretrainDataTrainVal(howMany, dataType, trainVal, source=None, jobs=1, seed=0):
+    """Convert howMany random person images of dataType and append them to Coco.csv
+
+    Images are read from source (see findImageSource) if given, downloaded from coco_url otherwise.
+    They are drawn from one permutation of the image ids seeded by seed and dataType,
+    skipping the ids converted by earlier runs, and converted by jobs worker processes.
+    """
 
     dataDir = '../data/rawdata/Coco'
     annFile = '{}/instances_{}.json'.format(dataDir, dataType)
@@ -57,71 +75,125 @@ def makePretrainDataTrainVal(howMany, dataType, trainVal):
     if not os.path.exists(dataDir + '/Input'):
         os.mkdir(dataDir + '/Input')
 
-    coco = COCO(annFile)
+    imageSource = None if source is None else findImageSource(source, dataType)
+
+    coco = loadCoco(annFile, ['person'])
 
     catIds = coco.getCatIds(catNms=['person'])
     imgIds = coco.getImgIds(catIds=catIds)
+    annotIndex = buildAnnotIndex(coco, catIds)
     outputFileName = '../data/metadata/Coco.csv'
 
     cols = ['Image.Title', 'Pano.File', 'Xml.File', 'Annot.File', 'Train.Val']
-    rows = []
+
+    # ids whose input image exists were converted before
+    imgIds = sorted(imgIds)
+    random.Random('{}:{}'.format(seed, dataType)).shuffle(imgIds)
+    imgIds = [imgId for imgId in imgIds if not os.path.isfile(dataDir + '/Input/InputImg-' + str(imgId) + '.jpg')]
+
+    howMany = len(imgIds) if howMany < 0 else min(howMany, len(imgIds))
+    tasks = [(coco.imgs[imgId], annotIndex.get(imgId, []), dataDir, trainVal, imageSource, seed)
+            for imgId in imgIds[:howMany]]
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.imap_unordered(_convertImageWorker, tasks)
+    else:
+        pool = None
+        results = map(_convertImageWorker, tasks)
 
     # if exists, append
-    if os.path.isfile(outputFileName):
-        inputDf = pd.read_csv(outputFileName)
-        for idx, row in inputDf.iterrows():
-            rows.append([row['Image.Title'], row['Pano.File'], row['Xml.File'], row['Annot.File'], row['Train.Val']])
+    hasHeader = os.path.isfile(outputFileName) and os.path.getsize(outputFileName) > 0
+    rowNum = len(pd.read_csv(outputFileName)) if hasHeader else 0
+    failedIds = []
 
-    howMany = len(imgIds) if howMany < 0 else howMany
+    with open(outputFileName, 'a') as outputFile:
 
-    for i in range(howMany):
+        if not hasHeader:
+            pd.DataFrame([], columns=cols).to_csv(outputFile)
 
-        imgId = 0
-        inputImgName = ''
+        for imgId, row, error in results:
 
-        while True:
-            imgId = imgIds[np.random.randint(0, len(imgIds))]
-            inputImgName = dataDir + '/Input/InputImg-' + str(imgId) + '.jpg'
-            if not os.path.isfile(inputImgName):
-                break
+            if error is not None:
+                print('failed to convert {}\n{}'.format(imgId, error))
+                failedIds.append(imgId)
+                continue
 
-        img = coco.loadImgs(imgId)[0]
-        print('img: {}'.format(img))
-        inputImg = io.imread(img['coco_url'])
-        io.imsave(inputImgName, inputImg)
+            # write every row so that there will be result to use even after an abrupt error
+            pd.DataFrame([row], columns=cols, index=[rowNum]).to_csv(outputFile, header=False)
+            outputFile.flush()
+            rowNum += 1
 
-        xmlName = dataDir + '/Xml/Xml-' + str(imgId) + '.xml'
-        xmlRoot = ET.Element("root")
-        xmlToothList = ET.SubElement(xmlRoot, "ToothList")
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        annotDir = dataDir + '/Annot/Annot-' + str(imgId) + '/'
-        os.mkdir(annotDir)
+    if len(failedIds) > 0:
+        print('{} images failed: {}'.format(len(failedIds), failedIds))
 
-        pngs = cocoSegmentationToPng(coco, imgId)
+    return
 
-        for j in range(len(pngs)):
 
-            png = pngs[j]
-            annotImg = np.array(png)
-            annotName = dataDir + '/Annot/Annot-' + str(imgId) + '/TargetImg-' + str(j) + '.jpg'
-            cv2.imwrite(annotName, annotImg)
-            xmlTooth = ET.SubElement(xmlToothList, "Tooth", Number=str(j))
-            coords = makeRandomBoundingBox(annotImg)
-            for i in range(len(coords)):
-                (x, y) = coords[i]
-                ET.SubElement(xmlTooth, 'P' + str(i), Y=str(y), X=str(x))
+def _convertImageWorker(task):
+    # catches every error so that one broken image does not abort the whole run
+    img, imgAnnots, dataDir, trainVal, imageSource, seed = task
+    try:
+        return (img['id'], convertImage(img, imgAnnots, dataDir, trainVal, imageSource, seed), None)
+    except Exception:
+        return (img['id'], None, traceback.format_exc())
 
-        xmlTree = ET.ElementTree(xmlRoot)
-        xmlTree.write(xmlName)
 
-        row = [imgId, inputImgName, xmlName, annotDir, trainVal]
-        rows.append(row)
+def convertImage(img, imgAnnots, dataDir, trainVal, imageSource=None, seed=0):
+    """Write the input image, one target image per annotation and the xml of random boxes
 
-        # write every time so that there will be result to use even after an abrupt error
-        outputDf = pd.DataFrame(rows, columns=cols)
-        outputDf.to_csv(outputFileName)
+    Returns:
+        list -- Coco.csv row of the image
+    """
 
-    return
+    imgId = img['id']
+    inputImgName = dataDir + '/Input/InputImg-' + str(imgId) + '.jpg'
+    xmlName = dataDir + '/Xml/Xml-' + str(imgId) + '.xml'
+    annotDir = dataDir + '/Annot/Annot-' + str(imgId) + '/'
+
+    # the boxes of an image do not depend on the worker that converts it
+    np.random.seed([seed, imgId])
+
+    print('img: {}'.format(img))
+    xmlRoot = ET.Element("root")
+    xmlToothList = ET.SubElement(xmlRoot, "ToothList")
+
+    os.makedirs(annotDir, exist_ok=True)
+
+    # a coco with only this image is enough to decode its annotations
+    coco = COCO()
+    coco.imgs = {imgId: img}
+    pngs = cocoSegmentationToPng(coco, imgId, annotIndex={imgId: imgAnnots})
+
+    for j in range(len(pngs)):
+
+        png = pngs[j]
+        annotImg = np.array(png)
+        annotName = annotDir + 'TargetImg-' + str(j) + '.jpg'
+        cv2.imwrite(annotName, annotImg)
+        xmlTooth = ET.SubElement(xmlToothList, "Tooth", Number=str(j))
+        coords = makeRandomBoundingBox(annotImg)
+        for i in range(len(coords)):
+            (x, y) = coords[i]
+            ET.SubElement(xmlTooth, 'P' + str(i), Y=str(y), X=str(x))
+
+    xmlTree = ET.ElementTree(xmlRoot)
+    xmlTree.write(xmlName)
+
+    # the input image goes last, its existence marks the image as converted
+    tempName = '{}.{}.tmp.jpg'.format(inputImgName[:-4], os.getpid())
+    if imageSource is None:
+        io.imsave(tempName, io.imread(img['coco_url']))
+    else:
+        with open(tempName, 'wb') as inputFile:
+            inputFile.write(readImageBytes(imageSource, img['file_name']))
+    os.replace(tempName, inputImgName)
+
+    return [imgId, inputImgName, xmlName, annotDir, trainVal]
 
 
 def makeRandomBoundingBox(img):
@@ -190,13 +262,14 @@ def boxIsBigEnough(annotImg, coords):
     return True
 
 
-def cocoSegmentationToSegmentationMap(coco, imgId, checkUniquePixelLabel=True, includeCrowd=False):
+def cocoSegmentationToSegmentationMap(coco, imgId, checkUniquePixelLabel=True, includeCrowd=False, annotIndex=None):
     '''
     Convert COCO GT or results for a single image to a segmentation map.
     :param coco: an instance of the COCO API (ground-truth or result)
     :param imgId: the id of the COCO image
     :param checkUniquePixelLabel: (optional) whether every pixel can have at most one label
     :param includeCrowd: whether to include 'crowd' thing annotations as 'other' (or void)
+    :param annotIndex: (optional) image id -> annotations from buildAnnotIndex, built for this image if None
     :return: labelMap - [h x w] segmentation map that indicates the label of each pixel
     '''
 
@@ -205,19 +278,26 @@ def cocoSegmentationToSegmentationMap(coco, imgId, checkUniquePixelLabel=True, i
     imageSize = (curImg['height'], curImg['width'])
 
     # Get annotations of the current image (may be empty)
-    imgAnnots = [a for a in coco.anns.values() if a['image_id'] == imgId]
-    catIds = coco.getCatIds(catNms=['person'])
-    if includeCrowd:
-        annIds = coco.getAnnIds(imgIds=imgId, catIds=catIds)
+    if annotIndex is None:
+        catIds = coco.getCatIds(catNms=['person'])
+        if includeCrowd:
+            annIds = coco.getAnnIds(imgIds=imgId, catIds=catIds)
+        else:
+            annIds = coco.getAnnIds(imgIds=imgId, catIds=catIds, iscrowd=False)
+        imgAnnots = coco.loadAnns(annIds)
     else:
-        annIds = coco.getAnnIds(imgIds=imgId, catIds=catIds, iscrowd=False)
-
-    imgAnnots = coco.loadAnns(annIds)
+        imgAnnots = annotIndex.get(imgId, [])
 
     labelMaps = []
+    if len(imgAnnots) == 0:
+        return labelMaps
+
+    # decode the masks of all annotations in one call, [h x w x n]
+    labelMasks = maskUtils.decode([coco.annToRLE(a) for a in imgAnnots]) == 1
+
     # Combine all annotations of this image in labelMap
     for a in range(0, len(imgAnnots)):
-        labelMask = coco.annToMask(imgAnnots[a]) == 1
+        labelMask = labelMasks[:, :, a]
         newLabel = 255 #imgAnnots[a]['category_id']
 
         labelMap = np.zeros(imageSize)
@@ -227,20 +307,21 @@ def cocoSegmentationToSegmentationMap(coco, imgId, checkUniquePixelLabel=True, i
     return labelMaps
 
 
-def cocoSegmentationToPng(coco, imgId, includeCrowd=False):
+def cocoSegmentationToPng(coco, imgId, includeCrowd=False, annotIndex=None):
     '''
     Convert COCO GT or results for a single image to a segmentation map and write it to disk.
     :param coco: an instance of the COCO API (ground-truth or result)
     :param imgId: the COCO id of the image (last part of the file name)
     :param pngPath: the path of the .png file
     :param includeCrowd: whether to include 'crowd' thing annotations as 'other' (or void)
+    :param annotIndex: (optional) image id -> annotations from buildAnnotIndex
     :return: None
     '''
 
     pngs = []
 
     # Create label map
-    labelMaps = cocoSegmentationToSegmentationMap(coco, imgId, includeCrowd=includeCrowd)
+    labelMaps = cocoSegmentationToSegmentationMap(coco, imgId, includeCrowd=includeCrowd, annotIndex=annotIndex)
 
     for i in range(len(labelMaps)):
         labelMap = labelMaps[i]
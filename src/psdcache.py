@@ -0,0 +1,118 @@
+'''
+
+persistent cache of decoded PSD annotation layers
+
+Parsing a PSD and thresholding the alpha channel of every layer is the slowest part of
+genData and boxcreation. The result is stored once per PSD, keyed by the file hash, as
+the bit-packed mask of each layer's bounding box plus the layer names and bounds.
+
+'''
+
+import os
+import hashlib
+import numpy as np
+import cv2
+from psd_tools import PSDImage
+
+CACHE_DIR = '../data/cache/psd/'
+
+
+def fileHash(fileName):
+    sha1 = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def decodePsdLayers(annotPsd):
+    """Decode the tooth layers of a PSD
+
+    Arguments:
+        annotPsd {PSDImage} -- loaded PSD
+
+    Returns:
+        list -- (name, [y1, y2, x1, x2], bool mask of the bounding box) per layer
+    """
+
+    layers = []
+
+    for layer in annotPsd.layers:
+
+        if layer is None or layer.bbox == (0, 0, 0, 0):
+            continue
+
+        layerImg = np.array(layer.as_PIL())
+
+        # get alpha channel from png
+        if (layerImg.shape[-1] != 4):
+            # Then this is background image
+            continue
+
+        r, g, b, a = cv2.split(layerImg)
+        bound = [layer.bbox.y1, layer.bbox.y2, layer.bbox.x1, layer.bbox.x2]
+        layers.append((layer.name.strip(), bound, a > 200))
+
+    return layers
+
+
+def loadPsdLayers(psdFileName, cacheDir=CACHE_DIR):
+    """Load the decoded tooth layers of a PSD, decoding and caching them on the first call
+
+    Arguments:
+        psdFileName {string} -- path of the .psd file
+
+    Keyword Arguments:
+        cacheDir {string} -- cache directory (default: {CACHE_DIR})
+
+    Returns:
+        list -- (name, [y1, y2, x1, x2], bool mask of the bounding box) per layer
+    """
+
+    cacheName = os.path.join(cacheDir, fileHash(psdFileName) + '.npz')
+
+    if os.path.exists(cacheName):
+        try:
+            return _readCache(cacheName)
+        except (IOError, ValueError, KeyError):
+            print('broken psd cache {}, decoding again'.format(cacheName))
+
+    layers = decodePsdLayers(PSDImage.load(psdFileName))
+    _writeCache(cacheName, layers)
+
+    return layers
+
+
+def _writeCache(cacheName, layers):
+
+    if not os.path.exists(os.path.dirname(cacheName)):
+        os.makedirs(os.path.dirname(cacheName), exist_ok=True)
+
+    packed = [np.packbits(mask) for name, bound, mask in layers]
+    offsets = np.cumsum([0] + [len(p) for p in packed])
+
+    # written aside and renamed, so concurrent workers never read a half written entry
+    tempName = '{}.{}.tmp.npz'.format(cacheName[:-4], os.getpid())
+    np.savez(tempName,
+            names=np.array([name for name, bound, mask in layers], dtype=str),
+            bounds=np.array([bound for name, bound, mask in layers], dtype=np.int64).reshape(-1, 4),
+            shapes=np.array([mask.shape for name, bound, mask in layers], dtype=np.int64).reshape(-1, 2),
+            offsets=offsets,
+            bits=np.concatenate(packed) if len(packed) > 0 else np.zeros(0, dtype=np.uint8))
+    os.replace(tempName, cacheName)
+
+
+def _readCache(cacheName):
+
+    layers = []
+
+    with np.load(cacheName) as cache:
+        names, bounds, shapes = cache['names'], cache['bounds'], cache['shapes']
+        offsets, bits = cache['offsets'], cache['bits']
+
+        for i in range(len(names)):
+            h, w = shapes[i]
+            mask = np.unpackbits(bits[offsets[i]:offsets[i + 1]])[:h * w].reshape(h, w).astype(bool)
+            layers.append((str(names[i]), [int(b) for b in bounds[i]], mask))
+
+    return layers
@@ -0,0 +1,125 @@
+'''
+
+two-tier cache of the image files read by PanoSet
+
+The encoded tier keeps the raw bytes of every file read, up to a byte budget, in an anonymous
+shared mapping made before the DataLoader forks its workers. A file read by any worker is
+read from memory by all of them afterwards. The decoded tier is an LRU of decoded uint8
+arrays, also bounded in bytes, private to each worker. It only pays off when the workers live
+across epochs, so trainer.py keeps its DataLoader workers (persistent_workers).
+
+Workers must be forked (the default on linux), the mappings are not pickled. The counters and
+the bytes of both tiers are kept in shared memory, so stats() covers every worker.
+
+'''
+
+import io
+import mmap
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+MB = 1 << 20
+
+# modes whose np.array round trip gives back the same image
+DECODED_MODES = ('L', 'RGB', 'RGBA')
+
+
+class SampleCache():
+    """Cache of slotNum files, a slot is one file of one sample
+
+    Arguments:
+        slotNum {int} -- number of slots
+        encodedBytes {int} -- budget of the shared encoded tier
+        decodedBytes {int} -- budget of the decoded tier of each process
+    """
+
+    COUNTERS = ('encoded.hits', 'encoded.misses', 'encoded.full', 'decoded.hits', 'decoded.misses', 'decoded.evictions')
+
+    def __init__(self, slotNum, encodedBytes, decodedBytes):
+
+        self.encodedBytes = int(encodedBytes)
+        self.decodedBytes = int(decodedBytes)
+
+        # mmap(-1, n) is an anonymous MAP_SHARED mapping, forked workers write to the same pages
+        self._arena = mmap.mmap(-1, max(self.encodedBytes, 1))
+        self._tableMap = mmap.mmap(-1, max(slotNum, 1) * 16)
+        self._metaMap = mmap.mmap(-1, 8 * (2 + len(self.COUNTERS)))
+
+        # (offset, length) per slot, length -1 until the slot is written
+        self.table = np.frombuffer(self._tableMap, dtype=np.int64).reshape(-1, 2)
+        self.table[:, 1] = -1
+        # used bytes of the arena, bytes of the decoded tiers of all processes, then the counters
+        self.meta = np.frombuffer(self._metaMap, dtype=np.int64)
+        self.lock = multiprocessing.Lock()
+
+        self.decoded = OrderedDict()
+        self.decodedSize = 0
+
+    def _count(self, name, decodedBytes=0):
+        with self.lock:
+            self.meta[2 + self.COUNTERS.index(name)] += 1
+            self.meta[1] += decodedBytes
+
+    def encoded(self, slot, path):
+        """Returns the bytes of the file of slot, reading path on the first call"""
+
+        length = self.table[slot, 1]
+        if length >= 0:
+            offset = self.table[slot, 0]
+            self._count('encoded.hits')
+            return self._arena[offset:offset + length]
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        with self.lock:
+            self.meta[2 + self.COUNTERS.index('encoded.misses')] += 1
+            offset = self.meta[0]
+            if offset + len(data) > self.encodedBytes:
+                self.meta[2 + self.COUNTERS.index('encoded.full')] += 1
+                return data
+            self.meta[0] += len(data)
+
+        # the length is written last, readers see a slot only once its bytes are in place
+        self._arena[offset:offset + len(data)] = data
+        self.table[slot, 0] = offset
+        self.table[slot, 1] = len(data)
+
+        return data
+
+    def read(self, slot, path):
+        """Returns the file of slot as a PIL image, like Image.open(path)"""
+
+        if slot in self.decoded:
+            self.decoded.move_to_end(slot)
+            self._count('decoded.hits')
+            arr, mode = self.decoded[slot]
+            return Image.fromarray(arr, mode=mode)
+
+        img = Image.open(io.BytesIO(self.encoded(slot, path)))
+        img.load()
+        if img.mode not in DECODED_MODES or img.width * img.height * len(img.getbands()) > self.decodedBytes:
+            self._count('decoded.misses')
+            return img
+
+        arr = np.array(img)
+        self.decoded[slot] = (arr, img.mode)
+        self.decodedSize += arr.nbytes
+        self._count('decoded.misses', arr.nbytes)
+        while self.decodedSize > self.decodedBytes:
+            oldSlot, (oldArr, oldMode) = self.decoded.popitem(last=False)
+            self.decodedSize -= oldArr.nbytes
+            self._count('decoded.evictions', -oldArr.nbytes)
+
+        return img
+
+    def stats(self):
+        """Counters of all processes, the bytes in the encoded tier and in the decoded tiers of all processes"""
+        with self.lock:
+            meta = self.meta.copy()
+        result = OrderedDict((name, int(meta[2 + i])) for i, name in enumerate(self.COUNTERS))
+        result['encoded.bytes'] = int(meta[0])
+        result['decoded.bytes'] = int(meta[1])
+        return result
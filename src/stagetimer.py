@@ -0,0 +1,51 @@
+'''
+
+wall time and counters per pipeline stage, used by benchmark.py
+
+genData and boxcreation take an optional timer. Without one they use NULL_TIMER,
+whose stages cost nothing.
+
+'''
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StageTimer():
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.seconds = OrderedDict()
+        self.counts = OrderedDict()
+        self.started = {}
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+    # start/stop for stages that are too long to indent under a with block
+    def start(self, name):
+        if self.enabled:
+            self.started[name] = time.perf_counter()
+
+    def stop(self, name):
+        if self.enabled and name in self.started:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - self.started.pop(name)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def toDict(self):
+        return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+
+NULL_TIMER = StageTimer(enabled=False)
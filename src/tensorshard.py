@@ -0,0 +1,185 @@
+'''
+
+python3 tensorshard.py (config.json) [--jobs N]
+
+memory-mapped shards of the samples of a PanoSet after the deterministic prefix of its transform
+
+The prefix of TripleAugment (target threshold, resize to the training size) gives the same
+images every epoch, so it is run once and its uint8 result is stored as .npy shards of
+(samples, 4, height, width): pano, box, major target, minor target. getDataset serves the
+samples from the shards and runs only the rest of the transform (see ShardSet).
+
+Shards of one split are in (shard dir)/(dataset name)-(split)-(hash)/, the hash covering the
+csv (path, size, modification time), the filter and the prefix config, so a new csv or size
+builds new shards. A directory is complete once it is renamed from its .tmp build directory.
+The command builds the shards of the train and val split of a training config beforehand.
+
+'''
+
+import os
+import sys
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+from cliutil import popOption
+
+SHARD_DIR = '../data/cache/shards/'
+SHARD_SAMPLES = 4096
+META_NAME = 'meta.json'
+
+
+def __main__():
+
+    args = list(sys.argv)
+    jobs = int(popOption(args, '--jobs', 1))
+
+    if len(args) < 2:
+        print('need to input config file\n', '(config.json) [--jobs N]')
+        return
+
+    with open(args[1]) as configFile:
+        config = json.load(configFile)
+
+    from dataset import getDataset
+    dataset = dict(config['dataset'])
+    dataset['shards'] = dict(dataset.get('shards') or {}, jobs=jobs)
+    datasets = getDataset(**dataset, **config['augmentation'])
+    for x in ('train', 'val'):
+        print('{}: {}'.format(x, datasets[x]))
+
+    return
+
+
+def shardKey(metaDataPath, filterSpec, prefixConfig):
+    stat = os.stat(metaDataPath)
+    key = json.dumps([os.path.abspath(metaDataPath), stat.st_size, stat.st_mtime_ns, filterSpec, prefixConfig], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def loadShards(dataset, transform, name, split, filterSpec, shardDir=SHARD_DIR, jobs=1):
+    """Returns the ShardReader of the samples of dataset, building the shards if needed
+
+    Arguments:
+        dataset {PanoSet} -- dataset without transform, its loadSample(index) gives the four images
+        transform {TripleAugment} -- its prefix is applied before storing
+        name {string} -- dataset name of the shard directory
+        split {string} -- 'train' or 'val'
+        filterSpec {list} -- filter of the split
+
+    Returns:
+        ShardReader -- None if the prefix does not end at a fixed size
+    """
+
+    size = transform.prefixSize()
+    if size is None:
+        print('{} {}: the deterministic prefix does not end at a fixed size, not sharded'.format(name, split))
+        return None
+
+    key = shardKey(dataset.path, filterSpec, transform.prefixConfig())
+    outDir = os.path.join(shardDir, '{}-{}-{}'.format(name, split, key))
+
+    if not os.path.exists(os.path.join(outDir, META_NAME)):
+        print('building shards of {} {} in {}'.format(name, split, outDir))
+        buildShards(dataset, transform, size, outDir, jobs)
+
+    return ShardReader(outDir)
+
+
+def buildShards(dataset, transform, size, outDir, jobs=1):
+    """Write the prefix of transform of every sample of dataset to .npy shards in outDir"""
+
+    sampleNum = len(dataset)
+    shardNum = (sampleNum + SHARD_SAMPLES - 1) // SHARD_SAMPLES
+    tempDir = '{}.{}.tmp'.format(outDir, os.getpid())
+    os.makedirs(tempDir, exist_ok=True)
+
+    global _buildState
+    _buildState = (dataset, transform, size, tempDir)
+
+    # workers are forked with the dataset in _buildState
+    tasks = list(range(shardNum))
+    if jobs > 1 and shardNum > 1:
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.imap_unordered(_buildShardWorker, tasks)
+    else:
+        pool = None
+        results = map(_buildShardWorker, tasks)
+
+    try:
+        for shardIdx, error in results:
+            if error is not None:
+                raise ValueError('failed to build shard {} of {}\n{}'.format(shardIdx, outDir, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _buildState = None
+
+    meta = {'samples': sampleNum, 'shardSamples': SHARD_SAMPLES, 'size': list(size), 'shards': shardNum}
+    with open(os.path.join(tempDir, META_NAME), 'w') as metaFile:
+        json.dump(meta, metaFile, indent=2)
+
+    # another process may have built it meanwhile, its shards are the same
+    try:
+        os.replace(tempDir, outDir)
+    except OSError:
+        for fileName in os.listdir(tempDir):
+            os.remove(os.path.join(tempDir, fileName))
+        os.rmdir(tempDir)
+
+
+_buildState = None
+
+def _buildShardWorker(shardIdx):
+    dataset, transform, size, tempDir = _buildState
+    start = shardIdx * SHARD_SAMPLES
+    stop = min(start + SHARD_SAMPLES, len(dataset))
+    try:
+        shard = np.lib.format.open_memmap(shardName(tempDir, shardIdx), mode='w+', dtype=np.uint8,
+                shape=(stop - start, 4) + tuple(size))
+        prefixLength = transform.prefixLength()
+        for index in range(start, stop):
+            imgs = transform(*dataset.loadSample(index), stop=prefixLength)
+            for k, img in enumerate(imgs):
+                arr = np.asarray(img)
+                if arr.shape != tuple(size) or arr.dtype != np.uint8:
+                    raise ValueError('sample {} image {} is {} {}, not uint8 {}'.format(index, k, arr.dtype, arr.shape, tuple(size)))
+                shard[index - start, k] = arr
+        shard.flush()
+        del shard
+    except Exception as e:
+        return (shardIdx, repr(e))
+    return (shardIdx, None)
+
+
+def shardName(shardDir, shardIdx):
+    return os.path.join(shardDir, 'shard-{:05d}.npy'.format(shardIdx))
+
+
+class ShardReader():
+    """Samples of one shard directory, as read-only views of the memory-mapped shards
+
+    Arguments:
+        shardDir {string} -- complete shard directory
+    """
+
+    def __init__(self, shardDir):
+        with open(os.path.join(shardDir, META_NAME)) as metaFile:
+            meta = json.load(metaFile)
+        self.shardDir = shardDir
+        self.sampleNum = meta['samples']
+        self.shardSamples = meta['shardSamples']
+        self.size = tuple(meta['size'])
+        self.shards = [np.load(shardName(shardDir, idx), mmap_mode='r') for idx in range(meta['shards'])]
+
+    def __getitem__(self, index):
+        # (4, height, width) uint8: pano, box, major target, minor target
+        return self.shards[index // self.shardSamples][index % self.shardSamples]
+
+    def __len__(self):
+        return self.sampleNum
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,10 @@
+"""
+
+pytest setup, the tests import the modules of src/ by name
+
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,64 @@
+"""
+
+tests of annotation.py
+
+"""
+
+import numpy as np
+
+from annotation import ToothMask, ToothIndex
+
+
+def randomTeeth(seed, num):
+    rng = np.random.RandomState(seed)
+    annotImgs = {}
+    for i in range(num):
+        y1, x1 = rng.randint(0, 200), rng.randint(-20, 400)
+        y2, x2 = y1 + rng.randint(0, 60), x1 + rng.randint(-10, 60)
+        # a few boxes are empty or inverted, like hollow teeth shifted out of the panorama
+        img = np.full((max(y2 - y1, 0), max(x2 - x1, 0)), 255, dtype=np.uint8)
+        annotImgs[str(11 + i)] = ToothMask([y1, y2, x1, x2], img)
+    return annotImgs
+
+
+def bruteSpanning(annotImgs, x1, x2):
+    return set(name for name, mask in annotImgs.items()
+            if max(mask.bound[2], mask.bound[3]) >= x1 and min(mask.bound[2], mask.bound[3]) <= x2)
+
+
+def bruteWindow(annotImgs, y1, y2, x1, x2):
+    return [name for name, mask in annotImgs.items() if mask.overlaps(y1, y2, x1, x2)]
+
+
+def test_tooth_index_matches_brute_force():
+    rng = np.random.RandomState(1)
+    for seed in range(5):
+        annotImgs = randomTeeth(seed, 32)
+        index = ToothIndex(annotImgs)
+        for _ in range(200):
+            y1, x1 = rng.randint(-20, 250), rng.randint(-30, 450)
+            y2, x2 = y1 + rng.randint(0, 80), x1 + rng.randint(0, 120)
+            assert index.spanning(x1, x2) == bruteSpanning(annotImgs, x1, x2)
+            assert index.window(y1, y2, x1, x2) == bruteWindow(annotImgs, y1, y2, x1, x2)
+        for name in annotImgs:
+            assert index.overlapping(name) == [other for other in bruteWindow(annotImgs, *annotImgs[name].bound) if other != name]
+
+
+def test_tooth_index_add_remove():
+    annotImgs = randomTeeth(7, 10)
+    index = ToothIndex(annotImgs)
+    index.add('hollow', ToothMask([10, 40, 100, 130], np.full((30, 30), 255, dtype=np.uint8)))
+    index.remove('11')
+
+    assert 'hollow' in index and '11' not in index
+    assert index['hollow'].bound == [10, 40, 100, 130]
+    assert index.window(0, 300, -50, 500) == bruteWindow(annotImgs, 0, 300, -50, 500)
+    assert index.spanning(100, 130) == bruteSpanning(annotImgs, 100, 130)
+    assert (index.bounds(['hollow', '12']) == np.array([[10, 40, 100, 130], annotImgs['12'].bound])).all()
+
+
+def test_empty_tooth_index():
+    index = ToothIndex({})
+    assert index.spanning(0, 100) == set()
+    assert index.window(0, 100, 0, 100) == []
+    assert index.bounds([]).shape == (0, 4)
@@ -0,0 +1,50 @@
+"""
+
+tests of augmentation.py
+
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+pytest.importorskip('imgaug')
+
+from augmentation import getAugmentation
+
+PARAM = {'size': [64, 32], 'box_mean': 0.4, 'box_std': 0.2, 'pano_mean': 0.5, 'pano_std': 0.25}
+
+
+def randomSample(seed):
+    rng = np.random.RandomState(seed)
+    return [Image.fromarray((rng.rand(120, 70) * 255).astype(np.uint8), mode='L') for _ in range(4)]
+
+
+def test_prefix_of_deterministic_pipeline():
+    # target threshold, resize, target threshold, then ToTensor starts the suffix
+    transform = getAugmentation([], PARAM)
+    assert transform.prefixLength() == 3
+    assert transform.prefixSize() == (64, 32)
+
+    n = transform.prefixLength()
+    full = transform(*randomSample(0))
+    prefix = transform(*randomSample(0), stop=n)
+    assert all(np.array(img).dtype == np.uint8 and np.array(img).shape == (64, 32) for img in prefix)
+    split = transform(*prefix, start=n)
+    for a, b in zip(full, split):
+        assert np.allclose(np.asarray(a), np.asarray(b))
+
+
+def test_prefix_stops_at_random_op():
+    transform = getAugmentation([{'category': 'All', 'type': 'HFlip'}], PARAM)
+    assert transform.prefixLength() == 1
+    assert transform.prefixSize() is None
+
+
+def test_prefix_config_follows_size():
+    config = getAugmentation([], PARAM).prefixConfig()
+    assert config == getAugmentation([], dict(PARAM)).prefixConfig()
+    assert config != getAugmentation([], dict(PARAM, size=[32, 16])).prefixConfig()
+    assert getAugmentation([], dict(PARAM, size=64)).prefixSize() is None
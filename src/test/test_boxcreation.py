@@ -0,0 +1,46 @@
+"""
+
+tests of boxcreation.py
+
+"""
+
+import random
+import xml.etree.ElementTree as ET
+import numpy as np
+import pytest
+
+pytest.importorskip('psd_tools')
+
+from boxcreation import createBoxXml, criticalLineCandidates, getLineCutMask, getLineCutRegion
+
+
+@pytest.mark.parametrize('inputAngle', [10, 45, 80, 100, 135, 170])
+def test_line_cut_mask_matches_flood_fill(inputAngle):
+    imgShape = (60, 80)
+    ys, xs = np.mgrid[0:imgShape[0], 0:imgShape[1]]
+    border = (ys == 0) | (xs == 0) | (ys == imgShape[0] - 1) | (xs == imgShape[1] - 1)
+    lines = list(criticalLineCandidates((20, 10), (60, 10), imgShape, inputAngle))
+    assert len(lines) > 0
+
+    for line in lines[::5]:
+        mask = getLineCutMask(line, inputAngle % 180, imgShape, (0, imgShape[0], 0, imgShape[1]))
+        region = getLineCutRegion(line, inputAngle % 180, imgShape) > 0
+
+        # they only differ by rounding on the line and on the panorama border
+        x1, y1, x2, y2 = line
+        distance = np.abs((x2 - x1) * (ys - y1) - (y2 - y1) * (xs - x1)) / max(np.hypot(x2 - x1, y2 - y1), 1)
+        assert not np.any((mask != region) & ~border & (distance > 1.5))
+
+
+def test_create_box_xml_writes_before_returning(tmp_path, monkeypatch):
+    import benchmark
+    workDir = tmp_path / 'src'
+    workDir.mkdir()
+    monkeypatch.chdir(workDir)
+    benchmark.synthesize(1, (300, 600), 2, 0)
+    xmlFileName = '../data/rawdata/xmlFile/Bench-Pano-000.xml'
+    toothNum = len(ET.parse(xmlFileName).getroot().findall('.//Tooth'))
+
+    createBoxXml('Bench-Pano-000', 1, 1, 1, rng=random.Random(0))
+
+    assert len(ET.parse(xmlFileName).getroot().findall('.//Tooth')) > toothNum
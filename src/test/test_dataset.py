@@ -0,0 +1,127 @@
+"""
+
+tests of dataset.py
+
+"""
+
+import os
+import json
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip('torch')
+
+from dataset import CocoPanoSet, PanoSet, Filter, PathArray, parseSizes, getAbsoluteAddress
+
+
+def randomMetaData(seed, num):
+    rng = np.random.RandomState(seed)
+    rows = []
+    for i in range(num):
+        major = '0' if rng.rand() < 0.3 else 'data/major-{}.jpg'.format(i)
+        rows.append(['data/pano-{}.jpg'.format(i), 'pstore:data/store/shard-0.bin@{}:8x4'.format(32 * i), major,
+                'data/minor-{}.jpg'.format(i) if major != '0' else '0', 'overlay:data/all-{}.jpg'.format(i),
+                '({}, {})'.format(rng.randint(1, 500), rng.randint(1, 500)), rng.choice(['train', 'val']),
+                rng.choice([-1, 0, 1, 5, 10, 11, 13]), rng.choice([11, 14, 21, 26, 33, 38, 41, 47])])
+    return pd.DataFrame(rows, columns=['Cropped.Pano.Img', 'Cropped.Box.Img', 'Major.Target.Img', 'Minor.Target.Img',
+            'All.Img', 'Cropped.Img.Size', 'Train.Val', 'Segmentable.Type', 'Tooth.Num.Annot'])
+
+
+def test_filter_mask_matches_rows():
+    df = randomMetaData(0, 300)
+    rows = df.to_dict('records')
+    names = ['train', 'val', 'easy', 'segmentable', 'unsegmentable', 'front-teeth']
+    for num in range(3):
+        for filters in itertools.combinations(names, num):
+            f = Filter(filters)
+            assert (f.mask(df) == np.array([f(row) for row in rows], dtype=bool)).all(), filters
+
+
+def test_path_array():
+    paths = ['a.jpg', None, '', 'pstore:dir/shard.bin@0:2x2', 'ünïcode/파노.jpg', None]
+    array = PathArray(paths)
+    assert len(array) == len(paths)
+    assert [array[i] for i in range(len(paths))] == paths
+    assert len(PathArray([])) == 0
+
+
+def test_parse_sizes():
+    sizes = parseSizes(pd.Series(['(10, 20)', '(3,4)', '( 7 , 1 )']))
+    assert sizes.dtype == np.int64
+    assert sizes.tolist() == [[10, 20], [3, 4], [7, 1]]
+
+
+def test_pano_set_index(tmp_path):
+    df = randomMetaData(1, 200)
+    df['Cropped.Major.Annot.Img'] = df['Major.Target.Img']
+    df['Cropped.Minor.Annot.Img'] = df['Minor.Target.Img']
+    csvFileName = str(tmp_path / 'set.csv')
+    df.to_csv(csvFileName)
+
+    f = Filter(['val', 'segmentable'])
+    dataset = PanoSet(csvFileName, f)
+    rows = [row for row in pd.read_csv(csvFileName).to_dict('records') if f(row)]
+    assert len(dataset) == len(rows)
+
+    for index, row in enumerate(rows):
+        patch = dataset.patch(index)
+        expected = [getAbsoluteAddress(str(row[col])) for col in PanoSet.PATH_COLS]
+        assert list(patch)[:len(expected)] == expected
+        assert '({}, {})'.format(*patch.size) == row['Cropped.Img.Size']
+
+
+def toTensors(*imgs):
+    # stands in for the augmentation, uint8 images to 1xHxW tensors in [0, 1]
+    return [torch.from_numpy(np.array(img, dtype=np.float32)[None] / 255) for img in imgs]
+
+
+def writeCoco(cocoDir, dataType):
+    # two images, two overlapping persons on the first one, a crowd and another category ignored
+    imgDir = os.path.join(cocoDir, dataType)
+    os.makedirs(imgDir)
+    rng = np.random.RandomState(0)
+    images = []
+    for imgId, (h, w) in ((1, (60, 80)), (2, (50, 40))):
+        fileName = '{:012d}.jpg'.format(imgId)
+        Image.fromarray((rng.rand(h, w, 3) * 255).astype(np.uint8)).save(os.path.join(imgDir, fileName))
+        images.append({'id': imgId, 'file_name': fileName, 'height': h, 'width': w})
+
+    def square(annId, imgId, x, y, s, catId=1, iscrowd=0):
+        return {'id': annId, 'image_id': imgId, 'category_id': catId, 'iscrowd': iscrowd, 'area': s * s,
+                'bbox': [x, y, s, s], 'segmentation': [[x, y, x + s, y, x + s, y + s, x, y + s]]}
+
+    annotations = [square(1, 1, 10, 10, 20), square(2, 1, 20, 15, 20), square(3, 2, 5, 5, 15),
+                   square(4, 2, 20, 20, 10, iscrowd=1), square(5, 1, 50, 30, 10, catId=2)]
+    categories = [{'id': 1, 'name': 'person', 'supercategory': 'person'}, {'id': 2, 'name': 'dog', 'supercategory': 'animal'}]
+    with open(os.path.join(cocoDir, 'instances_{}.json'.format(dataType)), 'w') as annFile:
+        json.dump({'images': images, 'annotations': annotations, 'categories': categories}, annFile)
+
+
+def test_coco_pano_set_getitem(tmp_path, monkeypatch):
+    pytest.importorskip('pycocotools')
+    cocoDir = str(tmp_path / 'coco')
+    writeCoco(cocoDir, 'val2017')
+    # the instances cache goes to ../data/cache/coco/ of the working directory
+    os.makedirs(str(tmp_path / 'src'))
+    monkeypatch.chdir(str(tmp_path / 'src'))
+
+    dataset = CocoPanoSet(cocoDir, 'val2017', (32, 16), transform=toTensors)
+    assert len(dataset) == 3
+
+    for index in range(len(dataset)):
+        input, target, idx = dataset[index]
+        assert idx == index
+        assert tuple(input.shape) == (2, 32, 16)
+        assert tuple(target.shape) == (2, 32, 16)
+        # the instance is inside its window, the box covers the middle of it
+        assert target[0].sum() > 0
+        assert input[0, 16, 8] == 1
+
+    # the two persons of the first image overlap, each is the minor target of the other
+    assert dataset[0][1][1].sum() > 0
+    assert dataset[2][1][1].sum() == 0
+
+    dataset.step()
@@ -0,0 +1,90 @@
+"""
+
+tests of firstfilegen.py
+
+"""
+
+import os
+import json
+import pandas as pd
+import pytest
+
+from firstfilegen import makeFirstFile
+
+RAW_DIR = '../data/rawdata/'
+CSV_NAME = '../data/metadata/DataSet.csv'
+
+
+def touch(fileName, content='x'):
+    with open(fileName, 'w') as f:
+        f.write(content)
+
+
+def addPano(name, psd=True):
+    touch(RAW_DIR + 'panoImg/' + name + '.jpg')
+    touch(RAW_DIR + 'xmlFile/' + name + '.xml')
+    if psd:
+        touch(RAW_DIR + 'psdFile/' + name + '.psd')
+
+
+@pytest.fixture
+def rawTree(tmp_path, monkeypatch):
+    # makeFirstFile uses paths relative to src/
+    workDir = tmp_path / 'src'
+    workDir.mkdir()
+    monkeypatch.chdir(workDir)
+    for name in ('panoImg', 'psdFile', 'xmlFile'):
+        os.makedirs(RAW_DIR + name)
+    os.makedirs('../data/metadata')
+    addPano('T1-Pano-001')
+    addPano('T1-Pano-002')
+    addPano('T1-Pano-003', psd=False)
+
+
+def titles():
+    return list(pd.read_csv(CSV_NAME, index_col=0)['Image.Title'])
+
+
+def test_first_run_adds_every_annotated_pano(rawTree):
+    changes = makeFirstFile('not')
+
+    assert changes == {'added': ['T1-Pano-001', 'T1-Pano-002'], 'updated': [], 'removed': []}
+    assert titles() == ['T1-Pano-001', 'T1-Pano-002']
+    with open(CSV_NAME[:-4] + '-changes.json') as changesFile:
+        assert json.load(changesFile) == changes
+    with open(CSV_NAME[:-4] + '-index.json') as indexFile:
+        assert sorted(json.load(indexFile)) == ['T1-Pano-001', 'T1-Pano-002']
+
+
+def test_unchanged_rerun_keeps_the_csv(rawTree):
+    makeFirstFile('not')
+    mtime = os.stat(CSV_NAME).st_mtime_ns
+
+    changes = makeFirstFile('not')
+
+    assert changes == {'added': [], 'updated': [], 'removed': []}
+    assert os.stat(CSV_NAME).st_mtime_ns == mtime
+
+
+def test_rerun_adds_updates_and_removes(rawTree):
+    makeFirstFile('not')
+    touch(RAW_DIR + 'psdFile/T1-Pano-002.psd', 'a larger psd')
+    os.remove(RAW_DIR + 'panoImg/T1-Pano-001.jpg')
+    addPano('T1-Pano-004')
+
+    changes = makeFirstFile('not')
+
+    assert changes == {'added': ['T1-Pano-004'], 'updated': ['T1-Pano-002'], 'removed': ['T1-Pano-001']}
+    # kept rows stay in their order, added rows go last
+    assert titles() == ['T1-Pano-002', 'T1-Pano-004']
+    with open(CSV_NAME[:-4] + '-index.json') as indexFile:
+        assert sorted(json.load(indexFile)) == ['T1-Pano-002', 'T1-Pano-004']
+
+
+def test_semi_keeps_panos_without_psd(rawTree):
+    makeFirstFile('semi')
+
+    rows = pd.read_csv('../data/metadata/SemiSet.csv', index_col=0)
+    semi = rows[rows['Image.Title'] == 'T1-Pano-003'].iloc[0]
+    assert str(semi['Annot.File']) == '-1'
+    assert semi['Train.Val'] == 'semi'
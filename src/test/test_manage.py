@@ -0,0 +1,234 @@
+"""
+
+tests of manage.py
+
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('psd_tools')
+
+from manage import RunningStat, DatasetStat, generateDataset, calcStat, getStatFileName, loadManifest
+from patchstore import readPatchImage
+
+
+@pytest.fixture
+def firstFile(tmp_path, monkeypatch):
+    # a small synthetic data tree, the pipeline uses paths relative to src/
+    import benchmark
+    workDir = tmp_path / 'src'
+    workDir.mkdir()
+    monkeypatch.chdir(workDir)
+    return benchmark.synthesize(2, (300, 600), 2, 0)
+
+
+def randomImgs(seed, num):
+    rng = np.random.RandomState(seed)
+    return [(rng.rand(rng.randint(1, 20), rng.randint(1, 20)) * 255).astype(np.uint8) for _ in range(num)]
+
+
+def concatStat(imgs):
+    x = np.concatenate([img.ravel() for img in imgs]).astype(np.float64) / 255
+    return x.size, x.mean(), x.std()
+
+
+def test_running_stat_matches_concat():
+    imgs = randomImgs(0, 30)
+    stat = RunningStat()
+    for img in imgs:
+        stat.update(img)
+
+    n, mean, std = concatStat(imgs)
+    assert stat.n == n
+    assert stat.mean == pytest.approx(mean, abs=1e-12)
+    assert stat.std() == pytest.approx(std, abs=1e-12)
+
+
+def test_running_stat_merge_equals_concat():
+    imgs = randomImgs(1, 30)
+    # uneven parts, and an empty one
+    parts = [imgs[:1], imgs[1:17], [], imgs[17:]]
+    stats = []
+    for part in parts:
+        stat = RunningStat()
+        for img in part:
+            stat.update(img)
+        stats.append(stat)
+
+    merged = RunningStat()
+    for stat in stats:
+        merged.merge(stat)
+
+    n, mean, std = concatStat(imgs)
+    assert merged.n == n
+    assert merged.mean == pytest.approx(mean, abs=1e-12)
+    assert merged.std() == pytest.approx(std, abs=1e-12)
+
+
+def test_dataset_stat_merge_round_trip():
+    imgs = randomImgs(2, 8)
+    targets = ['0', 'a.jpg', '0', 'b.jpg', 'c.jpg', '0', 'd.jpg', 'e.jpg']
+    whole = DatasetStat()
+    parts = [DatasetStat(), DatasetStat()]
+    for i, img in enumerate(imgs):
+        minor = '0' if i % 3 else 'm.jpg'
+        whole.update(img, img[::-1], targets[i], minor)
+        parts[i % 2].update(img, img[::-1], targets[i], minor)
+
+    merged = DatasetStat.fromDict(parts[0].toDict()).merge(DatasetStat.fromDict(parts[1].toDict()))
+    for key in ('totalCount', 'noneCount', 'noneNSingleCount'):
+        assert getattr(merged, key) == getattr(whole, key)
+    for name in ('pano', 'box'):
+        assert getattr(merged, name).n == getattr(whole, name).n
+        assert getattr(merged, name).mean == pytest.approx(getattr(whole, name).mean, abs=1e-12)
+        assert getattr(merged, name).std() == pytest.approx(getattr(whole, name).std(), abs=1e-12)
+
+
+def test_calc_stat_empty_csv_with_jobs(tmp_path):
+    from manage import OUT_COLS, calcStat, getStatFileName
+
+    csvFileName = str(tmp_path / 'Empty-10.csv')
+    pd.DataFrame(columns=OUT_COLS).to_csv(csvFileName, index=False)
+
+    calcStat(csvFileName, jobs=2, force=True)
+
+    stat = DatasetStat.load(getStatFileName(csvFileName))
+    assert stat.totalCount == 0
+    assert stat.pano.n == 0 and stat.box.n == 0
+
+
+def test_gen_data_stat_equals_scan(firstFile):
+    generateDataset([10], firstFile)
+    csvFileName = '../data/metadata/BenchSet-10.csv'
+    written = DatasetStat.load(getStatFileName(csvFileName))
+
+    calcStat(csvFileName, force=True)
+    scanned = DatasetStat.load(getStatFileName(csvFileName))
+
+    assert written.totalCount == scanned.totalCount > 0
+    assert written.noneCount == scanned.noneCount
+    assert written.noneNSingleCount == scanned.noneNSingleCount
+    for name in ('pano', 'box'):
+        assert getattr(written, name).n == getattr(scanned, name).n
+        assert getattr(written, name).mean == pytest.approx(getattr(scanned, name).mean, rel=1e-12)
+        assert getattr(written, name).m2 == pytest.approx(getattr(scanned, name).m2, rel=1e-12)
+
+
+def storeSize(storeDir):
+    return sum(os.path.getsize(os.path.join(storeDir, f)) for f in os.listdir(storeDir))
+
+
+def test_forced_store_rerun_does_not_grow_the_store(firstFile):
+    storeDir = '../data/metadata/BenchSet-10/store/'
+    generateDataset([10], firstFile, store=True)
+    size = storeSize(storeDir)
+    assert size > 0
+
+    generateDataset([10], firstFile, force=True, store=True)
+    assert storeSize(storeDir) == size
+
+    # every row still reads from the remaining shards
+    rows = pd.read_csv('../data/metadata/BenchSet-10.csv').to_dict('records')
+    for row in rows:
+        assert readPatchImage(row['Cropped.Pano.Img']).size > 0
+
+
+MANIFEST_FILE = '../data/metadata/BenchSet-10/manifest.jsonl'
+TITLES = ['Bench-Pano-000', 'Bench-Pano-001']
+
+
+def manifestTitles():
+    # titles of the manifest lines, in the order they were appended
+    with open(MANIFEST_FILE) as manifestFile:
+        return [json.loads(line)['title'] for line in manifestFile]
+
+
+def csvTitles():
+    names = pd.read_csv('../data/metadata/BenchSet-10.csv')['Name']
+    return sorted(set(name.rsplit('-', 1)[0] for name in names))
+
+
+def test_manifest_rerun_regenerates_stale_panos_only(firstFile):
+    generateDataset([10], firstFile)
+    assert manifestTitles() == TITLES
+
+    generateDataset([10], firstFile)
+    assert manifestTitles() == TITLES
+
+    # a new modification time changes the input key
+    panoFileName = '../data/rawdata/panoImg/Bench-Pano-001.jpg'
+    stat = os.stat(panoFileName)
+    os.utime(panoFileName, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    generateDataset([10], firstFile)
+    assert manifestTitles() == TITLES + ['Bench-Pano-001']
+    assert csvTitles() == TITLES
+
+
+def test_manifest_force_regenerates_everything(firstFile):
+    generateDataset([10], firstFile)
+    generateDataset([10], firstFile, force=True)
+    assert manifestTitles() == TITLES + TITLES
+
+
+def test_manifest_truncated_line_is_dropped(firstFile):
+    generateDataset([10], firstFile)
+    # a run interrupted while writing the line of the second panorama
+    size = os.path.getsize(MANIFEST_FILE)
+    with open(MANIFEST_FILE, 'r+b') as manifestFile:
+        manifestFile.truncate(size - 20)
+
+    assert list(loadManifest(MANIFEST_FILE)) == TITLES[:1]
+    assert manifestTitles() == TITLES[:1]
+
+    generateDataset([10], firstFile)
+    assert manifestTitles() == TITLES
+    assert csvTitles() == TITLES
+
+
+def test_failed_pano_is_dropped_and_retried(firstFile):
+    xmlFileName = '../data/rawdata/xmlFile/Bench-Pano-000.xml'
+    with open(xmlFileName) as xmlFile:
+        xml = xmlFile.read()
+    with open(xmlFileName, 'w') as xmlFile:
+        xmlFile.write('<root><ToothList>')
+
+    generateDataset([10], firstFile)
+    assert manifestTitles() == TITLES[1:]
+    assert csvTitles() == TITLES[1:]
+
+    with open(xmlFileName, 'w') as xmlFile:
+        xmlFile.write(xml)
+    generateDataset([10], firstFile)
+    assert manifestTitles() == TITLES[1:] + TITLES[:1]
+    assert csvTitles() == TITLES
+
+
+def readOutputs(marginType):
+    # the .csv of marginType and the bytes of every patch it references
+    df = pd.read_csv('../data/metadata/BenchSet-{}.csv'.format(marginType), index_col=0)
+    patches = {}
+    for col in ('Cropped.Pano.Img', 'Cropped.Box.Img', 'Cropped.Major.Annot.Img', 'Cropped.Minor.Annot.Img'):
+        for fileName in df[col]:
+            with open(fileName, 'rb') as patchFile:
+                patches[fileName] = patchFile.read()
+    return df, patches
+
+
+def test_multi_margin_pass_equals_separate_runs(firstFile):
+    generateDataset([4, 10], firstFile)
+    onePass = {m: readOutputs(m) for m in (4, 10)}
+
+    for marginType in (4, 10):
+        generateDataset([marginType], firstFile, force=True)
+        df, patches = readOutputs(marginType)
+        assert len(df) > 0
+        pd.testing.assert_frame_equal(df, onePass[marginType][0])
+        assert patches == onePass[marginType][1]
+        assert set(df['Margin.Type']) == {marginType}
+
+    # each margin type gets its own crops
+    assert list(onePass[4][0]['Cropped.Img.Size']) != list(onePass[10][0]['Cropped.Img.Size'])
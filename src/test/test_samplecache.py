@@ -0,0 +1,98 @@
+"""
+
+tests of samplecache.py
+
+"""
+
+import os
+import numpy as np
+from PIL import Image
+
+from samplecache import SampleCache
+
+
+def writeImages(tmp_path, num, shape=(16, 8)):
+    rng = np.random.RandomState(0)
+    paths = []
+    for i in range(num):
+        path = str(tmp_path / '{}.png'.format(i))
+        Image.fromarray((rng.rand(*shape) * 255).astype(np.uint8), mode='L').save(path)
+        paths.append(path)
+    return paths
+
+
+def test_read_matches_file(tmp_path):
+    paths = writeImages(tmp_path, 3)
+    cache = SampleCache(3, 1 << 20, 1 << 20)
+    for _ in range(2):
+        for slot, path in enumerate(paths):
+            img = cache.read(slot, path)
+            assert img.mode == 'L'
+            assert (np.array(img) == np.array(Image.open(path))).all()
+
+    stats = cache.stats()
+    assert stats['encoded.misses'] == 3 and stats['encoded.hits'] == 0
+    assert stats['decoded.misses'] == 3 and stats['decoded.hits'] == 3
+    assert stats['encoded.bytes'] == sum(os.path.getsize(path) for path in paths)
+    assert stats['decoded.bytes'] == 3 * 16 * 8
+
+
+def test_decoded_lru_eviction(tmp_path):
+    paths = writeImages(tmp_path, 3)
+    # room for two decoded images
+    cache = SampleCache(3, 1 << 20, 2 * 16 * 8)
+    cache.read(0, paths[0])
+    cache.read(1, paths[1])
+    cache.read(0, paths[0])
+    # slot 1 is the least recently used
+    cache.read(2, paths[2])
+    assert list(cache.decoded) == [0, 2]
+
+    stats = cache.stats()
+    assert stats['decoded.evictions'] == 1
+    assert stats['decoded.bytes'] == 2 * 16 * 8
+
+    # slot 1 comes back from the encoded tier
+    cache.read(1, paths[1])
+    stats = cache.stats()
+    assert stats['encoded.hits'] == 1 and stats['decoded.evictions'] == 2
+
+
+def test_encoded_budget(tmp_path):
+    paths = writeImages(tmp_path, 3)
+    size = os.path.getsize(paths[0])
+    cache = SampleCache(3, size, 0)
+    for slot, path in enumerate(paths):
+        assert (np.array(cache.read(slot, path)) == np.array(Image.open(path))).all()
+
+    stats = cache.stats()
+    assert stats['encoded.full'] == 2
+    assert stats['encoded.bytes'] == size
+    assert stats['decoded.bytes'] == 0 and len(cache.decoded) == 0
+
+
+def test_encoded_tier_shared_across_fork(tmp_path):
+    paths = writeImages(tmp_path, 6)
+    cache = SampleCache(6, 1 << 20, 1 << 20)
+
+    # forked children fill the shared tier, like DataLoader workers
+    pids = []
+    for worker in range(2):
+        pid = os.fork()
+        if pid == 0:
+            for slot in range(worker, 6, 2):
+                cache.read(slot, paths[slot])
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        assert os.waitpid(pid, 0)[1] == 0
+
+    stats = cache.stats()
+    assert stats['encoded.misses'] == 6
+    assert stats['decoded.bytes'] == 6 * 16 * 8
+
+    # the parent finds every file in the shared tier, even a file that is gone
+    os.remove(paths[0])
+    for slot in range(6):
+        assert np.array(cache.read(slot, paths[slot])).shape == (16, 8)
+    assert cache.stats()['encoded.hits'] == 6
@@ -0,0 +1,92 @@
+"""
+
+tests of tensorshard.py
+
+"""
+
+import os
+import numpy as np
+import pytest
+from PIL import Image
+
+import tensorshard
+from tensorshard import loadShards, ShardReader
+
+
+class ImageSet():
+    # four random images of its own size per sample, like PanoSet.loadSample
+    def __init__(self, path, num):
+        self.path = path
+        self.num = num
+        self.loads = 0
+
+    def loadSample(self, index):
+        self.loads += 1
+        rng = np.random.RandomState(index)
+        h, w = rng.randint(5, 30), rng.randint(5, 30)
+        return [Image.fromarray((rng.rand(h, w) * 255).astype(np.uint8), mode='L') for _ in range(4)]
+
+    def __len__(self):
+        return self.num
+
+
+class ResizePrefix():
+    # the prefix is one resize to size, the rest would run per sample
+    def __init__(self, size):
+        self.size = size
+
+    def prefixLength(self):
+        return 1
+
+    def prefixSize(self):
+        return self.size
+
+    def prefixConfig(self):
+        return [['ToAll', 'Resize', {'size': str(self.size)}]]
+
+    def __call__(self, *imgs, start=0, stop=None):
+        assert start == 0 and stop == 1
+        return [img.resize((self.size[1], self.size[0]), Image.BILINEAR) for img in imgs]
+
+
+def expected(dataset, transform, index):
+    return np.stack([np.array(img) for img in transform(*dataset.loadSample(index), stop=1)])
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_shard_round_trip(tmp_path, monkeypatch, jobs):
+    monkeypatch.setattr(tensorshard, 'SHARD_SAMPLES', 3)
+    csvFileName = str(tmp_path / 'set.csv')
+    open(csvFileName, 'w').close()
+    dataset = ImageSet(csvFileName, 10)
+    transform = ResizePrefix((8, 6))
+    shardDir = str(tmp_path / 'shards')
+
+    shards = loadShards(dataset, transform, 'Mini', 'val', ['val'], shardDir, jobs)
+    assert len(shards) == 10 and len(shards.shards) == 4
+    for index in range(10):
+        assert shards[index].dtype == np.uint8
+        assert (shards[index] == expected(dataset, transform, index)).all()
+
+    # built once, read back by another reader without loading a sample
+    loads = dataset.loads
+    again = loadShards(dataset, transform, 'Mini', 'val', ['val'], shardDir, jobs)
+    assert dataset.loads == loads and again.shardDir == shards.shardDir
+    assert os.listdir(shardDir) == [os.path.basename(shards.shardDir)]
+
+    # another size or filter is another key
+    other = loadShards(dataset, ResizePrefix((4, 4)), 'Mini', 'val', ['val'], shardDir, jobs)
+    assert other.shardDir != shards.shardDir and other[0].shape == (4, 4, 4)
+    assert loadShards(dataset, transform, 'Mini', 'val', ['val', 'easy'], shardDir, jobs).shardDir != shards.shardDir
+
+
+def test_no_fixed_size(tmp_path):
+    dataset = ImageSet(str(tmp_path / 'set.csv'), 2)
+    assert loadShards(dataset, ResizePrefix(None), 'Mini', 'val', ['val'], str(tmp_path / 'shards')) is None
+
+
+def test_empty_dataset(tmp_path):
+    csvFileName = str(tmp_path / 'set.csv')
+    open(csvFileName, 'w').close()
+    shards = loadShards(ImageSet(csvFileName, 0), ResizePrefix((8, 6)), 'Mini', 'val', ['val'], str(tmp_path / 'shards'))
+    assert len(shards) == 0 and ShardReader(shards.shardDir).shards == []
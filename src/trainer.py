@@ -55,7 +55,9 @@ class Trainer():
                                       batch_size = batch_size, 
                                       shuffle = True, 
                                       pin_memory=torch.cuda.is_available(), 
-                                      num_workers=num_workers) 
+                                      num_workers=num_workers,
+                                      # workers keep the decoded tier of the sample cache across epochs
+                                      persistent_workers=num_workers > 0) 
                 for x in ['train', 'val']}
 
         start_time = datetime.datetime.now()